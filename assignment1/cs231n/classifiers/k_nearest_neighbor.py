@@ -1,12 +1,40 @@
+import hashlib
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 
+from cs231n.classifiers.knn_index import IVFIndex
+
+
+def _cast_train_data(X_train, dtype):
+  """
+  Flatten X_train to rows of dtype and compute their squared norms.
+  """
+  X_train = X_train.reshape(X_train.shape[0], -1)
+  X_train = np.ascontiguousarray(X_train, dtype=dtype)
+  sq_norms = np.sum(np.square(X_train, dtype=dtype), axis=1)
+  return X_train, sq_norms
+
+
+def _fold_digest(X_folds, y_folds):
+  """
+  Hash the shapes, types and contents of the folds for cross_validate.
+  """
+  h = hashlib.sha1()
+  for a in list(X_folds) + list(y_folds):
+    a = np.ascontiguousarray(a)
+    h.update(str((a.dtype.str, a.shape)))
+    h.update(a.view(np.uint8))
+  return h.hexdigest()
+
+
 class KNearestNeighbor(object):
   """ a kNN classifier with L2 distance """
 
   def __init__(self):
     pass
 
-  def train(self, X, y):
+  def train(self, X, y, index=None):
     """
     Train the classifier. For k-nearest neighbors this is just 
     memorizing the training data.
@@ -16,9 +44,19 @@ class KNearestNeighbor(object):
       consisting of num_train samples each of dimension D.
     - y: A numpy array of shape (N,) containing the training labels, where
          y[i] is the label for X[i].
+    - index: Optional approximate nearest neighbor index used by
+      predict_approx. Either an IVFIndex (built here if it has not been built
+      yet, for example one loaded with IVFIndex.load is used as is) or True to
+      build an IVFIndex with default settings.
     """
     self.X_train = X
     self.y_train = y
+    self._train_cast = {}
+    if index is True:
+      index = IVFIndex()
+    if index is not None and index.centroids is None:
+      index.build(X)
+    self.index = index
     
   def predict(self, X, k=1, num_loops=0):
     """
@@ -29,14 +67,15 @@ class KNearestNeighbor(object):
          of num_test samples each of dimension D.
     - k: The number of nearest neighbors that vote for the predicted labels.
     - num_loops: Determines which implementation to use to compute distances
-      between training points and testing points.
+      between training points and testing points. 0 uses the blocked search
+      of predict_blocked, which never builds the full distance matrix.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
     """
     if num_loops == 0:
-      dists = self.compute_distances_no_loops(X)
+      return self.predict_blocked(X, k=k)
     elif num_loops == 1:
       dists = self.compute_distances_one_loop(X)
     elif num_loops == 2:
@@ -128,60 +167,343 @@ class KNearestNeighbor(object):
     # HINT: Try to formulate the l2 distance using matrix multiplication    #
     #       and two broadcast sums.                                         #
     #########################################################################
-    pass
+    # |x - t|^2 = |x|^2 + |t|^2 - 2 x.t, with the training norms cached
+    X_train, train_sq = self._train_data(np.float64)
+    X = X.reshape(num_test, -1).astype(np.float64)
+    dists = X.dot(X_train.T)
+    dists *= -2
+    dists += np.sum(np.square(X), axis=1)[:, np.newaxis]
+    dists += train_sq
+    # Rounding in the expansion can give tiny negative values
+    np.maximum(dists, 0, out=dists)
+    np.sqrt(dists, out=dists)
     #########################################################################
     #                         END OF YOUR CODE                              #
     #########################################################################
     return dists
 
-  def predict_labels(self, dists, num_labels, k=1):
+  def predict_labels(self, dists, num_labels=None, k=1, weighted=False):
     """
     Given a matrix of distances between test points and training points,
     predict a label for each test point.
 
+    All test points are handled at once: np.argpartition selects the k
+    nearest neighbors of every row without fully sorting it, and the votes
+    are counted for all rows with a single np.bincount.
+
     Inputs:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
       gives the distance betwen the ith test point and the jth training point.
+    - num_labels: Number of classes; defaults to max(self.y_train) + 1.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - weighted: If True, each neighbor's vote is weighted by the inverse of
+      its distance.
 
     Returns:
     - y: A numpy array of shape (num_test,) containing predicted labels for the
       test data, where y[i] is the predicted label for the test point X[i].  
+      Ties are broken by choosing the smaller label.
     """
-    num_test = dists.shape[0]
-    y_pred = np.zeros(num_test)
-    for i in xrange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-      #########################################################################
-      # TODO:                                                                 #
-      # Use the distance matrix to find the k nearest neighbors of the ith    #
-      # testing point, and use self.y_train to find the labels of these       #
-      # neighbors. Store these labels in closest_y.                           #
-      # Hint: Look up the function numpy.argsort.                             #
-      #########################################################################
-      temp = np.argsort(dists[i, :]) #Computing the indices of training  
-      #examples (sorted w.r.t distance) 
-      temp = temp[:k] #Keeping only first k indices and slicing off the others. 
-      closest_y = self.y_train[temp] #Storing y-labels of k-nearest trainint examples. 
-      pass
-      #########################################################################
-      # TODO:                                                                 #
-      # Now that you have found the labels of the k nearest neighbors, you    #
-      # need to find the most common label in the list closest_y of labels.   #
-      # Store this label in y_pred[i]. Break ties by choosing the smaller     #
-      # label.                                                                #
-      #########################################################################
-      pass
-      classtopost = 0 #Assuming 0 class is the winner, as of yet.
-      winnerby = np.sum(closest_y == 0)
-      for j in range(1, num_labels): 
-            if np.sum(closest_y == j) > winnerby: 
-                winnerby = np.sum(closest_y == j)
-                classtopost = j 
-      y_pred[i] = classtopost 
-      #########################################################################
-      #                           END OF YOUR CODE                            # 
-      #########################################################################
-
-    return y_pred
\ No newline at end of file
+    num_train = dists.shape[1]
+    k = min(k, num_train)
+    if k < num_train:
+      idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    else:
+      idx = np.tile(np.arange(num_train), (dists.shape[0], 1))
+    weights = None
+    if weighted:
+      neighbor_dists = dists[np.arange(dists.shape[0])[:, np.newaxis], idx]
+      weights = 1.0 / (neighbor_dists + 1e-8)
+    return self._vote(self.y_train[idx], num_labels, weights)
+
+  def _vote(self, closest_y, num_labels=None, weights=None):
+    """
+    Majority vote over the labels of the nearest neighbors of many test
+    points at once.
+
+    Inputs:
+    - closest_y: Array of shape (num_test, k) giving neighbor labels.
+    - num_labels: Number of classes; defaults to max(self.y_train) + 1.
+    - weights: If not None, array of shape (num_test, k) giving the weight of
+      each neighbor's vote.
+
+    Returns:
+    - y: Array of shape (num_test,) giving the winning label of each row;
+      ties are broken by choosing the smaller label.
+    """
+    if num_labels is None:
+      num_labels = int(np.max(self.y_train)) + 1
+    num_test = closest_y.shape[0]
+    if weights is not None:
+      weights = weights.ravel()
+    # Give every row its own range of num_labels bins so that one bincount
+    # counts the votes for all rows.
+    offsets = num_labels * np.arange(num_test)[:, np.newaxis]
+    votes = np.bincount((closest_y + offsets).ravel(), weights=weights,
+                        minlength=num_test * num_labels)
+    votes = votes.reshape(num_test, num_labels)
+    return np.argmax(votes, axis=1).astype(self.y_train.dtype)
+
+  def _train_data(self, dtype):
+    """
+    Return the training data cast to dtype together with its squared row
+    norms. Both are computed once per dtype and reused for every query.
+    """
+    dtype = np.dtype(dtype)
+    if not hasattr(self, '_train_cast'):
+      self._train_cast = {}
+    if dtype not in self._train_cast:
+      self._train_cast[dtype] = _cast_train_data(self.X_train, dtype)
+    return self._train_cast[dtype]
+
+  def compute_nearest_neighbors(self, X, k=1, memory_budget=256 * 2**20,
+                                dtype=np.float64, num_threads=1):
+    """
+    Find the k nearest training points of each test point without ever
+    building the full (num_test, num_train) distance matrix.
+
+    Test and training points are processed in tiles whose distance block fits
+    in memory_budget bytes. Squared distances for a tile are computed with the
+    expansion |x - t|^2 = |x|^2 + |t|^2 - 2 x.t (one matrix multiply), and for
+    each test point only a running top-k is kept, merged with every new tile
+    using np.argpartition. Blocks of test points are independent, so they are
+    spread over a pool of threads; NumPy releases the GIL inside the matrix
+    multiply and the selection.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: Number of neighbors to return for each test point.
+    - memory_budget: Approximate number of bytes that all threads together
+      may use for distance tiles.
+    - dtype: Floating point type to compute in. float32 halves memory and is
+      faster, but the norm expansion loses precision on raw pixel values.
+    - num_threads: Number of worker threads.
+
+    Returns a tuple of:
+    - dists: Array of shape (num_test, k) giving the Euclidean distances to
+      the k nearest training points, sorted in increasing order.
+    - idx: Array of shape (num_test, k) giving the indices of those training
+      points; ties in distance are broken by smaller training index.
+    """
+    X_train, train_sq = self._train_data(dtype)
+    return self._nearest_neighbors(X, X_train, train_sq, k, memory_budget,
+                                   dtype, num_threads)
+
+  def _nearest_neighbors(self, X, X_train, train_sq, k, memory_budget, dtype,
+                         num_threads):
+    """
+    The search behind compute_nearest_neighbors, against training data
+    X_train with squared row norms train_sq, both as returned by
+    _cast_train_data.
+    """
+    X = X.reshape(X.shape[0], -1)
+    num_test = X.shape[0]
+    num_train = X_train.shape[0]
+    k = min(k, num_train)
+
+    # Pick tile sizes so that each thread stays within its share of the
+    # budget. Per element of a tile that is the distance itself plus the
+    # index np.argpartition returns for it; the merge that follows only works
+    # on the k survivors of the tile and the running top-k, which costs about
+    # as much as 3 * k more elements per test point.
+    bytes_per_element = np.dtype(dtype).itemsize + np.dtype(np.intp).itemsize
+    budget = max(memory_budget / num_threads / bytes_per_element, 1)
+    train_block = min(num_train, max(4 * k, 4096))
+    test_block = max(budget / (train_block + 3 * k), 1)
+    if test_block < 64:
+      test_block = min(64, num_test)
+      train_block = min(num_train, max(budget / test_block - 3 * k, k))
+    test_block = min(test_block, num_test)
+
+    dists = np.empty((num_test, k), dtype=dtype)
+    idx = np.empty((num_test, k), dtype=np.int64)
+
+    def run_block(start):
+      end = min(start + test_block, num_test)
+      X_b = np.ascontiguousarray(X[start:end], dtype=dtype)
+      rows = np.arange(end - start)[:, np.newaxis]
+      test_sq = np.sum(np.square(X_b, dtype=dtype), axis=1)[:, np.newaxis]
+      best_d = np.empty((end - start, 0), dtype=dtype)
+      best_i = np.empty((end - start, 0), dtype=np.int64)
+      for t_start in xrange(0, num_train, train_block):
+        t_end = min(t_start + train_block, num_train)
+        d2 = X_b.dot(X_train[t_start:t_end].T)
+        d2 *= -2
+        d2 += test_sq
+        d2 += train_sq[t_start:t_end]
+        # Keep only the k nearest of this tile before merging
+        if t_end - t_start > k:
+          sel = np.argpartition(d2, k - 1, axis=1)[:, :k]
+          tile_d, tile_i = d2[rows, sel], sel + t_start
+          # sel is a view of the whole index array; drop it with the tile
+          del sel
+        else:
+          tile_d = d2
+          tile_i = np.broadcast_to(np.arange(t_start, t_end), d2.shape)
+        del d2
+        cand_d = np.concatenate([best_d, tile_d], axis=1)
+        cand_i = np.concatenate([best_i, tile_i], axis=1)
+        if cand_d.shape[1] > k:
+          sel = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+          cand_d, cand_i = cand_d[rows, sel], cand_i[rows, sel]
+        best_d, best_i = cand_d, cand_i
+
+      # Sort the survivors by distance, breaking ties by training index
+      order = np.argsort(best_i, axis=1)
+      best_d, best_i = best_d[rows, order], best_i[rows, order]
+      order = np.argsort(best_d, axis=1, kind='mergesort')
+      best_d, best_i = best_d[rows, order], best_i[rows, order]
+
+      # Rounding in the norm expansion can give tiny negative values
+      np.maximum(best_d, 0, out=best_d)
+      dists[start:end] = np.sqrt(best_d)
+      idx[start:end] = best_i
+
+    starts = range(0, num_test, test_block)
+    if num_threads > 1 and len(starts) > 1:
+      pool = ThreadPool(num_threads)
+      try:
+        pool.map(run_block, starts)
+      finally:
+        pool.close()
+        pool.join()
+    else:
+      for start in starts:
+        run_block(start)
+
+    return dists, idx
+
+  def predict_blocked(self, X, k=1, weighted=False, **kwargs):
+    """
+    Predict labels for test data using the blocked nearest neighbor search in
+    compute_nearest_neighbors, which scales to training sets whose full
+    distance matrix would not fit in memory.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - weighted: If True, weight each neighbor's vote by inverse distance.
+    - kwargs: Passed on to compute_nearest_neighbors (memory_budget, dtype,
+      num_threads).
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels for the
+      test data. Ties in the vote are broken by choosing the smaller label.
+    """
+    dists, idx = self.compute_nearest_neighbors(X, k=k, **kwargs)
+    weights = 1.0 / (dists + 1e-8) if weighted else None
+    return self._vote(self.y_train[idx], weights=weights)
+
+  def predict_approx(self, X, k=1, nprobe=8, rerank=True, weighted=False):
+    """
+    Predict labels using the approximate nearest neighbor index passed to
+    train(). Only the training points in the nprobe cells closest to each
+    query are examined, so a query costs a fraction of a brute force search.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - nprobe: Number of index cells searched per query; larger values give
+      better recall at the cost of speed.
+    - rerank: If True, rank candidates by their exact distance in the original
+      space rather than by their distance in the index's reduced space.
+    - weighted: If True, weight each neighbor's vote by inverse distance.
+
+    Returns:
+    - y: A numpy array of shape (num_test,) containing predicted labels.
+    """
+    if getattr(self, 'index', None) is None:
+      raise ValueError('predict_approx requires training with an index')
+    X_train = self.X_train if rerank else None
+    dists, idx = self.index.search(X, k=k, nprobe=nprobe, X_train=X_train)
+
+    # Cells may hold fewer than k points in total; missing neighbors get a
+    # vote of weight zero.
+    found = idx >= 0
+    weights = found.astype(np.float64)
+    if weighted:
+      weights[found] = 1.0 / (dists[found] + 1e-8)
+    return self._vote(np.where(found, self.y_train[idx], 0), weights=weights)
+
+  def predict_multi_k(self, X, k_choices, **kwargs):
+    """
+    Predict labels for several values of k from a single neighbor search.
+
+    The neighbors returned by compute_nearest_neighbors are sorted by
+    distance, so the k nearest neighbors for every k in k_choices are
+    prefixes of one list of max(k_choices) neighbors.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k_choices: List of values of k.
+    - kwargs: Passed on to compute_nearest_neighbors.
+
+    Returns:
+    A dictionary mapping each k in k_choices to an array of shape (num_test,)
+    of predicted labels.
+    """
+    _, idx = self.compute_nearest_neighbors(X, k=max(k_choices), **kwargs)
+    return self._predict_from_neighbors(self.y_train[idx], k_choices)
+
+  def _predict_from_neighbors(self, closest_y, k_choices, num_labels=None):
+    return {k: self._vote(closest_y[:, :k], num_labels) for k in k_choices}
+
+  def cross_validate(self, X_folds, y_folds, k_choices, cache_key=None,
+                     **kwargs):
+    """
+    Run k-fold cross-validation for several values of k at once.
+
+    For each fold the distances from the fold to the remaining folds are
+    computed once and the sorted neighbor labels are reused for every k.
+    The neighbor labels of each fold are also cached on the classifier, so
+    calling cross_validate again with the same folds (for example with new
+    values of k) does not compute any distances unless a larger k is needed.
+
+    The cache is keyed on the contents of the folds (and the dtype of the
+    search), so rebuilt or modified folds are searched again; pass cache_key
+    to skip hashing the folds. The training data of the classifier itself is
+    left untouched.
+
+    Inputs:
+    - X_folds: List of arrays of shape (N_i, D) giving the data of each fold.
+    - y_folds: List of arrays of shape (N_i,) giving the labels of each fold.
+    - k_choices: List of values of k to evaluate.
+    - cache_key: If not None, a hashable value identifying the folds, used
+      instead of a hash of their contents.
+    - kwargs: Passed on to compute_nearest_neighbors.
+
+    Returns:
+    A dictionary mapping each k in k_choices to a list of length num_folds
+    giving the validation accuracy on each fold.
+    """
+    num_folds = len(X_folds)
+    max_k = max(k_choices)
+    num_labels = max(int(np.max(y)) for y in y_folds) + 1
+
+    memory_budget = kwargs.get('memory_budget', 256 * 2**20)
+    dtype = np.dtype(kwargs.get('dtype', np.float64))
+    num_threads = kwargs.get('num_threads', 1)
+
+    # The cache is only valid for folds with the same contents
+    if cache_key is None:
+      cache_key = _fold_digest(X_folds, y_folds)
+    tag = (cache_key, dtype.str)
+    if getattr(self, '_fold_cache_tag', None) != tag:
+      self._fold_cache_tag = tag
+      self._fold_cache = {}
+
+    k_to_accuracies = {k: [] for k in k_choices}
+    for i in xrange(num_folds):
+      cached = self._fold_cache.get(i)
+      if cached is None or cached.shape[1] < max_k:
+        y_train = np.concatenate(y_folds[:i] + y_folds[i + 1:])
+        X_train = np.concatenate(X_folds[:i] + X_folds[i + 1:])
+        X_train, train_sq = _cast_train_data(X_train, dtype)
+        _, idx = self._nearest_neighbors(X_folds[i], X_train, train_sq, max_k,
+                                         memory_budget, dtype, num_threads)
+        cached = self._fold_cache[i] = y_train[idx]
+      preds = self._predict_from_neighbors(cached, k_choices, num_labels)
+      for k in k_choices:
+        k_to_accuracies[k].append(np.mean(preds[k] == y_folds[i]))
+    return k_to_accuracies
+
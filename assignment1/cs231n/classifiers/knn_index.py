@@ -0,0 +1,253 @@
+import numpy as np
+
+
+def _sq_dists(A, B):
+  """
+  Squared Euclidean distances between the rows of A and the rows of B, using
+  the expansion |a - b|^2 = |a|^2 + |b|^2 - 2 a.b.
+  """
+  d = A.dot(B.T)
+  d *= -2
+  d += np.sum(A * A, axis=1)[:, np.newaxis]
+  d += np.sum(B * B, axis=1)
+  np.maximum(d, 0, out=d)
+  return d
+
+
+class IVFIndex(object):
+  """
+  An approximate nearest neighbor index: an inverted file over k-means cells
+  in a reduced-dimensional space.
+
+  Building the index projects the training data to projection_dim dimensions
+  (with PCA or a random Gaussian projection), clusters the projected points
+  with k-means, and stores the points of each cluster contiguously. A query
+  is projected the same way, the nprobe clusters with the closest centroids
+  are selected, and only the points in those clusters are compared with the
+  query. nprobe is the recall/speed knob: nprobe=num_lists is an exact search
+  (in the projected space, or the original space if the training data is
+  passed to search), while small values touch only a fraction of the data.
+
+  Example usage:
+
+  index = IVFIndex(num_lists=100, projection_dim=64)
+  index.build(X_train)
+  dists, idx = index.search(X_test, k=5, nprobe=8, X_train=X_train)
+  index.save('cifar_index.npz')
+  index = IVFIndex.load('cifar_index.npz')
+  """
+
+  def __init__(self, num_lists=None, projection_dim=64, projection='pca',
+               num_iters=10, train_size=20000, seed=None):
+    """
+    Inputs:
+    - num_lists: Number of k-means cells. Defaults to about sqrt(num_train).
+    - projection_dim: Dimension of the space the index is built in; if it is
+      None or not smaller than D, no projection is used.
+    - projection: 'pca' or 'random'.
+    - num_iters: Number of k-means iterations.
+    - train_size: Number of points used to fit the projection and centroids;
+      all points are then assigned to their nearest centroid.
+    - seed: Seed for the random number generator.
+    """
+    if projection not in ('pca', 'random'):
+      raise ValueError('Invalid projection "%s"' % projection)
+    self.num_lists = num_lists
+    self.projection_dim = projection_dim
+    self.projection = projection
+    self.num_iters = num_iters
+    self.train_size = train_size
+    self.seed = seed
+
+    self.mean = None
+    self.proj = None
+    self.centroids = None
+    self.list_offsets = None
+    self.list_ids = None
+    self.Z = None
+
+  def _project(self, X):
+    Z = X.reshape(X.shape[0], -1) - self.mean
+    if self.proj is not None:
+      Z = Z.dot(self.proj)
+    return Z.astype(np.float32)
+
+  def build(self, X):
+    """
+    Build the index over the training data X, of shape (num_train, D).
+    """
+    rng = np.random.RandomState(self.seed)
+    X = X.reshape(X.shape[0], -1)
+    num_train, D = X.shape
+    sample = X
+    if num_train > self.train_size:
+      sample = X[rng.choice(num_train, self.train_size, replace=False)]
+
+    # Fit the projection
+    self.mean = sample.mean(axis=0)
+    self.proj = None
+    if self.projection_dim is not None and self.projection_dim < D:
+      if self.projection == 'pca':
+        _, _, V = np.linalg.svd(sample - self.mean, full_matrices=False)
+        self.proj = V[:self.projection_dim].T
+      else:
+        self.proj = rng.randn(D, self.projection_dim) / np.sqrt(self.projection_dim)
+
+    # Run k-means on the projected sample
+    num_lists = self.num_lists
+    if num_lists is None:
+      num_lists = int(np.sqrt(num_train))
+    num_lists = max(1, min(num_lists, sample.shape[0]))
+    Z_sample = self._project(sample)
+    centroids = Z_sample[rng.choice(Z_sample.shape[0], num_lists, replace=False)]
+    for it in xrange(self.num_iters):
+      assign = np.argmin(_sq_dists(Z_sample, centroids), axis=1)
+      counts = np.bincount(assign, minlength=num_lists)
+      sums = np.zeros_like(centroids)
+      np.add.at(sums, assign, Z_sample)
+      nonempty = counts > 0
+      centroids[nonempty] = sums[nonempty] / counts[nonempty, np.newaxis]
+      # Reseed empty cells with random points
+      empty = np.flatnonzero(~nonempty)
+      if empty.size > 0:
+        centroids[empty] = Z_sample[rng.choice(Z_sample.shape[0], empty.size)]
+    self.centroids = centroids
+
+    # Assign every training point to a cell and store the cells contiguously
+    self.Z = self._project(X)
+    assign = np.empty(num_train, dtype=np.int64)
+    for start in xrange(0, num_train, 10000):
+      end = min(start + 10000, num_train)
+      d = _sq_dists(self.Z[start:end], centroids)
+      assign[start:end] = np.argmin(d, axis=1)
+    self.list_ids = np.argsort(assign, kind='mergesort')
+    counts = np.bincount(assign, minlength=num_lists)
+    self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+    self.Z = self.Z[self.list_ids]
+    return self
+
+  def search(self, X, k=1, nprobe=8, X_train=None, rerank_size=None,
+             dtype=np.float64, memory_budget=64 * 2**20):
+    """
+    Find approximate k nearest neighbors of each row of X.
+
+    Queries are grouped by the cells they probe, so the work for each cell is
+    one matrix multiply between the queries that probe it and the points it
+    holds. The best candidates found so far are merged with each cell's
+    results using np.argpartition.
+
+    Inputs:
+    - X: Array of shape (num_test, D) of query points.
+    - k: Number of neighbors to return.
+    - nprobe: Number of cells to search for each query.
+    - X_train: If given, the training data the index was built on. The best
+      rerank_size candidates in the projected space are then re-ranked by
+      their exact distance in the original space.
+    - rerank_size: Number of candidates to re-rank; defaults to 10 * k.
+    - dtype: Floating point type in which exact distances are computed; X and
+      the candidate rows of X_train (which may for example be uint8) are
+      cast to it.
+    - memory_budget: Approximate number of bytes used for the candidate rows
+      gathered from X_train while re-ranking.
+
+    Returns a tuple of:
+    - dists: Array of shape (num_test, k) of distances, sorted increasingly.
+    - idx: Array of shape (num_test, k) of training indices. If fewer than k
+      candidates were found the remaining entries are -1 with distance inf.
+    """
+    num_test = X.shape[0]
+    X = X.reshape(num_test, -1)
+    Z = self._project(X)
+    num_lists = self.centroids.shape[0]
+    nprobe = min(nprobe, num_lists)
+    cell_d = _sq_dists(Z, self.centroids)
+    if nprobe < num_lists:
+      probes = np.argpartition(cell_d, nprobe - 1, axis=1)[:, :nprobe]
+    else:
+      probes = np.tile(np.arange(num_lists), (num_test, 1))
+
+    num_cand = k
+    if X_train is not None:
+      num_cand = max(k, rerank_size or 10 * k)
+
+    # best_pos holds positions in the cell-sorted order of the index
+    best_d = np.empty((num_test, num_cand), dtype=np.float32)
+    best_d.fill(np.inf)
+    best_pos = -np.ones((num_test, num_cand), dtype=np.int64)
+    order = np.argsort(probes.ravel(), kind='mergesort')
+    cells = probes.ravel()[order]
+    queries = order / nprobe
+    bounds = np.searchsorted(cells, np.arange(num_lists + 1))
+    for c in xrange(num_lists):
+      Q = queries[bounds[c]:bounds[c + 1]]
+      lo, hi = self.list_offsets[c], self.list_offsets[c + 1]
+      if Q.size == 0 or hi == lo:
+        continue
+      d = _sq_dists(Z[Q], self.Z[lo:hi])
+      cand_d = np.concatenate([best_d[Q], d], axis=1)
+      cand_pos = np.concatenate([best_pos[Q], np.broadcast_to(
+                                 np.arange(lo, hi), d.shape)], axis=1)
+      rows = np.arange(Q.size)[:, np.newaxis]
+      sel = np.argpartition(cand_d, num_cand - 1, axis=1)[:, :num_cand]
+      best_d[Q] = cand_d[rows, sel]
+      best_pos[Q] = cand_pos[rows, sel]
+
+    found = best_pos >= 0
+    best_i = np.where(found, self.list_ids[np.maximum(best_pos, 0)], -1)
+    best_d = best_d.astype(np.float64)
+    if X_train is not None:
+      X_train = X_train.reshape(X_train.shape[0], -1)
+      # Gather the candidates of as many queries as fit in memory_budget and
+      # use the expansion |x - t|^2 = |x|^2 + |t|^2 - 2 x.t, as
+      # compute_nearest_neighbors does
+      row_bytes = num_cand * X_train.shape[1] * np.dtype(dtype).itemsize
+      chunk = max(1, memory_budget / row_bytes)
+      for start in xrange(0, num_test, chunk):
+        end = min(start + chunk, num_test)
+        x = X[start:end].astype(dtype)
+        T = X_train[np.maximum(best_i[start:end], 0)].astype(dtype, copy=False)
+        exact = np.matmul(T, x[:, :, np.newaxis])[:, :, 0]
+        exact *= -2
+        exact += np.einsum('nd,nd->n', x, x)[:, np.newaxis]
+        exact += np.einsum('nrd,nrd->nr', T, T)
+        del T
+        np.maximum(exact, 0, out=exact)
+        best_d[start:end] = np.where(found[start:end], exact, np.inf)
+
+    # Keep the k best, sorted by distance and then by training index
+    rows = np.arange(num_test)[:, np.newaxis]
+    order = np.argsort(np.where(found, best_i, np.iinfo(np.int64).max), axis=1)
+    best_d, best_i = best_d[rows, order], best_i[rows, order]
+    order = np.argsort(best_d, axis=1, kind='mergesort')[:, :k]
+    best_d, best_i = best_d[rows, order], best_i[rows, order]
+    return np.sqrt(best_d), best_i
+
+  def save(self, path):
+    """
+    Save the index to path as a .npz file.
+    """
+    proj = self.proj if self.proj is not None else np.zeros((0, 0))
+    np.savez(path, mean=self.mean, proj=proj, centroids=self.centroids,
+             list_offsets=self.list_offsets, list_ids=self.list_ids, Z=self.Z,
+             config=np.array([self.projection_dim or -1, self.num_iters,
+                              self.train_size]),
+             projection=np.array(self.projection))
+
+  @staticmethod
+  def load(path):
+    """
+    Load an index saved with save().
+    """
+    data = np.load(path)
+    projection_dim, num_iters, train_size = [int(v) for v in data['config']]
+    index = IVFIndex(num_lists=data['centroids'].shape[0],
+                     projection_dim=projection_dim if projection_dim >= 0 else None,
+                     projection=str(data['projection']), num_iters=num_iters,
+                     train_size=train_size)
+    index.mean = data['mean']
+    index.proj = data['proj'] if data['proj'].size > 0 else None
+    index.centroids = data['centroids']
+    index.list_offsets = data['list_offsets']
+    index.list_ids = data['list_ids']
+    index.Z = data['Z']
+    return index
@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+"""
+This file implements the on-disk format used by the Solver to checkpoint and
+resume training. A checkpoint is a directory holding:
+
+- One .npy file per distinct array, named after a hash of its contents, type
+  and shape.
+- A manifest, checkpoint.json, describing the saved state as a nested
+  structure of dictionaries, lists and numbers in which every array is
+  replaced by a reference to its file.
+
+Because files are named by their contents, saving a new checkpoint into the
+same directory only writes arrays that changed since the last one (such as
+the parameters and optimizer state); arrays that rarely change (such as the
+best parameters seen so far) are written once and then reused. The manifest
+is written to a temporary file and renamed over the old one, so a crash
+while saving leaves the previous checkpoint intact; array files that the new
+manifest no longer refers to are deleted afterwards.
+
+state = {'params': model.params, 'iteration': 100}
+save_checkpoint('/path/to/checkpoint', state)
+state = load_checkpoint('/path/to/checkpoint')
+
+The state may contain dictionaries with string keys, lists, tuples, strings,
+numbers, None and numpy arrays; tuples are restored as tuples, so that for
+example the result of np.random.get_state() round-trips.
+"""
+
+MANIFEST_NAME = 'checkpoint.json'
+
+
+def _array_name(a):
+  h = hashlib.sha1()
+  h.update(str(a.dtype))
+  h.update(str(a.shape))
+  h.update(np.ascontiguousarray(a).view(np.uint8))
+  return h.hexdigest() + '.npy'
+
+
+def _encode(obj, arrays):
+  """
+  Convert obj to a structure that json can store, replacing every array by a
+  reference to its file name and collecting the arrays in the dictionary
+  arrays, keyed by file name.
+  """
+  if isinstance(obj, np.ndarray):
+    name = _array_name(obj)
+    arrays[name] = obj
+    return {'__array__': name}
+  if isinstance(obj, np.generic):
+    return obj.item()
+  if isinstance(obj, dict):
+    return {str(k): _encode(v, arrays) for k, v in obj.iteritems()}
+  if isinstance(obj, tuple):
+    return {'__tuple__': [_encode(v, arrays) for v in obj]}
+  if isinstance(obj, list):
+    return [_encode(v, arrays) for v in obj]
+  return obj
+
+
+def _decode(obj, path):
+  if isinstance(obj, dict):
+    if '__array__' in obj:
+      return np.load(os.path.join(path, obj['__array__']))
+    if '__tuple__' in obj:
+      return tuple(_decode(v, path) for v in obj['__tuple__'])
+    return {str(k): _decode(v, path) for k, v in obj.iteritems()}
+  if isinstance(obj, list):
+    return [_decode(v, path) for v in obj]
+  if isinstance(obj, unicode):
+    return str(obj)
+  return obj
+
+
+def save_checkpoint(path, state):
+  """
+  Save state to the checkpoint directory path, creating it if needed.
+
+  Inputs:
+  - path: Checkpoint directory.
+  - state: Structure to save, as described at the top of this file.
+
+  Returns:
+  - bytes_written: Total size of the array files that had to be written;
+    arrays already present in the directory are not written again.
+  """
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  arrays = {}
+  manifest = {'version': 1, 'state': _encode(state, arrays)}
+
+  bytes_written = 0
+  for name, a in arrays.iteritems():
+    filename = os.path.join(path, name)
+    if os.path.exists(filename):
+      continue
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+      np.save(f, a)
+    os.rename(tmp_filename, filename)
+    bytes_written += a.nbytes
+
+  manifest_filename = os.path.join(path, MANIFEST_NAME)
+  tmp_filename = '%s.%d.tmp' % (manifest_filename, os.getpid())
+  with open(tmp_filename, 'w') as f:
+    json.dump(manifest, f, sort_keys=True)
+  os.rename(tmp_filename, manifest_filename)
+
+  # Only now that the new manifest is in place can stale arrays go
+  for name in os.listdir(path):
+    if name.endswith('.npy') and name not in arrays:
+      os.remove(os.path.join(path, name))
+  return bytes_written
+
+
+def load_checkpoint(path):
+  """
+  Load the state saved in the checkpoint directory path.
+  """
+  with open(os.path.join(path, MANIFEST_NAME)) as f:
+    manifest = json.load(f)
+  if manifest.get('version') != 1:
+    raise ValueError('Unsupported checkpoint version "%s"'
+                     % manifest.get('version'))
+  return _decode(manifest['state'], path)
@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 
 from cs231n.layers import *
@@ -9,16 +11,35 @@ class ThreeLayerConvNet(object):
   """
   A three-layer convolutional network with the following architecture:
   
-  conv - relu - 2x2 max pool - affine - relu - affine - softmax
+  conv - [spatial batch norm] - relu - 2x2 max pool - affine - [batch norm] -
+  relu - affine - softmax
+
+  where batch normalization is optional.
   
   The network operates on minibatches of data that have shape (N, C, H, W)
   consisting of N images, each with height H and width W and with C input
   channels.
+
+  For mixed precision training the Solver sets self.loss_scale; the gradients
+  returned by loss are those of loss_scale times the loss, while the loss
+  itself is returned unscaled.
+
+  To train with larger minibatches in the same memory, the first block
+  (conv - [spatial batch norm] - relu - pool), which holds by far the largest
+  intermediates, can be checkpointed: its intermediates are dropped after the
+  forward pass and recomputed during the backward pass. See the checkpoint
+  argument and layer_utils.checkpoint_report.
+
+  Parameters named in self.frozen_params are not trained: loss returns no
+  gradients for them, they are left out of the regularization loss, and the
+  backward pass skips the work that only they need. The input gradient of the
+  first layer is never computed.
   """
   
   def __init__(self, input_dim=(3, 32, 32), num_filters=32, filter_size=7,
                hidden_dim=100, num_classes=10, weight_scale=1e-3, reg=0.0,
-               dtype=np.float32):
+               dtype=np.float32, use_batchnorm=False, activation_dtype=None,
+               checkpoint=None, frozen_params=()):
     """
     Initialize a new network.
     
@@ -32,10 +53,28 @@ class ThreeLayerConvNet(object):
       of weights.
     - reg: Scalar giving L2 regularization strength
     - dtype: numpy datatype to use for computation.
+    - use_batchnorm: Whether to use batch normalization after the convolutional
+      layer and the hidden affine layer.
+    - activation_dtype: If not None, a numpy datatype such as np.float16 in
+      which to store the outputs of the first two layers; computations still
+      use dtype.
+    - checkpoint: What to recompute in the backward pass instead of keeping
+      from the forward pass: None (the default) for nothing, 'conv' for the
+      convolution's column matrix, or 'segment' for every intermediate of the
+      first block.
+    - frozen_params: Names of parameters that are not trained. It is kept as
+      the set self.frozen_params, which may be changed later.
     """
+    if checkpoint not in (None, 'conv', 'segment'):
+      raise ValueError('Invalid checkpoint mode "%s"' % checkpoint)
     self.params = {}
     self.reg = reg
     self.dtype = dtype
+    self.use_batchnorm = use_batchnorm
+    self.activation_dtype = activation_dtype
+    self.checkpoint = checkpoint
+    self.frozen_params = set(frozen_params)
+    self.loss_scale = 1.0
     
     ############################################################################
     # TODO: Initialize weights and biases for the three-layer convolutional    #
@@ -47,15 +86,134 @@ class ThreeLayerConvNet(object):
     # hidden affine layer, and keys 'W3' and 'b3' for the weights and biases   #
     # of the output affine layer.                                              #
     ############################################################################
-    pass
+    C, H, W = input_dim
+    self.params['W1'] = weight_scale * np.random.randn(num_filters, C,
+                                                       filter_size, filter_size)
+    self.params['b1'] = np.zeros(num_filters)
+    # The conv layer preserves the spatial size and the 2x2 pool halves it
+    pooled_dim = num_filters * (H / 2) * (W / 2)
+    self.params['W2'] = weight_scale * np.random.randn(pooled_dim, hidden_dim)
+    self.params['b2'] = np.zeros(hidden_dim)
+    self.params['W3'] = weight_scale * np.random.randn(hidden_dim, num_classes)
+    self.params['b3'] = np.zeros(num_classes)
+    if use_batchnorm:
+      self.params['gamma1'] = np.ones(num_filters)
+      self.params['beta1'] = np.zeros(num_filters)
+      self.params['gamma2'] = np.ones(hidden_dim)
+      self.params['beta2'] = np.zeros(hidden_dim)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
 
+    self.bn_params = []
+    if use_batchnorm:
+      self.bn_params = [{'mode': 'train'} for i in xrange(2)]
+
     for k, v in self.params.iteritems():
       self.params[k] = v.astype(dtype)
      
+
+  def activation_bytes(self, N):
+    """
+    Estimate the number of bytes of activations alive during a test-time
+    forward pass on N examples. The Solver uses this to choose how many
+    examples to evaluate at once.
+    """
+    W1, W2 = self.params['W1'], self.params['W2']
+    # The 2x2 pool keeps a quarter of the conv output, and the conv makes an
+    # im2col matrix with one column of W1[0].size values per output position
+    conv_out = 4 * W2.shape[0]
+    cols = conv_out / W1.shape[0] * W1[0].size
+    hidden = 2 * W2.shape[1]
+    return N * (cols + 2 * conv_out + hidden) * np.dtype(self.dtype).itemsize
  
+  def _trains(self, layer):
+    """
+    Whether any parameter of the given layer (1, 2 or 3) is being trained.
+    """
+    names = ['W%d' % layer, 'b%d' % layer, 'gamma%d' % layer, 'beta%d' % layer]
+    return any(name in self.params and name not in self.frozen_params
+               for name in names)
+
+
+  def _layer_params(self):
+    # pass conv_param to the forward pass for the convolutional layer
+    filter_size = self.params['W1'].shape[2]
+    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
+
+    # pass pool_param to the forward pass for the max-pooling layer
+    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    return conv_param, pool_param
+
+
+  def _score_chunks(self, X, batch_size):
+    """
+    Run the network forward in test mode over chunks of batch_size examples,
+    yielding (start, scores) for each chunk. Nothing is kept for a backward
+    pass, the convolution reuses its column buffer from chunk to chunk, and
+    the two affine layers write into buffers allocated once. The scores array
+    is reused too, so it is only valid until the next chunk.
+    """
+    N = X.shape[0]
+    chunk = max(1, min(batch_size, N))
+    conv_param, pool_param = self._layer_params()
+    W2, W3 = self.params['W2'], self.params['W3']
+    hidden = np.empty((chunk, W2.shape[1]), dtype=self.dtype)
+    scores = np.empty((chunk, W3.shape[1]), dtype=self.dtype)
+    bn = self.use_batchnorm
+
+    for start in xrange(0, N, chunk):
+      n = min(chunk, N - start)
+      x = X[start:start + n].astype(self.dtype, copy=False)
+      h1 = conv_bn_relu_pool_inference(
+          x, self.params['W1'], self.params['b1'], conv_param, pool_param,
+          self.params.get('gamma1'), self.params.get('beta1'),
+          self.bn_params[0] if bn else None)
+      h1 = h1.astype(self.dtype, copy=False)
+      h2 = affine_bn_relu_inference(
+          h1, W2, self.params['b2'], self.params.get('gamma2'),
+          self.params.get('beta2'), self.bn_params[1] if bn else None,
+          out=hidden[:n])
+      yield start, affine_bn_relu_inference(h2, W3, self.params['b3'],
+                                            relu=False, out=scores[:n])
+
+
+  def scores(self, X, batch_size=1000):
+    """
+    Compute classification scores for X with a forward-only inference pass,
+    as loss(X) does; see _score_chunks.
+
+    Inputs:
+    - X: Array of input data
+    - batch_size: Number of examples processed at a time.
+
+    Returns:
+    - scores: Array of shape (N, C) of classification scores.
+    """
+    scores = None
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      if scores is None:
+        scores = np.empty((X.shape[0], chunk_scores.shape[1]),
+                          dtype=chunk_scores.dtype)
+      scores[start:start + chunk_scores.shape[0]] = chunk_scores
+    return scores
+
+
+  def predict(self, X, batch_size=1000):
+    """
+    Predict class labels for X; unlike scores, this never holds more than
+    one chunk of scores at a time.
+
+    Returns:
+    - y_pred: Array of shape (N,) of predicted labels.
+    """
+    y_pred = np.empty(X.shape[0], dtype=np.intp)
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      y_pred[start:start + chunk_scores.shape[0]] = np.argmax(chunk_scores,
+                                                              axis=1)
+    return y_pred
+
+
   def loss(self, X, y=None):
     """
     Evaluate loss and gradient for the three-layer convolutional network.
@@ -66,12 +224,16 @@ class ThreeLayerConvNet(object):
     W2, b2 = self.params['W2'], self.params['b2']
     W3, b3 = self.params['W3'], self.params['b3']
     
-    # pass conv_param to the forward pass for the convolutional layer
-    filter_size = W1.shape[2]
-    conv_param = {'stride': 1, 'pad': (filter_size - 1) / 2}
+    # Test time uses the forward-only inference path
+    if y is None:
+      return self.scores(X)
 
-    # pass pool_param to the forward pass for the max-pooling layer
-    pool_param = {'pool_height': 2, 'pool_width': 2, 'stride': 2}
+    conv_param, pool_param = self._layer_params()
+    if self.checkpoint == 'conv':
+      conv_param['checkpoint'] = True
+
+    for bn_param in self.bn_params:
+      bn_param['mode'] = 'train'
 
     scores = None
     ############################################################################
@@ -79,14 +241,35 @@ class ThreeLayerConvNet(object):
     # computing the class scores for X and storing them in the scores          #
     # variable.                                                                #
     ############################################################################
-    pass
+    X = X.astype(self.dtype, copy=False)
+    act_dtype = self.activation_dtype
+    block1_forward = conv_relu_pool_forward
+    if self.use_batchnorm:
+      block1_forward = conv_bn_relu_pool_forward
+    if self.checkpoint == 'segment':
+      block1_forward = functools.partial(checkpoint_forward, block1_forward)
+    if self.use_batchnorm:
+      h1, cache1 = block1_forward(X, W1, b1, self.params['gamma1'],
+                                  self.params['beta1'], conv_param,
+                                  self.bn_params[0], pool_param,
+                                  out_dtype=act_dtype)
+      h2, cache2 = affine_bn_relu_dropout_forward(h1, W2, b2,
+                                                  self.params['gamma2'],
+                                                  self.params['beta2'],
+                                                  self.bn_params[1], None,
+                                                  out_dtype=act_dtype)
+    else:
+      h1, cache1 = block1_forward(X, W1, b1, conv_param, pool_param)
+      if act_dtype is not None:
+        h1 = h1.astype(act_dtype)
+      h2, cache2 = affine_relu_forward(h1, W2, b2)
+      if act_dtype is not None:
+        h2 = h2.astype(act_dtype)
+    scores, cache3 = affine_forward(h2, W3, b3)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
     
-    if y is None:
-      return scores
-    
     loss, grads = 0, {}
     ############################################################################
     # TODO: Implement the backward pass for the three-layer convolutional net, #
@@ -94,7 +277,43 @@ class ThreeLayerConvNet(object):
     # data loss using softmax, and make sure that grads[k] holds the gradients #
     # for self.params[k]. Don't forget to add L2 regularization!               #
     ############################################################################
-    pass
+    loss, dscores = softmax_loss(scores, y)
+    loss += 0.5 * self.reg * sum(np.sum(W * W) for k, W in
+                                 (('W1', W1), ('W2', W2), ('W3', W3))
+                                 if k not in self.frozen_params)
+    if self.loss_scale != 1:
+      dscores *= self.loss_scale
+
+    block1_backward = conv_relu_pool_backward
+    if self.use_batchnorm:
+      block1_backward = conv_bn_relu_pool_backward
+    if self.checkpoint == 'segment':
+      block1_backward = functools.partial(checkpoint_backward, block1_backward)
+
+    # Which layers have parameters to train; a layer needs the gradient of
+    # its input only if some layer below it does
+    trains = [self._trains(i) for i in (1, 2, 3)]
+
+    dh2, grads['W3'], grads['b3'] = affine_backward(
+        dscores, cache3, need_dx=trains[0] or trains[1], need_dw=trains[2])
+    if self.use_batchnorm:
+      dh1, grads['W2'], grads['b2'], grads['gamma2'], grads['beta2'] = \
+          affine_bn_relu_dropout_backward(dh2, cache2, need_dx=trains[0],
+                                          need_dw=trains[1])
+      if trains[0]:
+        _, grads['W1'], grads['b1'], grads['gamma1'], grads['beta1'] = \
+            block1_backward(dh1, cache1, need_dx=False)
+    else:
+      dh1, grads['W2'], grads['b2'] = affine_relu_backward(
+          dh2, cache2, need_dx=trains[0], need_dw=trains[1])
+      if trains[0]:
+        _, grads['W1'], grads['b1'] = block1_backward(dh1, cache1,
+                                                      need_dx=False)
+
+    grads = {k: v for k, v in grads.iteritems() if k not in self.frozen_params}
+    for k, W in (('W1', W1), ('W2', W2), ('W3', W3)):
+      if k in grads:
+        grads[k] += self.reg * self.loss_scale * W
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -2,6 +2,7 @@ import numpy as np
 
 from cs231n.layers import *
 from cs231n.layer_utils import *
+from cs231n.layer_graph import LayerGraph
 
 
 class TwoLayerNet(object):
@@ -108,7 +109,8 @@ class TwoLayerNet(object):
     loss += 0.5 * self.reg * (np.sum(W1*W1) + np.sum(W2*W2))
     
     l2_grad, grads['W2'], grads['b2'] = affine_backward(loss_grad, l2_cache)
-    dummy, grads['W1'], grads['b1'] = affine_relu_backward(l2_grad, l1_cache)
+    dummy, grads['W1'], grads['b1'] = affine_relu_backward(l2_grad, l1_cache,
+                                                           need_dx=False)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -130,11 +132,27 @@ class FullyConnectedNet(object):
   
   Similar to the TwoLayerNet above, learnable parameters are stored in the
   self.params dictionary and will be learned using the Solver class.
+
+  The layers are run by a LayerGraph (see cs231n/layer_graph.py), which works
+  in place where it can and frees each layer's cache as soon as its backward
+  pass is done. After setting self.graph.track_memory = True,
+  self.graph.memory_report() gives the peak activation memory of the last
+  call to loss.
+
+  For mixed precision training the Solver sets self.loss_scale; the gradients
+  returned by loss are those of loss_scale times the loss, while the loss
+  itself is returned unscaled.
+
+  Parameters named in self.frozen_params are not trained: loss returns no
+  gradients for them, they are left out of the regularization loss, and the
+  backward pass skips the work that only they need, stopping at the lowest
+  layer that is still being trained.
   """
 
   def __init__(self, hidden_dims, input_dim=3*32*32, num_classes=10,
                dropout=0, use_batchnorm=False, reg=0.0,
-               weight_scale=1e-2, dtype=np.float32, seed=None):
+               weight_scale=1e-2, dtype=np.float32, seed=None,
+               fuse_layers=True, activation_dtype=None, frozen_params=()):
     """
     Initialize a new FullyConnectedNet.
     
@@ -154,12 +172,23 @@ class FullyConnectedNet(object):
     - seed: If not None, then pass this random seed to the dropout layers. This
       will make the dropout layers deteriminstic so we can gradient check the
       model.
+    - fuse_layers: If True, run each hidden layer as a single
+      affine_bn_relu_dropout layer (see layer_utils.py) rather than as
+      separate affine, batchnorm, relu and dropout layers.
+    - activation_dtype: If not None, a numpy datatype such as np.float16 in
+      which to store the activations between layers; computations still use
+      dtype.
+    - frozen_params: Names of parameters that are not trained, for example
+      ['W1', 'b1'] to fine-tune all but the first layer. It is kept as the
+      set self.frozen_params, which may be changed later.
     """
     self.use_batchnorm = use_batchnorm
     self.use_dropout = dropout > 0
     self.reg = reg
     self.num_layers = 1 + len(hidden_dims)
     self.dtype = dtype
+    self.loss_scale = 1.0
+    self.frozen_params = set(frozen_params)
     self.params = {}
 
     ############################################################################
@@ -174,13 +203,13 @@ class FullyConnectedNet(object):
     # beta2, etc. Scale parameters should be initialized to one and shift      #
     # parameters should be initialized to zero.                                #
     ############################################################################
-    dims_list = hidden_dims
-    dims_list.insert(0, input_dim) 
-    dims_list.append(num_classes) 
+    dims_list = [input_dim] + list(hidden_dims) + [num_classes]
     for i in range(1, self.num_layers + 1): 
         self.params['W' + str(i)] = weight_scale * np.random.randn(dims_list[i-1], dims_list[i])
         self.params['b' + str(i)] = np.zeros((dims_list[i], ))
-        #self.params['gamma' + str(i)], self.params['beta' + str(i)] = 1, 1 
+        if self.use_batchnorm and i < self.num_layers:
+            self.params['gamma' + str(i)] = np.ones(dims_list[i])
+            self.params['beta' + str(i)] = np.zeros(dims_list[i])
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
@@ -207,6 +236,110 @@ class FullyConnectedNet(object):
     for k, v in self.params.iteritems():
       self.params[k] = v.astype(dtype)
 
+    # Describe the layers once; loss() runs them through the graph
+    self.graph = LayerGraph(storage_dtype=activation_dtype)
+    for i in xrange(1, self.num_layers):
+      names = ['W%d' % i, 'b%d' % i]
+      bn_names = ['gamma%d' % i, 'beta%d' % i] if self.use_batchnorm else []
+      if fuse_layers:
+        self.graph.add('affine_bn_relu_dropout', names + bn_names, {
+          'bn_param': self.bn_params[i - 1] if self.use_batchnorm else None,
+          'dropout_param': self.dropout_param if self.use_dropout else None,
+        })
+        continue
+      self.graph.add('affine', names)
+      if self.use_batchnorm:
+        self.graph.add('batchnorm', bn_names, self.bn_params[i - 1])
+      self.graph.add('relu')
+      if self.use_dropout:
+        self.graph.add('dropout', layer_param=self.dropout_param)
+    self.graph.add('affine', ['W%d' % self.num_layers, 'b%d' % self.num_layers])
+
+
+  def activation_bytes(self, N):
+    """
+    Estimate the number of bytes of activations alive during a test-time
+    forward pass on N examples. The Solver uses this to choose how many
+    examples to evaluate at once.
+    """
+    dims = [self.params['W1'].shape[0]]
+    dims += [self.params['W%d' % i].shape[1]
+             for i in xrange(1, self.num_layers + 1)]
+    # The graph keeps every layer's output, plus the normalized activations
+    # when using batch normalization
+    factor = 2 if self.use_batchnorm else 1
+    return N * sum(dims) * factor * np.dtype(self.dtype).itemsize
+
+
+  def _score_chunks(self, X, batch_size):
+    """
+    Run the network forward in test mode over chunks of batch_size examples,
+    yielding (start, scores) for each chunk. Nothing is kept for a backward
+    pass: every hidden layer reads from one of a pair of buffers and writes
+    into the other, so after the first chunk no activations are allocated.
+    The scores array is reused too, so it is only valid until the next
+    chunk.
+    """
+    N = X.shape[0]
+    L = self.num_layers
+    chunk = max(1, min(batch_size, N))
+    dims = [self.params['W%d' % i].shape[1] for i in xrange(1, L + 1)]
+    width = max(dims[:-1] or [0])
+    buffers = [np.empty(chunk * width, dtype=self.dtype) for i in xrange(2)]
+    scores = np.empty(chunk * dims[-1], dtype=self.dtype)
+
+    for start in xrange(0, N, chunk):
+      n = min(chunk, N - start)
+      h = X[start:start + n].reshape(n, -1).astype(self.dtype, copy=False)
+      for i in xrange(1, L + 1):
+        D = dims[i - 1]
+        buf = buffers[i % 2] if i < L else scores
+        gamma, beta, bn_param = None, None, None
+        if self.use_batchnorm and i < L:
+          gamma, beta = self.params['gamma%d' % i], self.params['beta%d' % i]
+          bn_param = self.bn_params[i - 1]
+        h = affine_bn_relu_inference(h, self.params['W%d' % i],
+                                     self.params['b%d' % i], gamma, beta,
+                                     bn_param, relu=i < L,
+                                     out=buf[:n * D].reshape(n, D))
+      yield start, h
+
+
+  def scores(self, X, batch_size=1000):
+    """
+    Compute classification scores for X with a forward-only inference pass,
+    as loss(X) does; see _score_chunks.
+
+    Inputs:
+    - X: Array of input data
+    - batch_size: Number of examples processed at a time.
+
+    Returns:
+    - scores: Array of shape (N, C) of classification scores.
+    """
+    scores = None
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      if scores is None:
+        scores = np.empty((X.shape[0], chunk_scores.shape[1]),
+                          dtype=chunk_scores.dtype)
+      scores[start:start + chunk_scores.shape[0]] = chunk_scores
+    return scores
+
+
+  def predict(self, X, batch_size=1000):
+    """
+    Predict class labels for X; unlike scores, this never holds more than
+    one chunk of scores at a time.
+
+    Returns:
+    - y_pred: Array of shape (N,) of predicted labels.
+    """
+    y_pred = np.empty(X.shape[0], dtype=np.intp)
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      y_pred[start:start + chunk_scores.shape[0]] = np.argmax(chunk_scores,
+                                                              axis=1)
+    return y_pred
+
 
   def loss(self, X, y=None):
     """
@@ -214,16 +347,19 @@ class FullyConnectedNet(object):
 
     Input / output: Same as TwoLayerNet above.
     """
+    # Test time uses the forward-only inference path
+    if y is None:
+      return self.scores(X)
+
     X = X.astype(self.dtype)
-    mode = 'test' if y is None else 'train'
 
-    # Set train/test mode for batchnorm params and dropout param since they
+    # Set train mode for batchnorm params and dropout param since they
     # behave differently during training and testing.
     if self.dropout_param is not None:
-      self.dropout_param['mode'] = mode   
+      self.dropout_param['mode'] = 'train'
     if self.use_batchnorm:
       for bn_param in self.bn_params:
-        bn_param[mode] = mode
+        bn_param['mode'] = 'train'
 
     scores = None
     ############################################################################
@@ -238,23 +374,12 @@ class FullyConnectedNet(object):
     # self.bn_params[1] to the forward pass for the second batch normalization #
     # layer, etc.                                                              #
     ############################################################################
-    caches = {}
     next_input = X.reshape((X.shape[0], -1)) #Reshaping input design matrix as 2D matrix
-    for l in range(1, self.num_layers): 
-            next_input, caches['layer' + str(l)] = affine_relu_forward(next_input, 
-                                                   self.params['W' + str(l)],
-                                                   self.params['b' + str(l)])
-    scores, caches['layer' + str(self.num_layers)] = affine_forward(next_input, 
-                                       self.params['W' + str(self.num_layers)], 
-                                       self.params['b' + str(self.num_layers)])
+    scores = self.graph.forward(next_input, self.params)
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
 
-    # If test mode return early
-    if mode == 'test':
-      return scores
-
     loss, grads = 0.0, {}
     ############################################################################
     # TODO: Implement the backward pass for the fully-connected net. Store the #
@@ -273,18 +398,19 @@ class FullyConnectedNet(object):
      
     weights_sum = 0 
     for nl in xrange(1, self.num_layers + 1):
+        if 'W' + str(nl) in self.frozen_params:
+            continue
         weights_sum = weights_sum + np.sum(self.params['W' + str(nl)] *
                                            self.params['W' + str(nl)])
     loss += 0.5 * self.reg * weights_sum
     
-    grad_back, grads['W' + str(self.num_layers)], grads['b' + str(self.num_layers)] =\
-    affine_backward(loss_grad, caches['layer' + str(self.num_layers)])
-    grads['W' + str(self.num_layers)] += self.reg * self.params['W' + str(self.num_layers)]
-    
-    for l in xrange(self.num_layers - 1, 0, -1): 
-        grad_back, grads['W' + str(l)], grads['b' + str(l)] = affine_relu_backward(
-                                                grad_back, caches['layer' + str(l)])
-        grads['W' + str(l)] += self.reg * self.params['W' + str(l)]
+    if self.loss_scale != 1:
+        loss_grad *= self.loss_scale
+    grad_back, grads = self.graph.backward(loss_grad, need_dx=False,
+                                           frozen=self.frozen_params)
+    for l in xrange(1, self.num_layers + 1):
+        if 'W' + str(l) in grads:
+            grads['W' + str(l)] += self.reg * self.loss_scale * self.params['W' + str(l)]
     ############################################################################
     #                             END OF YOUR CODE                             #
     ############################################################################
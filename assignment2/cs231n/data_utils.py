@@ -1,4 +1,7 @@
 import cPickle as pickle
+import itertools
+import json
+import multiprocessing
 import numpy as np
 import os
 from scipy.misc import imread
@@ -69,15 +72,108 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000):
     }
     
 
-def load_tiny_imagenet(path, dtype=np.float32):
+def _load_tiny_imagenet_image(filename):
+  """
+  Decode a single TinyImageNet image into a uint8 array of shape (3, 64, 64).
+  This runs inside the worker processes of the loaders below.
+  """
+  img = imread(filename)
+  if img.ndim == 2:
+    ## grayscale file
+    img.shape = (64, 64, 1)
+  return img.transpose(2, 0, 1)
+
+
+def _make_pool(num_workers):
+  """
+  Create a worker pool for decoding images, or return None to decode in the
+  calling process. num_workers=None uses one worker per CPU.
+  """
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  if num_workers <= 1:
+    return None
+  return multiprocessing.Pool(num_workers)
+
+
+def _decode_iter(filenames, pool=None):
+  """
+  Return an iterator over the decoded images in filenames, in order.
+  """
+  if pool is None:
+    return itertools.imap(_load_tiny_imagenet_image, filenames)
+  return pool.imap(_load_tiny_imagenet_image, filenames, chunksize=64)
+
+
+def _decode_images(filenames, out, pool=None, progress=None, stage=None):
+  """
+  Decode filenames[i] into out[i], optionally using a multiprocessing pool.
+  Images are written straight into the preallocated output array.
+  """
+  total = len(filenames)
+  for i, img in enumerate(_decode_iter(filenames, pool)):
+    out[i] = img
+    if progress is not None and ((i + 1) % 1000 == 0 or i + 1 == total):
+      progress(stage, i + 1, total)
+  return out
+
+
+def _read_tiny_imagenet_classes(path):
+  """
+  Read the wnids and class names of a TinyImageNet directory.
+
+  Returns a tuple of:
+  - wnids: List of wnid strings; label i corresponds to wnids[i].
+  - class_names: List where class_names[i] is a list of strings giving the
+    WordNet names for class i.
+  """
+  # First load wnids
+  with open(os.path.join(path, 'wnids.txt'), 'r') as f:
+    wnids = [x.strip() for x in f]
+
+  # Use words.txt to get names for each class
+  with open(os.path.join(path, 'words.txt'), 'r') as f:
+    wnid_to_words = dict(line.split('\t') for line in f)
+    for wnid, words in wnid_to_words.iteritems():
+      wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
+  class_names = [wnid_to_words[wnid] for wnid in wnids]
+  return wnids, class_names
+
+
+def _tiny_imagenet_train_files(path, wnids):
+  """
+  Return a list whose ith element is the list of training image filenames
+  for class i.
+  """
+  train_files = []
+  for wnid in wnids:
+    # To figure out the filenames we need to open the boxes file
+    boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
+    with open(boxes_file, 'r') as f:
+      filenames = [x.split('\t')[0] for x in f]
+    train_files.append([os.path.join(path, 'train', wnid, 'images', x)
+                        for x in filenames])
+  return train_files
+
+
+def load_tiny_imagenet(path, dtype=np.float32, num_workers=None,
+                       progress=None):
   """
   Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
   TinyImageNet-200 have the same directory structure, so this can be used
   to load any of them.
 
+  Images are decoded in parallel by a pool of worker processes and written
+  directly into preallocated output arrays.
+
   Inputs:
   - path: String giving path to the directory to load.
   - dtype: numpy datatype used to load the data.
+  - num_workers: Number of processes used to decode images. The default of
+    None uses one per CPU; 0 or 1 decodes in the calling process.
+  - progress: If not None, a function progress(stage, done, total) that is
+    called periodically while images are decoded; stage is one of 'train',
+    'val' or 'test'.
 
   Returns: A tuple of
   - class_names: A list where class_names[i] is a list of strings giving the
@@ -90,77 +186,43 @@ def load_tiny_imagenet(path, dtype=np.float32):
   - y_test: (N_test,) array of test labels; if test labels are not available
     (such as in student code) then y_test will be None.
   """
-  # First load wnids
-  with open(os.path.join(path, 'wnids.txt'), 'r') as f:
-    wnids = [x.strip() for x in f]
+  wnids, class_names = _read_tiny_imagenet_classes(path)
 
   # Map wnids to integer labels
   wnid_to_label = {wnid: i for i, wnid in enumerate(wnids)}
 
-  # Use words.txt to get names for each class
-  with open(os.path.join(path, 'words.txt'), 'r') as f:
-    wnid_to_words = dict(line.split('\t') for line in f)
-    for wnid, words in wnid_to_words.iteritems():
-      wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
-  class_names = [wnid_to_words[wnid] for wnid in wnids]
+  # Training images are laid out class by class
+  train_files = _tiny_imagenet_train_files(path, wnids)
+  y_train = np.concatenate([i * np.ones(len(files), dtype=np.int64)
+                            for i, files in enumerate(train_files)])
+  train_files = list(itertools.chain.from_iterable(train_files))
 
-  # Next load training data.
-  X_train = []
-  y_train = []
-  for i, wnid in enumerate(wnids):
-    if (i + 1) % 20 == 0:
-      print 'loading training data for synset %d / %d' % (i + 1, len(wnids))
-    # To figure out the filenames we need to open the boxes file
-    boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
-    with open(boxes_file, 'r') as f:
-      filenames = [x.split('\t')[0] for x in f]
-    num_images = len(filenames)
-    
-    X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-    y_train_block = wnid_to_label[wnid] * np.ones(num_images, dtype=np.int64)
-    for j, img_file in enumerate(filenames):
-      img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        ## grayscale file
-        img.shape = (64, 64, 1)
-      X_train_block[j] = img.transpose(2, 0, 1)
-    X_train.append(X_train_block)
-    y_train.append(y_train_block)
-      
-  # We need to concatenate all training data
-  X_train = np.concatenate(X_train, axis=0)
-  y_train = np.concatenate(y_train, axis=0)
-  
-  # Next load validation data
+  # Next read the validation annotations
   with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
-    img_files = []
+    val_files = []
     val_wnids = []
     for line in f:
       img_file, wnid = line.split('\t')[:2]
-      img_files.append(img_file)
+      val_files.append(os.path.join(path, 'val', 'images', img_file))
       val_wnids.append(wnid)
-    num_val = len(img_files)
-    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-    X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-      img_file = os.path.join(path, 'val', 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        img.shape = (64, 64, 1)
-      X_val[i] = img.transpose(2, 0, 1)
-
-  # Next load test images
+  y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+
   # Students won't have test labels, so we need to iterate over files in the
   # images directory.
-  img_files = os.listdir(os.path.join(path, 'test', 'images'))
-  X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-  for i, img_file in enumerate(img_files):
-    img_file = os.path.join(path, 'test', 'images', img_file)
-    img = imread(img_file)
-    if img.ndim == 2:
-      img.shape = (64, 64, 1)
-    X_test[i] = img.transpose(2, 0, 1)
+  test_names = os.listdir(os.path.join(path, 'test', 'images'))
+  test_files = [os.path.join(path, 'test', 'images', x) for x in test_names]
+
+  X_train = np.empty((len(train_files), 3, 64, 64), dtype=dtype)
+  X_val = np.empty((len(val_files), 3, 64, 64), dtype=dtype)
+  X_test = np.empty((len(test_files), 3, 64, 64), dtype=dtype)
+  pool = _make_pool(num_workers)
+  try:
+    _decode_images(train_files, X_train, pool, progress, 'train')
+    _decode_images(val_files, X_val, pool, progress, 'val')
+    _decode_images(test_files, X_test, pool, progress, 'test')
+  finally:
+    if pool is not None:
+      pool.terminate()
 
   y_test = None
   y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
@@ -170,28 +232,264 @@ def load_tiny_imagenet(path, dtype=np.float32):
       for line in f:
         line = line.split('\t')
         img_file_to_wnid[line[0]] = line[1]
-    y_test = [wnid_to_label[img_file_to_wnid[img_file]] for img_file in img_files]
+    y_test = [wnid_to_label[img_file_to_wnid[img_file]] for img_file in test_names]
     y_test = np.array(y_test)
   
   return class_names, X_train, y_train, X_val, y_val, X_test, y_test
 
 
+def iter_tiny_imagenet_train(path, dtype=np.float32, num_workers=None,
+                             progress=None):
+  """
+  Stream the TinyImageNet training set one class at a time.
+
+  Images for all classes are decoded by the worker pool in the background;
+  each class is yielded as soon as its last image is ready, so the caller can
+  start working on early classes while later ones are still being decoded.
+
+  Inputs: Same as load_tiny_imagenet; progress is called with stage 'train'.
+
+  Yields tuples of:
+  - X_block: (N_c, 3, 64, 64) array of the training images of one class
+  - y_block: (N_c,) array of the labels of those images
+  """
+  wnids, _ = _read_tiny_imagenet_classes(path)
+  train_files = _tiny_imagenet_train_files(path, wnids)
+  all_files = list(itertools.chain.from_iterable(train_files))
+  total = len(all_files)
+
+  pool = _make_pool(num_workers)
+  try:
+    images = _decode_iter(all_files, pool)
+    done = 0
+    for label, files in enumerate(train_files):
+      X_block = np.empty((len(files), 3, 64, 64), dtype=dtype)
+      for j in xrange(len(files)):
+        X_block[j] = next(images)
+      done += len(files)
+      if progress is not None:
+        progress('train', done, total)
+      yield X_block, label * np.ones(len(files), dtype=np.int64)
+  finally:
+    if pool is not None:
+      pool.terminate()
+
+
+def write_dataset_cache(cache_dir, arrays, meta=None):
+  """
+  Write a set of arrays to a directory so that they can later be memory-mapped
+  with load_dataset_cache. Each array is stored as its own .npy file and a
+  small index.json file records the array names and any extra metadata.
+
+  The index is written last, so a directory with an index file always holds a
+  complete cache.
+
+  Inputs:
+  - cache_dir: String giving the directory to write to; it is created if it
+    does not exist.
+  - arrays: Dictionary mapping names to numpy arrays.
+  - meta: Optional JSON-serializable object stored alongside the arrays.
+  """
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  index = {'arrays': {}, 'meta': meta}
+  for name, arr in arrays.iteritems():
+    arr = np.ascontiguousarray(arr)
+    np.save(os.path.join(cache_dir, name + '.npy'), arr)
+    index['arrays'][name] = {'shape': arr.shape, 'dtype': arr.dtype.str}
+  tmp_file = os.path.join(cache_dir, 'index.json.tmp')
+  with open(tmp_file, 'w') as f:
+    json.dump(index, f)
+  os.rename(tmp_file, os.path.join(cache_dir, 'index.json'))
+
+
+def load_dataset_cache(cache_dir, mmap_mode='r'):
+  """
+  Load a cache written by write_dataset_cache.
+
+  With the default mmap_mode the arrays are memory-mapped rather than read:
+  loading is nearly instant, pages are only read from disk when they are
+  touched, and several processes mapping the same cache share one copy in the
+  operating system's page cache.
+
+  Inputs:
+  - cache_dir: String giving the directory holding the cache.
+  - mmap_mode: Passed to np.load; use None to read the arrays into memory.
+
+  Returns a tuple of:
+  - arrays: Dictionary mapping names to (memory-mapped) arrays.
+  - meta: The metadata object passed to write_dataset_cache.
+  """
+  with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+    index = json.load(f)
+  arrays = {}
+  for name in index['arrays']:
+    arrays[str(name)] = np.load(os.path.join(cache_dir, name + '.npy'),
+                                mmap_mode=mmap_mode)
+  return arrays, index['meta']
+
+
+def has_dataset_cache(cache_dir):
+  """ Check whether cache_dir holds a complete dataset cache """
+  return os.path.isfile(os.path.join(cache_dir, 'index.json'))
+
+
+class MeanSubtractedImages(object):
+  """
+  A read-only view of a uint8 image array that converts images to floating
+  point and subtracts a mean image as they are read.
+
+  Indexing returns a regular numpy array holding only the selected images, so
+  wrapping a memory-mapped cache lets a Solver train on data that is larger
+  than RAM: only the current minibatch is ever converted. Anything that reads
+  the whole array at once loses this benefit; the 'chunk' sampler is the
+  cheapest way to read from it, since it reads slices of consecutive images.
+  """
+
+  def __init__(self, images, mean_image, dtype=np.float64):
+    self.images = images
+    self.mean_image = mean_image.astype(dtype)
+    self.dtype = np.dtype(dtype)
+    self.shape = images.shape
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, idx):
+    X = np.asarray(self.images[idx]).astype(self.dtype)
+    X -= self.mean_image
+    return X
+
+
+def cache_CIFAR10(ROOT, cache_dir):
+  """
+  Convert CIFAR-10 into a memory-mappable cache.
+
+  Images are stored as uint8 in (N, 3, 32, 32) order, which is the layout of
+  the original batch files, together with the int64 labels and the float32
+  mean of the training images.
+  """
+  xs, ys = [], []
+  files = ['data_batch_%d' % b for b in range(1, 6)] + ['test_batch']
+  for filename in files:
+    with open(os.path.join(ROOT, filename), 'rb') as f:
+      datadict = pickle.load(f)
+    xs.append(np.asarray(datadict['data'], dtype=np.uint8).reshape(-1, 3, 32, 32))
+    ys.append(np.asarray(datadict['labels'], dtype=np.int64))
+  arrays = {
+    'X_train': np.concatenate(xs[:-1]), 'y_train': np.concatenate(ys[:-1]),
+    'X_test': xs[-1], 'y_test': ys[-1],
+  }
+  arrays['mean_image'] = arrays['X_train'].mean(axis=0, dtype=np.float64)
+  arrays['mean_image'] = arrays['mean_image'].astype(np.float32)
+  write_dataset_cache(cache_dir, arrays, meta={'dataset': 'cifar10'})
+
+
+def load_CIFAR10_cached(ROOT, cache_dir):
+  """
+  Load all of CIFAR-10 from a memory-mapped cache, building the cache first
+  if it does not exist yet.
+
+  Unlike load_CIFAR10 the images are returned as read-only uint8 arrays of
+  shape (N, 3, 32, 32).
+  """
+  if not has_dataset_cache(cache_dir):
+    cache_CIFAR10(ROOT, cache_dir)
+  arrays, _ = load_dataset_cache(cache_dir)
+  return arrays['X_train'], arrays['y_train'], arrays['X_test'], arrays['y_test']
+
+
+def get_CIFAR10_data_cached(num_training=49000, num_validation=1000,
+                            num_test=1000, cache_dir='cs231n/datasets/cifar-10-cache',
+                            dtype=np.float64):
+  """
+  Memory-mapped counterpart of get_CIFAR10_data.
+
+  Returns the same dictionary, but each X entry is a MeanSubtractedImages
+  view onto the cache, so start-up does not read any image data and images
+  are only converted to floating point when a minibatch is taken. The mean is
+  computed over the whole CIFAR-10 training set when the cache is built.
+  """
+  cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
+  if not has_dataset_cache(cache_dir):
+    cache_CIFAR10(cifar10_dir, cache_dir)
+  arrays, _ = load_dataset_cache(cache_dir)
+  mean_image = arrays['mean_image']
+
+  # Basic slicing of a memory-mapped array does not copy any data
+  X_train, y_train = arrays['X_train'], arrays['y_train']
+  val = slice(num_training, num_training + num_validation)
+  return {
+    'X_train': MeanSubtractedImages(X_train[:num_training], mean_image, dtype),
+    'y_train': y_train[:num_training],
+    'X_val': MeanSubtractedImages(X_train[val], mean_image, dtype),
+    'y_val': y_train[val],
+    'X_test': MeanSubtractedImages(arrays['X_test'][:num_test], mean_image,
+                                   dtype),
+    'y_test': arrays['y_test'][:num_test],
+  }
+
+
+def cache_tiny_imagenet(path, cache_dir):
+  """
+  Convert a TinyImageNet dataset into a memory-mappable cache of uint8
+  images. The class names are stored in the cache index.
+  """
+  class_names, X_train, y_train, X_val, y_val, X_test, y_test = \
+    load_tiny_imagenet(path, dtype=np.uint8)
+  arrays = {
+    'X_train': X_train, 'y_train': y_train,
+    'X_val': X_val, 'y_val': y_val,
+    'X_test': X_test,
+  }
+  if y_test is not None:
+    arrays['y_test'] = y_test
+  meta = {'dataset': 'tiny_imagenet', 'class_names': class_names}
+  write_dataset_cache(cache_dir, arrays, meta=meta)
+
+
+def load_tiny_imagenet_cached(path, cache_dir):
+  """
+  Load TinyImageNet from a memory-mapped cache, building the cache first if
+  it does not exist yet.
+
+  Returns the same tuple as load_tiny_imagenet, except that the images are
+  read-only uint8 arrays.
+  """
+  if not has_dataset_cache(cache_dir):
+    cache_tiny_imagenet(path, cache_dir)
+  arrays, meta = load_dataset_cache(cache_dir)
+  return (meta['class_names'], arrays['X_train'], arrays['y_train'],
+          arrays['X_val'], arrays['y_val'], arrays['X_test'],
+          arrays.get('y_test'))
+
+
+
 def load_models(models_dir):
   """
   Load saved models from disk. This will attempt to unpickle all files in a
   directory; any files that give errors on unpickling (such as README.txt) will
-  be skipped.
+  be skipped. Files written by cs231n.inference.export_model are memory-mapped
+  with load_model instead.
 
   Inputs:
   - models_dir: String giving the path to a directory containing model files.
-    Each model file is a pickled dictionary with a 'model' field.
+    Each model file is a pickled dictionary with a 'model' field, or an
+    exported model.
 
   Returns:
   A dictionary mapping model file names to models.
   """
+  # Imported here so that loading data does not pull in the models
+  from cs231n.inference import is_exported_model, load_model
+
   models = {}
   for model_file in os.listdir(models_dir):
-    with open(os.path.join(models_dir, model_file), 'rb') as f:
+    filename = os.path.join(models_dir, model_file)
+    if is_exported_model(filename):
+      models[model_file] = load_model(filename)
+      continue
+    with open(filename, 'rb') as f:
       try:
         models[model_file] = pickle.load(f)['model']
       except pickle.UnpicklingError:
@@ -1,7 +1,13 @@
+import json
+import os
+import threading
+import time
+
 import numpy as np
 try:
   from cs231n.im2col_cython import col2im_cython, im2col_cython
   from cs231n.im2col_cython import col2im_6d_cython
+  from cs231n.im2col_cython import set_num_threads, get_num_threads
 except ImportError:
   print 'run the following from the cs231n directory and try again:'
   print 'python setup.py build_ext --inplace'
@@ -83,7 +89,7 @@ def conv_forward_strides(x, w, b, conv_param):
   return out, cache
   
 
-def conv_backward_strides(dout, cache):
+def conv_backward_strides(dout, cache, need_dx=True, need_dw=True):
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
@@ -91,19 +97,21 @@ def conv_backward_strides(dout, cache):
   F, _, HH, WW = w.shape
   _, _, out_h, out_w = dout.shape
 
-  db = np.sum(dout, axis=(0, 2, 3))
-
+  dx, dw, db = None, None, None
   dout_reshaped = dout.transpose(1, 0, 2, 3).reshape(F, -1)
-  dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+  if need_dw:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-  dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
-  dx_cols.shape = (C, HH, WW, N, out_h, out_w)
-  dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  if need_dx:
+    dx_cols = w.reshape(F, -1).T.dot(dout_reshaped)
+    dx_cols.shape = (C, HH, WW, N, out_h, out_w)
+    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
 
   return dx, dw, db
 
 
-def conv_backward_im2col(dout, cache):
+def conv_backward_im2col(dout, cache, need_dx=True, need_dw=True):
   """
   A fast implementation of the backward pass for a convolutional layer
   based on im2col and col2im.
@@ -111,32 +119,577 @@ def conv_backward_im2col(dout, cache):
   x, w, b, conv_param, x_cols = cache
   stride, pad = conv_param['stride'], conv_param['pad']
 
-  db = np.sum(dout, axis=(0, 2, 3))
-
+  dx, dw, db = None, None, None
   num_filters, _, filter_height, filter_width = w.shape
   dout_reshaped = dout.transpose(1, 2, 3, 0).reshape(num_filters, -1)
-  dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
+  if need_dw:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw = dout_reshaped.dot(x_cols.T).reshape(w.shape)
 
-  dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
-  # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
-  dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2], x.shape[3],
-                     filter_height, filter_width, pad, stride)
+  if need_dx:
+    dx_cols = w.reshape(num_filters, -1).T.dot(dout_reshaped)
+    # dx = col2im_indices(dx_cols, x.shape, filter_height, filter_width, pad, stride)
+    dx = col2im_cython(dx_cols, x.shape[0], x.shape[1], x.shape[2],
+                       x.shape[3], filter_height, filter_width, pad, stride)
 
   return dx, dw, db
 
 
-conv_forward_fast = conv_forward_strides
-conv_backward_fast = conv_backward_strides
+class ConvWorkspace(object):
+  """
+  A pool of reusable scratch buffers, keyed by shape and dtype.
+
+  The workspace convolution below takes its padded input and column buffers
+  from here instead of allocating them. The column buffer travels in the
+  cache and is handed back by the backward pass, so in steady-state training
+  the same few buffers are reused on every step. Buffers are only held by the
+  pool while nobody is using them; a forward pass that is never followed by a
+  backward pass (as at test time) simply lets its buffer be garbage collected.
+
+  The pool is shared by every thread (such as the Solver's background
+  evaluation), so it is guarded by a lock; a buffer is only ever handed to
+  one caller at a time.
+  """
+
+  def __init__(self):
+    self._free = {}
+    self._lock = threading.Lock()
+
+  def get(self, shape, dtype):
+    key = (tuple(shape), np.dtype(dtype).str)
+    with self._lock:
+      buffers = self._free.get(key)
+      if buffers:
+        return buffers.pop()
+    return np.empty(shape, dtype=dtype)
+
+  def release(self, buf):
+    key = (buf.shape, buf.dtype.str)
+    with self._lock:
+      self._free.setdefault(key, []).append(buf)
+
+  def clear(self):
+    with self._lock:
+      self._free = {}
+
+
+conv_workspace = ConvWorkspace()
+
+
+def conv_forward_workspace(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer that
+  avoids allocating temporaries.
+
+  Compared to conv_forward_strides:
+  - The padded input and the column matrix come from conv_workspace.
+  - Computation happens in the dtype of w; with float32 weights the input is
+    converted once and everything else stays in float32.
+  - The column matrix is laid out as (N, C * HH * WW, out_h * out_w), so a
+    batched matrix multiply writes the output directly in (N, F, out_h, out_w)
+    order without the transpose and copy at the end.
+  - The cache holds the column matrix but not x itself.
+
+  The cache is consumed by conv_backward_workspace, which reuses the column
+  matrix as scratch space and returns it to the workspace; it can only be
+  passed to the backward pass once.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # Check dimensions
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  dtype = w.dtype
+  p = pad
+  Hp, Wp = H + 2 * p, W + 2 * p
+  out_h = (Hp - HH) / stride + 1
+  out_w = (Wp - WW) / stride + 1
+
+  # Pad the input into a reused buffer; only the border needs zeroing
+  if p > 0:
+    x_padded = conv_workspace.get((N, C, Hp, Wp), dtype)
+    x_padded[:, :, :p, :] = 0
+    x_padded[:, :, -p:, :] = 0
+    x_padded[:, :, p:-p, :p] = 0
+    x_padded[:, :, p:-p, -p:] = 0
+    x_padded[:, :, p:-p, p:-p] = x
+  else:
+    x_padded = np.ascontiguousarray(x, dtype=dtype)
+
+  # im2col through a strided view, copied straight into the column buffer
+  sN, sC, sH, sW = x_padded.strides
+  x_stride = np.lib.stride_tricks.as_strided(x_padded,
+                shape=(N, C, HH, WW, out_h, out_w),
+                strides=(sN, sC, sH, sW, stride * sH, stride * sW))
+  x_cols = conv_workspace.get((N, C * HH * WW, out_h * out_w), dtype)
+  x_cols.reshape(N, C, HH, WW, out_h, out_w)[...] = x_stride
+  if p > 0:
+    conv_workspace.release(x_padded)
+
+  out = np.empty((N, F, out_h * out_w), dtype=dtype)
+  np.matmul(w.reshape(F, -1), x_cols, out=out)
+  out += b.astype(dtype, copy=False).reshape(1, F, 1)
+  out.shape = (N, F, out_h, out_w)
+
+  cache = (x.shape, w, conv_param, [x_cols])
+  return out, cache
+
+
+def conv_backward_workspace(dout, cache, need_dx=True, need_dw=True):
+  """
+  Backward pass for conv_forward_workspace.
+  """
+  x_shape, w, conv_param, holder = cache
+  x_cols = holder[0]
+  if x_cols is None:
+    raise ValueError('This cache has already been used by a backward pass')
+  holder[0] = None
+
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  _, _, out_h, out_w = dout.shape
+
+  dx, dw, db = None, None, None
+  dout = np.ascontiguousarray(dout, dtype=w.dtype).reshape(N, F, -1)
+  w_cols = w.reshape(F, -1)
+  if need_dw:
+    db = np.sum(dout, axis=(0, 2))
+    # One batched multiply over all examples; unlike np.tensordot this needs
+    # no transposed copy of x_cols, only an (N, F, C * HH * WW) result
+    dw = np.matmul(dout, x_cols.transpose(0, 2, 1)).sum(axis=0)
+    dw = dw.reshape(w.shape)
+
+  if need_dx:
+    # x_cols is no longer needed, so the column gradient can overwrite it
+    dx_cols = np.matmul(np.ascontiguousarray(w_cols.T), dout, out=x_cols)
+    dx_cols = dx_cols.reshape(N, C, HH, WW, out_h, out_w).transpose(1, 2, 3, 0, 4, 5)
+    dx = col2im_6d_cython(dx_cols, N, C, H, W, HH, WW, pad, stride)
+  conv_workspace.release(x_cols)
+
+  return dx, dw, db
+
+
+# Transforms for Winograd's minimal filtering algorithm F(2x2, 3x3), which
+# computes a 2x2 block of outputs from a 4x4 block of inputs as
+# A^T [(G g G^T) * (B^T d B)] A
+# using 16 multiplies instead of the 36 needed by direct convolution.
+_WINOGRAD_BT = np.array([[1, 0, -1, 0],
+                         [0, 1, 1, 0],
+                         [0, -1, 1, 0],
+                         [0, 1, 0, -1]], dtype=np.float64)
+_WINOGRAD_G = np.array([[1, 0, 0],
+                        [0.5, 0.5, 0.5],
+                        [0.5, -0.5, 0.5],
+                        [0, 0, 1]], dtype=np.float64)
+_WINOGRAD_AT = np.array([[1, 1, 1, 0],
+                         [0, 1, -1, -1]], dtype=np.float64)
+
+
+def conv_forward_winograd(x, w, b, conv_param):
+  """
+  Forward pass for a 3x3, stride 1 convolutional layer using Winograd's
+  F(2x2, 3x3) algorithm.
+
+  The padded input is cut into overlapping 4x4 tiles with a stride of 2. Each
+  tile and each filter is transformed, the transformed tiles are combined
+  with the transformed filters with one (F, C) x (C, tiles) matrix multiply
+  for each of the 16 tile positions, and each product is transformed back
+  into a 2x2 block of the output.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+  assert HH == WW == 3 and stride == 1, 'winograd needs 3x3 filters, stride 1'
+
+  dtype = w.dtype
+  out_h = H + 2 * pad - 2
+  out_w = W + 2 * pad - 2
+  th, tw = (out_h + 1) / 2, (out_w + 1) / 2
+
+  # Pad so that the tiles cover the padded input exactly
+  x_padded = np.zeros((N, C, 2 * th + 2, 2 * tw + 2), dtype=dtype)
+  x_padded[:, :, pad:pad + H, pad:pad + W] = x
+  sN, sC, sH, sW = x_padded.strides
+  tiles = np.lib.stride_tricks.as_strided(x_padded,
+              shape=(N, C, th, tw, 4, 4),
+              strides=(sN, sC, 2 * sH, 2 * sW, sH, sW))
+
+  BT = _WINOGRAD_BT.astype(dtype)
+  G = _WINOGRAD_G.astype(dtype)
+  AT = _WINOGRAD_AT.astype(dtype)
+
+  # V[a, b, c, p] = (B^T d B)[a, b] for channel c and tile p = (n, i, j)
+  V = np.matmul(np.matmul(BT, tiles), BT.T)
+  V = V.transpose(4, 5, 1, 0, 2, 3).reshape(16, C, N * th * tw)
+  # U[a, b, f, c] = (G g G^T)[a, b]
+  U = np.matmul(np.matmul(G, w), G.T).transpose(2, 3, 0, 1).reshape(16, F, C)
+
+  M = np.matmul(U, V).reshape(4, 4, F, N, th, tw)
+  Y = np.tensordot(AT, M, axes=(1, 0))
+  Y = np.tensordot(AT, Y, axes=(1, 1))
+
+  # Y[j, i, f, n, ti, tj] is output pixel (2 * ti + i, 2 * tj + j)
+  out = Y.transpose(3, 2, 4, 1, 5, 0).reshape(N, F, 2 * th, 2 * tw)
+  out = out[:, :, :out_h, :out_w] + b.astype(dtype).reshape(1, F, 1, 1)
+
+  cache = (x.shape, w, conv_param, U, V)
+  return out, cache
+
+
+def conv_backward_winograd(dout, cache, need_dx=True, need_dw=True):
+  """
+  Backward pass for conv_forward_winograd. Every step of the forward pass is
+  linear, so the backward pass applies the transposes of the same transforms
+  in reverse order.
+  """
+  x_shape, w, conv_param, U, V = cache
+  pad = conv_param['pad']
+  N, C, H, W = x_shape
+  F = w.shape[0]
+  out_h, out_w = dout.shape[2], dout.shape[3]
+  th, tw = (out_h + 1) / 2, (out_w + 1) / 2
+
+  dtype = w.dtype
+  BT = _WINOGRAD_BT.astype(dtype)
+  G = _WINOGRAD_G.astype(dtype)
+  AT = _WINOGRAD_AT.astype(dtype)
+
+  dx, dw, db = None, None, None
+  dout_padded = np.zeros((N, F, 2 * th, 2 * tw), dtype=dtype)
+  dout_padded[:, :, :out_h, :out_w] = dout
+  dY = dout_padded.reshape(N, F, th, 2, tw, 2).transpose(3, 5, 1, 0, 2, 4)
+  dM = np.tensordot(AT.T, dY, axes=(1, 0))
+  dM = np.tensordot(AT.T, dM, axes=(1, 1)).transpose(1, 0, 2, 3, 4, 5)
+  dM = dM.reshape(16, F, N * th * tw)
+
+  if need_dw:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dU = np.matmul(dM, V.transpose(0, 2, 1))
+    dU = dU.reshape(4, 4, F, C).transpose(2, 3, 0, 1)
+    dw = np.matmul(np.matmul(G.T, dU), G)
+
+  if need_dx:
+    dV = np.matmul(U.transpose(0, 2, 1), dM)
+    dtiles = dV.reshape(4, 4, C, N, th, tw).transpose(3, 2, 4, 5, 0, 1)
+    dtiles = np.matmul(np.matmul(BT.T, dtiles), BT)
+
+    # Tiles overlap, so scatter-add each of the 16 tile positions
+    dx_padded = np.zeros((N, C, 2 * th + 2, 2 * tw + 2), dtype=dtype)
+    for i in xrange(4):
+      for j in xrange(4):
+        dx_padded[:, :, i:i + 2 * th:2, j:j + 2 * tw:2] += dtiles[:, :, :, :, i, j]
+    dx = dx_padded[:, :, pad:pad + H, pad:pad + W]
+
+  return dx, dw, db
+
+
+def _fft_matmul(A, B):
+  """
+  Multiply two stacks of spectra along their leading axes: A has shape
+  (P, Q, h, w) and B has shape (Q, R, h, w); the result has shape
+  (P, R, h, w) and is A * B summed over Q, independently at each frequency.
+  """
+  P, Q, h, w = A.shape
+  R = B.shape[1]
+  A = A.reshape(P, Q, -1).transpose(2, 0, 1)
+  B = B.reshape(Q, R, -1).transpose(2, 0, 1)
+  return np.matmul(A, B).transpose(1, 2, 0).reshape(P, R, h, w)
+
+
+def conv_forward_fft(x, w, b, conv_param):
+  """
+  Forward pass for a convolutional layer computed in the frequency domain.
+
+  The padded input and the zero-extended filters are transformed with a 2D
+  FFT of the padded input size; multiplying by the conjugate filter spectrum
+  and transforming back gives the cross-correlation at every offset. Because
+  the filters are no larger than the input, the offsets that form the output
+  never wrap around. The cost hardly depends on the filter size, which makes
+  this attractive for large filters such as 7x7.
+  """
+  N, C, H, W = x.shape
+  F, _, HH, WW = w.shape
+  stride, pad = conv_param['stride'], conv_param['pad']
+
+  # Check dimensions
+  assert (W + 2 * pad - WW) % stride == 0, 'width does not work'
+  assert (H + 2 * pad - HH) % stride == 0, 'height does not work'
+
+  dtype = w.dtype
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  x_padded = np.pad(x, ((0, 0), (0, 0), (pad, pad), (pad, pad)),
+                    mode='constant')
+
+  x_fft = np.fft.rfft2(x_padded, s=(Hp, Wp))
+  w_fft = np.fft.rfft2(w, s=(Hp, Wp))
+  out_fft = _fft_matmul(x_fft, np.conj(w_fft).transpose(1, 0, 2, 3))
+  out = np.fft.irfft2(out_fft, s=(Hp, Wp))
+
+  out = out[:, :, :Hp - HH + 1:stride, :Wp - WW + 1:stride]
+  out = (out + b.reshape(1, F, 1, 1)).astype(dtype)
+
+  cache = (x.shape, w, conv_param, x_fft, w_fft)
+  return out, cache
+
+
+def conv_backward_fft(dout, cache, need_dx=True, need_dw=True):
+  """
+  Backward pass for conv_forward_fft. The filter gradient is the
+  cross-correlation of the input with the upstream gradient and the input
+  gradient is the full convolution of the upstream gradient with the
+  filters; both are computed with FFTs of the padded input size.
+  """
+  x_shape, w, conv_param, x_fft, w_fft = cache
+  stride, pad = conv_param['stride'], conv_param['pad']
+  N, C, H, W = x_shape
+  F, _, HH, WW = w.shape
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+
+  dx, dw, db = None, None, None
+  # Spread a strided gradient back onto every offset
+  dout_full = np.zeros((N, F, Hp - HH + 1, Wp - WW + 1), dtype=dout.dtype)
+  dout_full[:, :, ::stride, ::stride] = dout
+  dout_fft = np.fft.rfft2(dout_full, s=(Hp, Wp))
+
+  if need_dw:
+    db = np.sum(dout, axis=(0, 2, 3))
+    dw_fft = _fft_matmul(x_fft.transpose(1, 0, 2, 3), np.conj(dout_fft))
+    dw = np.fft.irfft2(dw_fft, s=(Hp, Wp))[:, :, :HH, :WW]
+    dw = dw.transpose(1, 0, 2, 3).astype(w.dtype)
+
+  if need_dx:
+    dx_fft = _fft_matmul(dout_fft, w_fft)
+    dx = np.fft.irfft2(dx_fft, s=(Hp, Wp))[:, :, pad:pad + H, pad:pad + W]
+    dx = dx.astype(w.dtype)
+
+  return dx, dw, db
+
+
+# Every available convolution implementation, as (forward, backward) pairs.
+# conv_forward_fast uses the one named by conv_param['backend']. Every
+# backward function takes need_dx and need_dw flags; see conv_backward_fast.
+conv_backends = {
+  'strides': (conv_forward_strides, conv_backward_strides),
+  'im2col': (conv_forward_im2col, conv_backward_im2col),
+  'workspace': (conv_forward_workspace, conv_backward_workspace),
+  'winograd': (conv_forward_winograd, conv_backward_winograd),
+  'fft': (conv_forward_fft, conv_backward_fft),
+}
+
+
+class ConvAutotuner(object):
+  """
+  Picks the fastest convolution backend for each layer shape by timing them.
+
+  The tuner is only used by layers that ask for conv_param['backend'] =
+  'auto'. The first time a layer with a new signature (C, H, W, F, HH, WW,
+  stride, pad, dtype, and N rounded up to a power of two) is seen, every
+  backend that supports it runs a forward and a backward pass on that
+  layer's actual inputs and the fastest one is remembered. Later calls with
+  the same signature are routed straight to the winner, so for example the
+  smaller last chunk of an evaluation does not trigger a new benchmark.
+
+  Results are kept in memory. If a cache file is given, either as cache_path
+  or through $CS231N_CONV_AUTOTUNE_CACHE, they are also written there so that
+  they survive across processes. Timings depend on the machine and on the
+  number of threads, so delete the file (or call clear()) after changing
+  either. Note that the backends do not all round the same way: winograd and
+  fft are less accurate than the others in float32.
+
+  A lock serializes select() and clear() across threads, so that a layer is
+  only tuned once and the timings are not disturbed by another thread's
+  benchmark.
+  """
+
+  def __init__(self, cache_path=None, num_repeats=2,
+               backends=('strides', 'im2col', 'workspace', 'winograd', 'fft')):
+    """
+    Inputs:
+    - cache_path: Path of the JSON file holding tuning results; if None,
+      $CS231N_CONV_AUTOTUNE_CACHE is used if set. If neither is set (or
+      cache_path is an empty string) results are kept in memory only.
+    - num_repeats: Number of timed forward / backward passes per backend; the
+      fastest of them is used.
+    - backends: Names of the entries of conv_backends to choose from.
+    """
+    if cache_path is None:
+      cache_path = os.environ.get('CS231N_CONV_AUTOTUNE_CACHE', '')
+    self.cache_path = cache_path
+    self.num_repeats = num_repeats
+    self.backends = backends
+    self.results = None
+    self._lock = threading.Lock()
+
+  def _signature(self, x, w, conv_param):
+    N, C, H, W = x.shape
+    F, _, HH, WW = w.shape
+    # Batch sizes in the same power-of-two bucket share their result
+    N_bucket = 1 << int(N - 1).bit_length()
+    return '%d,%d,%d,%d,%d,%d,%d,%d,%d,%s' % (N_bucket, C, H, W, F, HH, WW,
+        conv_param['stride'], conv_param['pad'], np.dtype(w.dtype).name)
+
+  def _load(self):
+    self.results = {}
+    if self.cache_path and os.path.exists(self.cache_path):
+      try:
+        with open(self.cache_path) as f:
+          self.results = json.load(f)
+      except (IOError, ValueError):
+        pass
+
+  def _save(self):
+    if not self.cache_path:
+      return
+    # Write to a temporary file and rename it so that concurrent processes
+    # never see a partially written file
+    try:
+      cache_dir = os.path.dirname(self.cache_path)
+      if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+      tmp_path = '%s.%d.tmp' % (self.cache_path, os.getpid())
+      with open(tmp_path, 'w') as f:
+        json.dump(self.results, f, indent=1, sort_keys=True)
+      os.rename(tmp_path, self.cache_path)
+    except (IOError, OSError):
+      pass
+
+  def _time(self, backend, x, w, b, conv_param):
+    """
+    Return the best time of a forward and backward pass with backend, or None
+    if the backend does not support this layer.
+    """
+    forward, backward = conv_backends[backend]
+    best = None
+    try:
+      # The first pass is not timed; it warms up caches and buffer pools
+      for i in xrange(self.num_repeats + 1):
+        start = time.time()
+        out, cache = forward(x, w, b, conv_param)
+        backward(np.ones_like(out), cache)
+        elapsed = time.time() - start
+        if i > 0 and (best is None or elapsed < best):
+          best = elapsed
+    except (AssertionError, NameError):
+      # Unsupported shape, or the Cython extension is not built
+      return None
+    return best
+
+  def select(self, x, w, b, conv_param):
+    """
+    Return the name of the fastest backend for this layer, benchmarking the
+    candidates if this signature has not been seen before.
+    """
+    with self._lock:
+      return self._select(x, w, b, conv_param)
+
+  def _select(self, x, w, b, conv_param):
+    if self.results is None:
+      self._load()
+    key = self._signature(x, w, conv_param)
+    if key in self.results:
+      return self.results[key]['backend']
+
+    timings = {}
+    for backend in self.backends:
+      elapsed = self._time(backend, x, w, b, conv_param)
+      if elapsed is not None:
+        timings[backend] = elapsed
+    if not timings:
+      raise ValueError('No conv backend supports the layer %s' % key)
+
+    # Another process may have tuned other layers in the meantime
+    winner = min(timings, key=timings.get)
+    if self.cache_path:
+      self._load()
+    self.results[key] = {'backend': winner, 'timings': timings}
+    self._save()
+    return winner
+
+  def clear(self):
+    """
+    Forget all tuning results, both in memory and on disk.
+    """
+    with self._lock:
+      self.results = {}
+      if self.cache_path and os.path.exists(self.cache_path):
+        os.remove(self.cache_path)
+
+
+conv_autotuner = ConvAutotuner()
+
+
+def conv_forward_fast(x, w, b, conv_param):
+  """
+  A fast implementation of the forward pass for a convolutional layer.
+
+  The algorithm can be chosen per layer through conv_param['backend'], which
+  names an entry of conv_backends: 'workspace' (the default), 'strides',
+  'im2col', 'winograd' (3x3 filters with stride 1 only) or 'fft'. It can
+  also be 'auto', to use whichever backend conv_autotuner found fastest for
+  this layer shape.
+
+  If conv_param['checkpoint'] is True, the backend's cache (for most
+  backends dominated by the column matrix, C * HH * WW times larger than the
+  output) is dropped as soon as the forward pass is done and only the inputs
+  are kept; conv_backward_fast then runs the forward pass again to rebuild
+  it. This trades one extra forward pass for the memory of the cache.
+  """
+  backend = conv_param.get('backend', 'workspace')
+  if backend == 'auto':
+    backend = conv_autotuner.select(x, w, b, conv_param)
+  if backend not in conv_backends:
+    raise ValueError('Unrecognized conv backend "%s"' % backend)
+  out, real_cache = conv_backends[backend][0](x, w, b, conv_param)
+  if conv_param.get('checkpoint', False):
+    return out, ('checkpoint', (backend, x, w, b, conv_param))
+  return out, (backend, real_cache)
+
+
+def conv_backward_fast(dout, cache, need_dx=True, need_dw=True):
+  """
+  A fast implementation of the backward pass for a convolutional layer,
+  using the backend that computed the forward pass.
+
+  If need_dx is False, dx is not computed and returned as None, which for
+  most backends skips the col2im step; likewise need_dw=False skips dw and
+  db. All backends in conv_backends accept these flags.
+  """
+  backend, real_cache = cache
+  if backend == 'checkpoint':
+    backend, x, w, b, conv_param = real_cache
+    _, real_cache = conv_backends[backend][0](x, w, b, conv_param)
+  return conv_backends[backend][1](dout, real_cache, need_dx=need_dx,
+                                   need_dw=need_dw)
+
+
+def conv_forward_inference(x, w, b, conv_param):
+  """
+  Forward pass of a convolutional layer when no backward pass will follow,
+  returning only the output. With the workspace backend the column matrix
+  goes straight back to conv_workspace, so that repeated calls (such as over
+  the chunks of a large input) reuse one buffer instead of allocating a new
+  one every time.
+  """
+  out, (backend, cache) = conv_forward_fast(x, w, b,
+                                            dict(conv_param, checkpoint=False))
+  if backend == 'workspace':
+    conv_workspace.release(cache[3][0])
+  return out
 
 
 def max_pool_forward_fast(x, pool_param):
   """
   A fast implementation of the forward pass for a max pooling layer.
 
-  This chooses between the reshape method and the im2col method. If the pooling
-  regions are square and tile the input image, then we can use the reshape
-  method which is very fast. Otherwise we fall back on the im2col method, which
-  is not much faster than the naive method.
+  This chooses between the reshape method and the strided method. If the
+  pooling regions are square and tile the input image, then we can use the
+  reshape method which is very fast. Otherwise we fall back on the strided
+  method, which handles overlapping windows, padding and sizes that do not
+  tile the input.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -144,12 +697,12 @@ def max_pool_forward_fast(x, pool_param):
 
   same_size = pool_height == pool_width == stride
   tiles = H % pool_height == 0 and W % pool_width == 0
-  if same_size and tiles:
+  if same_size and tiles and pool_param.get('pad', 0) == 0:
     out, reshape_cache = max_pool_forward_reshape(x, pool_param)
     cache = ('reshape', reshape_cache)
   else:
-    out, im2col_cache = max_pool_forward_im2col(x, pool_param)
-    cache = ('im2col', im2col_cache)
+    out, strided_cache = max_pool_forward_strided(x, pool_param)
+    cache = ('strided', strided_cache)
   return out, cache
 
 
@@ -157,24 +710,50 @@ def max_pool_backward_fast(dout, cache):
   """
   A fast implementation of the backward pass for a max pooling layer.
 
-  This switches between the reshape method an the im2col method depending on
+  This switches between the reshape, strided and im2col methods depending on
   which method was used to generate the cache.
   """
   method, real_cache = cache
   if method == 'reshape':
     return max_pool_backward_reshape(dout, real_cache)
+  elif method == 'strided':
+    return max_pool_backward_strided(dout, real_cache)
   elif method == 'im2col':
     return max_pool_backward_im2col(dout, real_cache)
   else:
     raise ValueError('Unrecognized method "%s"' % method)
 
 
+def max_pool_forward_inference(x, pool_param):
+  """
+  Forward pass of a max pooling layer when no backward pass will follow,
+  returning only the output. For square regions that tile the input this is
+  a single reshape and max, without looking for the argmax.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+
+  same_size = pool_height == pool_width == stride
+  tiles = H % pool_height == 0 and W % pool_width == 0
+  if same_size and tiles and pool_param.get('pad', 0) == 0:
+    x_reshaped = x.reshape(N, C, H / pool_height, pool_height,
+                           W / pool_width, pool_width)
+    return x_reshaped.max(axis=3).max(axis=4)
+  out, _ = max_pool_forward_strided(x, pool_param)
+  return out
+
+
 def max_pool_forward_reshape(x, pool_param):
   """
   A fast implementation of the forward pass for the max pooling layer that uses
   some clever reshaping.
 
   This can only be used for square pooling regions that tile the input.
+
+  Rather than keeping x around for the backward pass, the cache records the
+  position of the argmax within each pooling region as a small integer array
+  of the size of the output.
   """
   N, C, H, W = x.shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
@@ -186,39 +765,153 @@ def max_pool_forward_reshape(x, pool_param):
                          W / pool_width, pool_width)
   out = x_reshaped.max(axis=3).max(axis=4)
 
-  cache = (x, x_reshaped, out)
+  # Find the first element of each region equal to its max, as np.argmax would
+  argmax = np.zeros(out.shape, dtype=_pool_index_dtype(pool_height * pool_width))
+  found = np.zeros(out.shape, dtype=np.bool_)
+  for i in reversed(xrange(pool_height)):
+    for j in reversed(xrange(pool_width)):
+      np.equal(x_reshaped[:, :, :, i, :, j], out, out=found)
+      np.copyto(argmax, i * pool_width + j, where=found)
+
+  cache = (x.shape, pool_param, argmax)
   return out, cache
 
 
 def max_pool_backward_reshape(dout, cache):
   """
-  A fast implementation of the backward pass for the max pooling layer that
-  uses some clever broadcasting and reshaping.
+  A fast implementation of the backward pass for the max pooling layer.
 
   This can only be used if the forward pass was computed using
   max_pool_forward_reshape.
 
-  NOTE: If there are multiple argmaxes, this method will assign gradient to
-  ALL argmax elements of the input rather than picking one. In this case the
-  gradient will actually be incorrect. However this is unlikely to occur in
-  practice, so it shouldn't matter much. One possible solution is to split the
-  upstream gradient equally among all argmax elements; this should result in a
-  valid subgradient. You can make this happen by uncommenting the line below;
-  however this results in a significant performance penalty (about 40% slower)
-  and is unlikely to matter in practice so we don't do it.
-  """
-  x, x_reshaped, out = cache
-
-  dx_reshaped = np.zeros_like(x_reshaped)
-  out_newaxis = out[:, :, :, np.newaxis, :, np.newaxis]
-  mask = (x_reshaped == out_newaxis)
-  dout_newaxis = dout[:, :, :, np.newaxis, :, np.newaxis]
-  dout_broadcast, _ = np.broadcast_arrays(dout_newaxis, dx_reshaped)
-  dx_reshaped[mask] = dout_broadcast[mask]
-  dx_reshaped /= np.sum(mask, axis=(3, 5), keepdims=True)
-  dx = dx_reshaped.reshape(x.shape)
+  Pooling regions do not overlap, so every input receives the gradient of at
+  most one output and the whole backward pass is a single indexed assignment
+  into a zeroed dx. If a region has several maximal elements, the gradient
+  goes to the first of them (in row-major order), which is a valid
+  subgradient.
+  """
+  x_shape, pool_param, argmax = cache
+  N, C, H, W = x_shape
+
+  flat = _pool_argmax_positions(x_shape, pool_param, argmax)
+  dx = np.zeros(N * C * H * W, dtype=dout.dtype)
+  dx[flat.ravel()] = dout.ravel()
+  return dx.reshape(x_shape)
 
-  return dx
+
+def _pool_index_dtype(pool_size):
+  """
+  Smallest unsigned integer type that can index a pooling window.
+  """
+  for dtype in (np.uint8, np.uint16, np.uint32):
+    if pool_size <= np.iinfo(dtype).max + 1:
+      return dtype
+  return np.uint64
+
+
+def _pool_argmax_positions(x_shape, pool_param, argmax):
+  """
+  Convert argmax positions within pooling regions into flat indices into the
+  (padded) input.
+
+  Inputs:
+  - x_shape: Shape (N, C, H, W) of the unpadded input.
+  - pool_param: Pooling parameters as passed to the forward pass.
+  - argmax: Array of shape (N, C, out_height, out_width); each element is
+    the row-major position of the max within its pooling region.
+
+  Returns:
+  - flat: Array of the same shape as argmax, giving the index of each max in
+    the flattened input of shape (N, C, H + 2 * pad, W + 2 * pad).
+  """
+  N, C, H, W = x_shape
+  pool_width = pool_param['pool_width']
+  stride = pool_param['stride']
+  pad = pool_param.get('pad', 0)
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  _, _, out_height, out_width = argmax.shape
+
+  rows = np.arange(out_height).reshape(-1, 1) * stride
+  cols = np.arange(out_width) * stride
+  planes = np.arange(N * C).reshape(N, C, 1, 1) * Hp
+  argmax = argmax.astype(np.intp)
+  return (planes + rows + argmax / pool_width) * Wp + cols + argmax % pool_width
+
+
+def max_pool_forward_strided(x, pool_param):
+  """
+  A fast implementation of the forward pass for max pooling with arbitrary
+  pooling regions.
+
+  Rather than materializing every window, this loops over the
+  pool_height * pool_width offsets within a window; the elements at one
+  offset in all windows form a single strided view of the input, so each
+  step is one vectorized maximum over an output-sized array. Windows may
+  overlap (e.g. 3x3 with stride 2), the input may be padded through
+  pool_param['pad'] (padding never wins the max), and sizes that do not
+  divide evenly drop the leftover rows and columns as the naive version does.
+
+  The cache holds only the input shape and, for each output, the position of
+  its argmax within its window, using the smallest integer type that fits.
+  """
+  N, C, H, W = x.shape
+  pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
+  stride = pool_param['stride']
+  pad = pool_param.get('pad', 0)
+
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+  out_height = (Hp - pool_height) / stride + 1
+  out_width = (Wp - pool_width) / stride + 1
+  assert out_height > 0 and out_width > 0, 'Invalid pool params'
+  # Otherwise some windows would hold nothing but padding
+  assert 2 * pad <= min(pool_height, pool_width), 'Invalid pad'
+
+  x_padded = x
+  if pad > 0:
+    if np.issubdtype(x.dtype, np.floating):
+      fill = -np.inf
+    else:
+      fill = np.iinfo(x.dtype).min
+    x_padded = np.empty((N, C, Hp, Wp), dtype=x.dtype)
+    x_padded.fill(fill)
+    x_padded[:, :, pad:pad + H, pad:pad + W] = x
+
+  h_end = stride * (out_height - 1) + 1
+  w_end = stride * (out_width - 1) + 1
+  out = x_padded[:, :, 0:h_end:stride, 0:w_end:stride].copy()
+  argmax = np.zeros(out.shape, dtype=_pool_index_dtype(pool_height * pool_width))
+  for i in xrange(pool_height):
+    for j in xrange(pool_width):
+      if i == 0 and j == 0:
+        continue
+      window = x_padded[:, :, i:i + h_end:stride, j:j + w_end:stride]
+      # Strict comparison keeps the first argmax, as np.argmax does
+      better = window > out
+      np.copyto(argmax, i * pool_width + j, where=better)
+      np.maximum(out, window, out=out)
+
+  cache = (x.shape, pool_param, argmax)
+  return out, cache
+
+
+def max_pool_backward_strided(dout, cache):
+  """
+  A fast implementation of the backward pass for max_pool_forward_strided.
+
+  Each upstream gradient is routed to the input element that won its window.
+  Overlapping windows may route several gradients to the same element, so
+  they are accumulated with a single np.bincount over flat input positions.
+  """
+  x_shape, pool_param, argmax = cache
+  N, C, H, W = x_shape
+  pad = pool_param.get('pad', 0)
+  Hp, Wp = H + 2 * pad, W + 2 * pad
+
+  flat = _pool_argmax_positions(x_shape, pool_param, argmax)
+  dx = np.bincount(flat.ravel(), weights=dout.ravel(),
+                   minlength=N * C * Hp * Wp)
+  dx = dx.astype(dout.dtype, copy=False).reshape(N, C, Hp, Wp)
+  return dx[:, :, pad:pad + H, pad:pad + W]
 
 
 def max_pool_forward_im2col(x, pool_param):
@@ -239,12 +932,15 @@ def max_pool_forward_im2col(x, pool_param):
   out_width = (W - pool_width) / stride + 1
 
   x_split = x.reshape(N * C, 1, H, W)
-  x_cols = im2col(x_split, pool_height, pool_width, padding=0, stride=stride)
+  x_cols = im2col_indices(x_split, pool_height, pool_width, padding=0,
+                          stride=stride)
   x_cols_argmax = np.argmax(x_cols, axis=0)
   x_cols_max = x_cols[x_cols_argmax, np.arange(x_cols.shape[1])]
   out = x_cols_max.reshape(out_height, out_width, N, C).transpose(2, 3, 0, 1)
 
-  cache = (x, x_cols, x_cols_argmax, pool_param)
+  x_cols_argmax = x_cols_argmax.astype(
+      _pool_index_dtype(pool_height * pool_width))
+  cache = (x.shape, x_cols_argmax, pool_param)
   return out, cache
 
 
@@ -255,16 +951,17 @@ def max_pool_backward_im2col(dout, cache):
   This isn't much faster than the naive version, so it should be avoided if
   possible.
   """
-  x, x_cols, x_cols_argmax, pool_param = cache
-  N, C, H, W = x.shape
+  x_shape, x_cols_argmax, pool_param = cache
+  N, C, H, W = x_shape
   pool_height, pool_width = pool_param['pool_height'], pool_param['pool_width']
   stride = pool_param['stride']
 
   dout_reshaped = dout.transpose(2, 3, 0, 1).flatten()
-  dx_cols = np.zeros_like(x_cols)
+  dx_cols = np.zeros((pool_height * pool_width, dout_reshaped.shape[0]),
+                     dtype=dout.dtype)
   dx_cols[x_cols_argmax, np.arange(dx_cols.shape[1])] = dout_reshaped
   dx = col2im_indices(dx_cols, (N * C, 1, H, W), pool_height, pool_width,
               padding=0, stride=stride)
-  dx = dx.reshape(x.shape)
+  dx = dx.reshape(x_shape)
 
   return dx
@@ -1,6 +1,9 @@
+import multiprocessing
+
 import numpy as np
 cimport numpy as np
 cimport cython
+from cython.parallel cimport prange
 
 # DTYPE = np.float64
 # ctypedef np.float64_t DTYPE_t
@@ -9,113 +12,161 @@ ctypedef fused DTYPE_t:
     np.float32_t
     np.float64_t
 
+# The kernels below run their outer loop in parallel with OpenMP when the
+# extension was built with it (see setup.py); otherwise prange runs serially.
+cdef int _num_threads = multiprocessing.cpu_count()
+
+
+def set_num_threads(int num_threads):
+    """
+    Set the number of threads used by the im2col / col2im kernels. Values
+    smaller than 1 select one thread per CPU.
+    """
+    global _num_threads
+    if num_threads < 1:
+        num_threads = multiprocessing.cpu_count()
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    return _num_threads
+
+
 def im2col_cython(np.ndarray[DTYPE_t, ndim=4] x, int field_height,
                   int field_width, int padding, int stride):
     cdef int N = x.shape[0]
     cdef int C = x.shape[1]
     cdef int H = x.shape[2]
     cdef int W = x.shape[3]
-    
+
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
 
-    cdef int p = padding
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.pad(x,
-            ((0, 0), (0, 0), (p, p), (p, p)), mode='constant')
-
-    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.zeros(
+    # Padding is handled inside the kernel, so no padded copy of x is made
+    cdef DTYPE_t[:, :, :, ::1] x_c = np.ascontiguousarray(x)
+    cdef np.ndarray[DTYPE_t, ndim=2] cols = np.empty(
             (C * field_height * field_width, N * HH * WW),
             dtype=x.dtype)
+    cdef DTYPE_t[:, ::1] cols_view = cols
 
-    # Moving the inner loop to a C function with no bounds checking works, but does
-    # not seem to help performance in any measurable way.
-
-    im2col_cython_inner(cols, x_padded, N, C, H, W, HH, WW,
+    im2col_cython_inner(cols_view, x_c, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
     return cols
 
 
 @cython.boundscheck(False)
-cdef int im2col_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+cdef int im2col_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+                             int field_height, int field_width, int padding,
+                             int stride) except? -1:
+    cdef int c, ii, jj, row, yy, xx, i, col, h, w
+    cdef int num_rows = C * field_height * field_width
+
+    # Each thread fills whole rows of cols; the innermost loop writes
+    # consecutive columns.
+    for row in prange(num_rows, nogil=True, schedule='static',
+                      num_threads=_num_threads):
+        c = row / (field_height * field_width)
+        ii = (row / field_width) % field_height
+        jj = row % field_width
         for yy in range(HH):
+            h = stride * yy + ii - padding
             for xx in range(WW):
-                for ii in range(field_height):
-                    for jj in range(field_width):
-                        row = c * field_width * field_height + ii * field_height + jj
-                        for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            cols[row, col] = x_padded[i, c, stride * yy + ii, stride * xx + jj]
-
+                w = stride * xx + jj - padding
+                col = yy * WW * N + xx * N
+                if h < 0 or h >= H or w < 0 or w >= W:
+                    for i in range(N):
+                        cols[row, col + i] = 0
+                else:
+                    for i in range(N):
+                        cols[row, col + i] = x[i, c, h, w]
+    return 0
 
 
 def col2im_cython(np.ndarray[DTYPE_t, ndim=2] cols, int N, int C, int H, int W,
                   int field_height, int field_width, int padding, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int HH = (H + 2 * padding - field_height) / stride + 1
     cdef int WW = (W + 2 * padding - field_width) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * padding, W + 2 * padding),
-                                        dtype=cols.dtype)
+    cdef np.ndarray x = np.zeros((N, C, H, W), dtype=cols.dtype)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    cdef DTYPE_t[:, ::1] cols_view = np.ascontiguousarray(cols)
 
     # Moving the inner loop to a C-function with no bounds checking improves
     # performance quite a bit for col2im.
-    col2im_cython_inner(cols, x_padded, N, C, H, W, HH, WW, 
+    col2im_cython_inner(cols_view, x_view, N, C, H, W, HH, WW,
                         field_height, field_width, padding, stride)
-    if padding > 0:
-        return x_padded[:, :, padding:-padding, padding:-padding]
-    return x_padded
+    return x
 
 
 @cython.boundscheck(False)
-cdef int col2im_cython_inner(np.ndarray[DTYPE_t, ndim=2] cols,
-                             np.ndarray[DTYPE_t, ndim=4] x_padded,
+@cython.wraparound(False)
+cdef int col2im_cython_inner(DTYPE_t[:, ::1] cols,
+                             DTYPE_t[:, :, :, ::1] x,
                              int N, int C, int H, int W, int HH, int WW,
-                             int field_height, int field_width, int padding, int stride) except? -1:
-    cdef int c, ii, jj, row, yy, xx, i, col
-
-    for c in range(C):
+                             int field_height, int field_width, int padding,
+                             int stride) except? -1:
+    cdef int c, ii, jj, row, yy, xx, i, col, h, w
+
+    # Different channels never write to the same element of x, so channels
+    # can be accumulated in parallel without any locking.
+    for c in prange(C, nogil=True, schedule='static',
+                    num_threads=_num_threads):
         for ii in range(field_height):
             for jj in range(field_width):
-                row = c * field_width * field_height + ii * field_height + jj
+                row = c * field_width * field_height + ii * field_width + jj
                 for yy in range(HH):
+                    h = stride * yy + ii - padding
+                    if h < 0 or h >= H:
+                        continue
                     for xx in range(WW):
+                        w = stride * xx + jj - padding
+                        if w < 0 or w >= W:
+                            continue
+                        col = yy * WW * N + xx * N
                         for i in range(N):
-                            col = yy * WW * N + xx * N + i
-                            x_padded[i, c, stride * yy + ii, stride * xx + jj] += cols[row, col]
+                            x[i, c, h, w] += cols[row, col + i]
+    return 0
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-cdef col2im_6d_cython_inner(np.ndarray[DTYPE_t, ndim=6] cols,
-                            np.ndarray[DTYPE_t, ndim=4] x_padded,
-                            int N, int C, int H, int W, int HH, int WW,
-                            int out_h, int out_w, int pad, int stride):
-
-    cdef int c, hh, ww, n, h, w
-    for n in range(N):
-        for c in range(C):
-            for hh in range(HH):
-                for ww in range(WW):
-                    for h in range(out_h):
-                        for w in range(out_w):
-                            x_padded[n, c, stride * h + hh, stride * w + ww] += cols[c, hh, ww, n, h, w]
-    
+cdef int col2im_6d_cython_inner(DTYPE_t[:, :, :, :, :, :] cols,
+                                DTYPE_t[:, :, :, ::1] x,
+                                int N, int C, int H, int W, int HH, int WW,
+                                int out_h, int out_w, int pad,
+                                int stride) except? -1:
+    cdef int nc, c, hh, ww, n, h, w, xh, xw
+
+    # Each (n, c) plane of x is owned by a single thread; the innermost loop
+    # reads consecutive elements of cols.
+    for nc in prange(N * C, nogil=True, schedule='static',
+                     num_threads=_num_threads):
+        n = nc / C
+        c = nc % C
+        for hh in range(HH):
+            for ww in range(WW):
+                for h in range(out_h):
+                    xh = stride * h + hh - pad
+                    if xh < 0 or xh >= H:
+                        continue
+                    for w in range(out_w):
+                        xw = stride * w + ww - pad
+                        if xw < 0 or xw >= W:
+                            continue
+                        x[n, c, xh, xw] += cols[c, hh, ww, n, h, w]
+    return 0
+
 
 def col2im_6d_cython(np.ndarray[DTYPE_t, ndim=6] cols, int N, int C, int H, int W,
         int HH, int WW, int pad, int stride):
-    cdef np.ndarray x = np.empty((N, C, H, W), dtype=cols.dtype)
     cdef int out_h = (H + 2 * pad - HH) / stride + 1
     cdef int out_w = (W + 2 * pad - WW) / stride + 1
-    cdef np.ndarray[DTYPE_t, ndim=4] x_padded = np.zeros((N, C, H + 2 * pad, W + 2 * pad),
-                                                  dtype=cols.dtype)
-
-    col2im_6d_cython_inner(cols, x_padded, N, C, H, W, HH, WW, out_h, out_w, pad, stride)
+    cdef np.ndarray x = np.zeros((N, C, H, W), dtype=cols.dtype)
+    cdef DTYPE_t[:, :, :, ::1] x_view = x
+    cdef DTYPE_t[:, :, :, :, :, :] cols_view = cols
 
-    if pad > 0:
-        return x_padded[:, :, pad:-pad, pad:-pad]
-    return x_padded 
+    col2im_6d_cython_inner(cols_view, x_view, N, C, H, W, HH, WW, out_h, out_w,
+                           pad, stride)
+    return x
@@ -0,0 +1,305 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from cs231n.layer_utils import *
+from cs231n.layer_utils import _batchnorm_inference_scale_shift
+from cs231n.classifiers.fc_net import TwoLayerNet, FullyConnectedNet
+from cs231n.classifiers.cnn import ThreeLayerConvNet
+
+"""
+This file implements an offline optimization pass that turns a trained model
+into a smaller model for test time only. At test time batch normalization is
+a fixed per-feature scale and shift, so it can be folded into the weights and
+biases of the affine or convolutional layer before it, and dropout does
+nothing, so it can be dropped. What is left is a plain sequence of layers,
+each a single pass over memory:
+
+- 'affine': out = x.dot(W) + b, followed by a ReLU if layer['relu'] is set.
+- 'conv_relu_pool': convolution with layer['conv_param'], ReLU and max
+  pooling with layer['pool_param'].
+
+Layer i (counting from 1) uses the parameters params['W%d' % i] and
+params['b%d' % i]; the layer specifications themselves hold only numbers and
+strings.
+
+inference_model = fold_batchnorm(model)
+y_pred = inference_model.predict(X_test)
+
+An inference model can be exported to a single file and loaded back by other
+processes. The file holds:
+
+- The 8 bytes of EXPORT_MAGIC.
+- The length of the header, as a little-endian unsigned 32 bit integer.
+- The header: JSON holding the format version, the layer specifications, and
+  for every parameter its shape and the offset of its data in the file.
+- The parameters as raw little-endian float32 arrays in C order, each
+  starting at a multiple of EXPORT_ALIGNMENT bytes.
+
+load_model memory-maps the file instead of reading it, so loading takes
+about the same time for any model size, and every process serving the same
+file shares one copy of the weights in the page cache.
+
+export_model(model, '/path/to/model.bin')
+inference_model = load_model('/path/to/model.bin')
+"""
+
+EXPORT_MAGIC = 'CS231NIM'
+EXPORT_VERSION = 1
+EXPORT_ALIGNMENT = 64
+
+
+class InferenceModel(object):
+  """
+  A model that only computes scores, made of the layers described at the top
+  of this file. It has the same scores, predict and loss(X) interface as the
+  models it is built from, so the Solver can evaluate it with check_accuracy.
+  """
+
+  def __init__(self, layers, params, dtype=np.float32):
+    """
+    Inputs:
+    - layers: List of layer specifications.
+    - params: Dictionary mapping parameter names to arrays.
+    - dtype: A numpy datatype object; all computations will be performed
+      using this datatype.
+    """
+    for layer in layers:
+      if layer['type'] not in ('affine', 'conv_relu_pool'):
+        raise ValueError('Invalid layer type "%s"' % layer['type'])
+    self.layers = layers
+    self.dtype = dtype
+    self.params = {k: v.astype(dtype, copy=False) for k, v in params.iteritems()}
+
+
+  def _score_chunks(self, X, batch_size):
+    """
+    Run the layers over chunks of batch_size examples, yielding
+    (start, scores) for each chunk. Consecutive affine layers alternate
+    between a pair of buffers allocated once, and the scores array is reused
+    too, so it is only valid until the next chunk.
+    """
+    N = X.shape[0]
+    L = len(self.layers)
+    chunk = max(1, min(batch_size, N))
+    widths = [self.params['W%d' % i].shape[-1] for i in xrange(1, L + 1)
+              if self.layers[i - 1]['type'] == 'affine']
+    buffers = [np.empty(chunk * max(widths), dtype=self.dtype)
+               for i in xrange(2)]
+
+    for start in xrange(0, N, chunk):
+      n = min(chunk, N - start)
+      h = X[start:start + n].astype(self.dtype, copy=False)
+      for i, layer in enumerate(self.layers, 1):
+        w, b = self.params['W%d' % i], self.params['b%d' % i]
+        if layer['type'] == 'conv_relu_pool':
+          h = conv_bn_relu_pool_inference(h, w, b, layer['conv_param'],
+                                          layer['pool_param'])
+          h = h.astype(self.dtype, copy=False)
+        else:
+          D = w.shape[1]
+          h = affine_bn_relu_inference(h, w, b, relu=layer['relu'],
+                                       out=buffers[i % 2][:n * D].reshape(n, D))
+      yield start, h
+
+
+  def scores(self, X, batch_size=1000):
+    """
+    Compute classification scores for X.
+
+    Inputs:
+    - X: Array of input data
+    - batch_size: Number of examples processed at a time.
+
+    Returns:
+    - scores: Array of shape (N, C) of classification scores.
+    """
+    scores = None
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      if scores is None:
+        scores = np.empty((X.shape[0], chunk_scores.shape[1]),
+                          dtype=chunk_scores.dtype)
+      scores[start:start + chunk_scores.shape[0]] = chunk_scores
+    return scores
+
+
+  def predict(self, X, batch_size=1000):
+    """
+    Predict class labels for X, one chunk of scores at a time.
+
+    Returns:
+    - y_pred: Array of shape (N,) of predicted labels.
+    """
+    y_pred = np.empty(X.shape[0], dtype=np.intp)
+    for start, chunk_scores in self._score_chunks(X, batch_size):
+      y_pred[start:start + chunk_scores.shape[0]] = np.argmax(chunk_scores,
+                                                              axis=1)
+    return y_pred
+
+
+  def loss(self, X, y=None):
+    """
+    Compute classification scores for X. An inference model cannot be
+    trained, so y must be None.
+    """
+    if y is not None:
+      raise ValueError('InferenceModel does not compute losses')
+    return self.scores(X)
+
+
+def _fold(w, b, gamma, beta, bn_param):
+  """
+  Fold a batch normalization layer in test mode into the weights w and biases
+  b of the affine or convolutional layer before it, whose output features are
+  along the last axis of w (affine) or the first (convolution). The folding
+  is done in float64.
+  """
+  w = w.astype(np.float64)
+  b = b.astype(np.float64)
+  if bn_param is None:
+    return w, b
+  scale, shift = _batchnorm_inference_scale_shift(
+      gamma.astype(np.float64), beta.astype(np.float64), bn_param, b)
+  if w.ndim == 2:
+    return w * scale, shift
+  return w * scale.reshape(-1, 1, 1, 1), shift
+
+
+def fold_batchnorm(model, dtype=None):
+  """
+  Build an InferenceModel computing the same scores as model does at test
+  time, with batch normalization folded into the preceding layers and
+  dropout removed.
+
+  Inputs:
+  - model: A TwoLayerNet, FullyConnectedNet or ThreeLayerConvNet.
+  - dtype: Datatype of the inference model; defaults to that of the model.
+
+  Returns:
+  - inference_model: An InferenceModel.
+  """
+  params = model.params
+  bn_params = getattr(model, 'bn_params', [])
+  use_batchnorm = getattr(model, 'use_batchnorm', False)
+  layers, folded = [], {}
+
+  def add(layer, w, b, bn_index=None):
+    i = len(layers) + 1
+    bn = None
+    if use_batchnorm and bn_index is not None:
+      bn = (params['gamma%d' % i], params['beta%d' % i], bn_params[bn_index])
+    folded['W%d' % i], folded['b%d' % i] = _fold(w, b, *(bn or (None,) * 3))
+    layers.append(layer)
+
+  if isinstance(model, TwoLayerNet):
+    add({'type': 'affine', 'relu': True}, params['W1'], params['b1'])
+    add({'type': 'affine', 'relu': False}, params['W2'], params['b2'])
+  elif isinstance(model, FullyConnectedNet):
+    L = model.num_layers
+    for i in xrange(1, L + 1):
+      add({'type': 'affine', 'relu': i < L}, params['W%d' % i],
+          params['b%d' % i], i - 1 if i < L else None)
+  elif isinstance(model, ThreeLayerConvNet):
+    conv_param, pool_param = model._layer_params()
+    add({'type': 'conv_relu_pool', 'conv_param': conv_param,
+         'pool_param': pool_param}, params['W1'], params['b1'], 0)
+    add({'type': 'affine', 'relu': True}, params['W2'], params['b2'], 1)
+    add({'type': 'affine', 'relu': False}, params['W3'], params['b3'])
+  else:
+    raise ValueError('Unsupported model "%s"' % type(model).__name__)
+
+  if dtype is None:
+    dtype = getattr(model, 'dtype', np.result_type(*params.values()))
+  return InferenceModel(layers, folded, dtype=dtype)
+
+
+def _align(offset):
+  return -(-offset // EXPORT_ALIGNMENT) * EXPORT_ALIGNMENT
+
+
+def export_model(model, filename):
+  """
+  Export a model to filename in the format described at the top of this file.
+  The file is written to a temporary name and then renamed, so processes
+  loading filename never see a partial file.
+
+  Inputs:
+  - model: An InferenceModel, or any model accepted by fold_batchnorm.
+  - filename: Path of the file to write.
+
+  Returns:
+  - nbytes: Size of the file.
+  """
+  if not isinstance(model, InferenceModel):
+    model = fold_batchnorm(model)
+  names = sorted(model.params)
+  params = [np.ascontiguousarray(model.params[k], dtype='<f4') for k in names]
+
+  # Offsets are relative to the start of the data, right after the header
+  entries, offset = {}, 0
+  for k, a in zip(names, params):
+    entries[k] = {'shape': list(a.shape), 'offset': offset}
+    offset += _align(a.nbytes)
+  header = json.dumps({'version': EXPORT_VERSION, 'layers': model.layers,
+                       'params': entries})
+  data_start = _align(len(EXPORT_MAGIC) + 4 + len(header))
+
+  tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+  with open(tmp_filename, 'wb') as f:
+    f.write(EXPORT_MAGIC)
+    f.write(struct.pack('<I', len(header)))
+    f.write(header)
+    for k, a in zip(names, params):
+      f.write('\0' * (data_start + entries[k]['offset'] - f.tell()))
+      f.write(a.tobytes())
+    f.write('\0' * (data_start + offset - f.tell()))
+  os.rename(tmp_filename, filename)
+  return data_start + offset
+
+
+def is_exported_model(filename):
+  """
+  Check whether filename starts like a file written by export_model.
+  """
+  with open(filename, 'rb') as f:
+    return f.read(len(EXPORT_MAGIC)) == EXPORT_MAGIC
+
+
+def load_model(filename):
+  """
+  Load a model written by export_model. The parameters are read-only views
+  into a memory map of the file rather than copies.
+
+  Inputs:
+  - filename: Path of the exported model.
+
+  Returns:
+  - inference_model: An InferenceModel computing in float32.
+  """
+  with open(filename, 'rb') as f:
+    if f.read(len(EXPORT_MAGIC)) != EXPORT_MAGIC:
+      raise ValueError('Not an exported model "%s"' % filename)
+    header_len, = struct.unpack('<I', f.read(4))
+    header = _to_str(json.loads(f.read(header_len)))
+  if header.get('version') != EXPORT_VERSION:
+    raise ValueError('Unsupported model version "%s"' % header.get('version'))
+
+  data_start = _align(len(EXPORT_MAGIC) + 4 + header_len)
+  data = np.memmap(filename, dtype=np.uint8, mode='r', offset=data_start)
+  params = {}
+  for k, entry in header['params'].iteritems():
+    params[k] = np.ndarray(tuple(entry['shape']), dtype='<f4', buffer=data,
+                           offset=entry['offset'])
+  return InferenceModel(header['layers'], params, dtype=np.float32)
+
+
+def _to_str(obj):
+  if isinstance(obj, dict):
+    return {str(k): _to_str(v) for k, v in obj.iteritems()}
+  if isinstance(obj, list):
+    return [_to_str(v) for v in obj]
+  if isinstance(obj, unicode):
+    return str(obj)
+  return obj
@@ -0,0 +1,348 @@
+import numpy as np
+
+from cs231n.layers import *
+from cs231n.layer_utils import (affine_bn_relu_dropout_forward,
+                                affine_bn_relu_dropout_backward, cache_bytes)
+
+"""
+This file implements a small executor for networks that are a chain of layers,
+such as FullyConnectedNet. Rather than having the model call each layer and
+hold on to every cache until the end of the backward pass, the model describes
+its layers once and the executor runs them:
+
+graph = LayerGraph()
+graph.add('affine', ['W1', 'b1'])
+graph.add('relu')
+graph.add('dropout', layer_param=dropout_param)
+graph.add('affine', ['W2', 'b2'])
+
+scores = graph.forward(X, params)
+dX, grads = graph.backward(dscores)
+
+Knowing the whole chain lets the executor save memory in three ways:
+
+- Layers that only need to shrink or rescale their input (ReLU and dropout)
+  overwrite their input instead of allocating an output, whenever no earlier
+  layer still needs that input for its backward pass. The plan is made once,
+  when the graph is built; see LayerGraph.plan.
+- ReLU and dropout likewise overwrite the upstream gradient in the backward
+  pass, since nothing else reads it.
+- Each layer's cache is dropped as soon as its backward pass has run, so the
+  activations it holds can be freed while the remaining layers run.
+
+For mixed precision training the executor can also store the activations
+passed between layers (and kept in the caches) in a smaller floating point
+type such as float16, while each layer still computes in the type of its
+parameters; see the storage_dtype argument of LayerGraph.
+
+When created with track_memory=True, the executor also measures the number
+of bytes of activations that are alive at any one time (ignoring parameters
+and gradients) and records the peak in graph.peak_bytes, which makes it easy
+to compare configurations. Measuring walks every cache after every layer, so
+it is off by default.
+
+Each layer type is described by an entry in layer_ops; see LayerOp.
+"""
+
+
+class LayerOp(object):
+  """
+  Describes one kind of layer for the LayerGraph executor.
+
+  - forward(x, params, layer_param, inplace, out_dtype) returns (out, cache);
+    params is a list of parameter arrays and layer_param the layer's
+    parameter dictionary, if any. If inplace is True the layer may overwrite
+    x and return it. If out_dtype is not None, out must have that type; a
+    layer that keeps out in its cache should keep the converted array.
+  - backward(dout, cache, inplace, need_dx, need_dw) returns (dx, dparams)
+    with dparams a list of gradients in the same order as params. If inplace
+    is True the layer may overwrite dout and return it. If need_dx (or
+    need_dw) is False the layer may skip computing dx (or dparams) and
+    return None in its place.
+  - saves_input: Whether the cache holds a reference to x, so that x must not
+    be modified until this layer's backward pass has run.
+  - saves_output: Whether the cache holds a reference to out.
+  - can_run_inplace: Whether forward supports inplace=True.
+  - shrinks_support: For layers that run in place, whether the only change
+    they make to their input is to zero some entries and scale the rest by a
+    positive factor, and whether they pass no gradient to the entries they
+    zero. Such a layer may overwrite an output that an earlier layer keeps
+    only for its sign pattern, as ReLU does.
+  """
+
+  def __init__(self, forward, backward, saves_input=False, saves_output=False,
+               can_run_inplace=False, shrinks_support=False):
+    self.forward = forward
+    self.backward = backward
+    self.saves_input = saves_input
+    self.saves_output = saves_output
+    self.can_run_inplace = can_run_inplace
+    self.shrinks_support = shrinks_support
+
+
+def _cast(x, dtype):
+  if dtype is None:
+    return x
+  return x.astype(dtype, copy=False)
+
+
+def _affine_op_forward(x, params, layer_param, inplace, out_dtype):
+  w, b = params
+  out, cache = affine_forward(x, w, b)
+  return _cast(out, out_dtype), cache
+
+
+def _affine_op_backward(dout, cache, inplace, need_dx, need_dw):
+  dx, dw, db = affine_backward(dout, cache, need_dx=need_dx, need_dw=need_dw)
+  return dx, [dw, db]
+
+
+def _batchnorm_op_forward(x, params, layer_param, inplace, out_dtype):
+  gamma, beta = params
+  out, cache = batchnorm_forward(x, gamma, beta, layer_param)
+  return _cast(out, out_dtype), cache
+
+
+def _batchnorm_op_backward(dout, cache, inplace, need_dx, need_dw):
+  dx, dgamma, dbeta = batchnorm_backward(dout, cache)
+  return dx, [dgamma, dbeta]
+
+
+def _relu_op_forward(x, params, layer_param, inplace, out_dtype):
+  if inplace:
+    out = np.maximum(x, 0, out=x)
+  else:
+    out, _ = relu_forward(x)
+  out = _cast(out, out_dtype)
+  # out > 0 exactly where x > 0, so the output doubles as the backward mask
+  return out, out
+
+
+def _relu_op_backward(dout, out, inplace, need_dx, need_dw):
+  if inplace:
+    dout[out <= 0] = 0
+    return dout, []
+  return relu_backward(dout, out), []
+
+
+def _dropout_op_forward(x, params, layer_param, inplace, out_dtype):
+  if layer_param['mode'] != 'train' or not inplace:
+    out, cache = dropout_forward(x, layer_param)
+    return _cast(out, out_dtype), cache
+
+  # Draw the same random numbers as dropout_forward, but keep the mask as
+  # booleans and scale x in place
+  p = layer_param['p']
+  if 'seed' in layer_param:
+    np.random.seed(layer_param['seed'])
+  keep = np.random.rand(*x.shape) < 1 - p
+  x *= keep
+  x *= 1.0 / (1 - p)
+  return _cast(x, out_dtype), (layer_param, keep)
+
+
+def _dropout_op_backward(dout, cache, inplace, need_dx, need_dw):
+  dropout_param, mask = cache
+  # Only the in-place forward pass stores a boolean mask, which does not
+  # include the 1 / (1 - p) scale
+  if mask is None or mask.dtype != np.bool_:
+    return dropout_backward(dout, cache), []
+  if inplace:
+    dout *= mask
+  else:
+    dout = dout * mask
+  dout *= 1.0 / (1 - dropout_param['p'])
+  return dout, []
+
+
+def _fused_op_forward(x, params, layer_param, inplace, out_dtype):
+  w, b = params[:2]
+  gamma, beta = params[2:] if len(params) == 4 else (None, None)
+  return affine_bn_relu_dropout_forward(x, w, b, gamma, beta,
+                                        layer_param['bn_param'],
+                                        layer_param['dropout_param'],
+                                        out_dtype=out_dtype)
+
+
+def _fused_op_backward(dout, cache, inplace, need_dx, need_dw):
+  dx, dw, db, dgamma, dbeta = affine_bn_relu_dropout_backward(
+      dout, cache, need_dx=need_dx, need_dw=need_dw)
+  if dgamma is None:
+    return dx, [dw, db]
+  return dx, [dw, db, dgamma, dbeta]
+
+
+layer_ops = {
+  'affine': LayerOp(_affine_op_forward, _affine_op_backward, saves_input=True),
+  'batchnorm': LayerOp(_batchnorm_op_forward, _batchnorm_op_backward,
+                       saves_input=True),
+  'relu': LayerOp(_relu_op_forward, _relu_op_backward, saves_output=True,
+                  can_run_inplace=True),
+  'dropout': LayerOp(_dropout_op_forward, _dropout_op_backward,
+                     can_run_inplace=True, shrinks_support=True),
+  # A whole hidden layer; params are [W, b] or [W, b, gamma, beta], and
+  # layer_param is a dictionary with keys 'bn_param' and 'dropout_param',
+  # either of which may be None
+  'affine_bn_relu_dropout': LayerOp(_fused_op_forward, _fused_op_backward,
+                                    saves_input=True, saves_output=True),
+}
+
+
+class LayerGraph(object):
+  """
+  Runs a chain of layers forward and backward, planning which layers can
+  work in place and freeing caches as early as possible.
+  """
+
+  def __init__(self, inplace=True, free_caches=True, storage_dtype=None,
+               track_memory=False):
+    """
+    Inputs:
+    - inplace: Whether to let layers overwrite their inputs and upstream
+      gradients where the plan allows it.
+    - free_caches: Whether to drop each layer's cache right after its
+      backward pass instead of at the end of backward.
+    - storage_dtype: If not None, the output of every layer but the last is
+      stored in this type, for example np.float16 to halve the memory held
+      by the caches. Gradients keep the type of the parameters.
+    - track_memory: Whether to record the peak activation memory of every
+      forward / backward pass in self.peak_bytes.
+    """
+    self.inplace = inplace
+    self.free_caches = free_caches
+    self.storage_dtype = storage_dtype
+    self.track_memory = track_memory
+    self.layers = []
+    self.plan = []
+    self.caches = []
+    self.peak_bytes = 0
+
+  def add(self, op, param_names=(), layer_param=None):
+    """
+    Append a layer to the graph.
+
+    Inputs:
+    - op: Name of an entry of layer_ops.
+    - param_names: Names of the layer's parameters in the params dictionary
+      passed to forward, in the order the op expects them.
+    - layer_param: Parameter dictionary passed to the layer on every call,
+      such as a bn_param or dropout_param. It is shared, not copied, so the
+      caller may keep changing it (for example its mode).
+    """
+    if op not in layer_ops:
+      raise ValueError('Invalid layer op "%s"' % op)
+    self.layers.append((op, list(param_names), layer_param))
+    self.plan = self._make_plan()
+    return self
+
+  def _make_plan(self):
+    """
+    Decide for each layer whether it may overwrite its input.
+
+    A layer runs in place if it supports it and the layer that produced its
+    input does not keep that input for its backward pass, or keeps it only
+    as a sign pattern that this layer preserves. The first layer never runs
+    in place, since its input belongs to the caller. Because a saved tensor
+    is only ever used by its producer and its consumer in a chain, these two
+    checks are enough.
+    """
+    plan = []
+    for i, (op, _, _) in enumerate(self.layers):
+      layer_op = layer_ops[op]
+      ok = self.inplace and layer_op.can_run_inplace and i > 0
+      if ok:
+        prev = layer_ops[self.layers[i - 1][0]]
+        if prev.saves_output and not layer_op.shrinks_support:
+          ok = False
+        if layer_op.saves_input:
+          ok = False
+      plan.append(ok)
+    return plan
+
+  def _record(self, objs, skip):
+    if self.track_memory:
+      self.peak_bytes = max(self.peak_bytes, cache_bytes(objs, skip))
+
+  def forward(self, x, params):
+    """
+    Run the forward pass.
+
+    Inputs:
+    - x: Input to the first layer.
+    - params: Dictionary mapping parameter names to arrays.
+
+    Returns:
+    - out: Output of the last layer.
+    """
+    self._skip = [id(v) for v in params.itervalues()]
+    self._skip.append(id(x.base if x.base is not None else x))
+    self.caches = []
+    self.peak_bytes = 0
+    out = x
+    last = len(self.layers) - 1
+    for i, ((op, names, layer_param), inplace) in enumerate(
+        zip(self.layers, self.plan)):
+      layer_params = [params[name] for name in names]
+      out_dtype = self.storage_dtype if i < last else None
+      out, cache = layer_ops[op].forward(out, layer_params, layer_param,
+                                         inplace, out_dtype)
+      self.caches.append(cache)
+      self._record([self.caches, out], self._skip)
+    return out
+
+  def backward(self, dout, need_dx=True, frozen=()):
+    """
+    Run the backward pass, using the caches from the last call to forward.
+
+    Only the work needed for the requested gradients is done: layers whose
+    parameters are all frozen skip their parameter gradients, and if need_dx
+    is False the pass stops at the lowest layer with parameters to train.
+
+    Inputs:
+    - dout: Upstream derivative of the output of the last layer. It is never
+      modified.
+    - need_dx: Whether to compute the gradient with respect to the input.
+    - frozen: Names of parameters that are not being trained.
+
+    Returns a tuple of:
+    - dx: Gradient with respect to the input of the first layer, or None if
+      need_dx is False.
+    - grads: Dictionary mapping the names of the parameters that are not
+      frozen to gradients.
+    """
+    trains = [any(name not in frozen for name in names)
+              for _, names, _ in self.layers]
+    lowest = 0
+    if not need_dx:
+      lowest = trains.index(True) if True in trains else len(self.layers)
+
+    grads = {}
+    owns_dout = False
+    for i in reversed(xrange(lowest, len(self.layers))):
+      op, names, _ = self.layers[i]
+      inplace = self.inplace and owns_dout
+      dout, dparams = layer_ops[op].backward(dout, self.caches[i], inplace,
+                                             need_dx or i > lowest, trains[i])
+      owns_dout = True
+      for name, dparam in zip(names, dparams):
+        if name not in frozen:
+          grads[name] = dparam
+      if self.free_caches:
+        self.caches[i] = None
+      self._record([self.caches, dout], self._skip)
+    self.caches = []
+    if not need_dx:
+      dout = None
+    return dout, grads
+
+  def memory_report(self):
+    """
+    Return a dictionary summarizing the plan and the peak activation memory
+    of the last forward / backward pass; peak_bytes is None unless the graph
+    tracks memory.
+    """
+    return {
+      'peak_bytes': self.peak_bytes if self.track_memory else None,
+      'inplace_layers': [i for i, ok in enumerate(self.plan) if ok],
+      'num_layers': len(self.layers),
+    }
@@ -1,7 +1,36 @@
+import time
+
+import numpy as np
+
 from cs231n.layers import *
 from cs231n.fast_layers import *
 
 
+def cache_bytes(objs, skip=()):
+  """
+  Count the bytes of distinct numpy buffers reachable from objs through
+  tuples, lists and dicts. Views are charged to the array that owns their
+  memory, so an array and views of it are counted once; buffers whose id is
+  in skip (such as the parameters) are not counted.
+  """
+  seen = set(skip)
+  total = 0
+  stack = list(objs)
+  while stack:
+    obj = stack.pop()
+    if isinstance(obj, np.ndarray):
+      while isinstance(obj.base, np.ndarray):
+        obj = obj.base
+      if id(obj) not in seen:
+        seen.add(id(obj))
+        total += obj.nbytes
+    elif isinstance(obj, (tuple, list)):
+      stack.extend(obj)
+    elif isinstance(obj, dict):
+      stack.extend(obj.values())
+  return total
+
+
 def affine_relu_forward(x, w, b):
   """
   Convenience layer that perorms an affine transform followed by a ReLU
@@ -20,17 +49,225 @@ def affine_relu_forward(x, w, b):
   return out, cache
 
 
-def affine_relu_backward(dout, cache):
+def affine_relu_backward(dout, cache, need_dx=True, need_dw=True):
   """
-  Backward pass for the affine-relu convenience layer
+  Backward pass for the affine-relu convenience layer. As for all the
+  backward passes in this file, need_dx=False skips computing dx and
+  need_dw=False skips the parameter gradients; skipped gradients are
+  returned as None.
   """
+  if not (need_dx or need_dw):
+    return None, None, None
   fc_cache, relu_cache = cache
   da = relu_backward(dout, relu_cache)
-  dx, dw, db = affine_backward(da, fc_cache)
+  dx, dw, db = affine_backward(da, fc_cache, need_dx=need_dx, need_dw=need_dw)
   return dx, dw, db
 
 
-pass
+def _batchnorm_statistics(a, bn_param, axis):
+  """
+  Mean and inverse standard deviation used to normalize a in a batch
+  normalization layer, following the same rules as batchnorm_forward: in
+  train mode they are the statistics of a over the given axes and the running
+  averages in bn_param are updated; in test mode the running averages are
+  used.
+  """
+  mode = bn_param['mode']
+  eps = bn_param.get('eps', 1e-5)
+  momentum = bn_param.get('momentum', 0.9)
+  D = a.shape[1]
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=a.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=a.dtype))
+
+  if mode == 'train':
+    mean = a.mean(axis=axis)
+    var = a.var(axis=axis)
+    bn_param['running_mean'] = momentum * running_mean + (1 - momentum) * mean
+    bn_param['running_var'] = momentum * running_var + (1 - momentum) * var
+  elif mode == 'test':
+    mean, var = running_mean, running_var
+  else:
+    raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+  return mean.astype(a.dtype), (1.0 / np.sqrt(var + eps)).astype(a.dtype)
+
+
+def _batchnorm_backward_inplace(dy, x_hat, gamma, inv_std, axis):
+  """
+  Backward pass of the scale, shift and normalization of a batch
+  normalization layer, overwriting dy with the gradient of its input.
+  Returns (dx, dgamma, dbeta).
+  """
+  dbeta = dy.sum(axis=axis)
+  dgamma = (dy * x_hat).sum(axis=axis)
+  shape = [1] * dy.ndim
+  shape[1] = -1
+  dy *= gamma.reshape(shape)
+  dy_mean = dy.mean(axis=axis).reshape(shape)
+  dy_x_hat_mean = (dy * x_hat).mean(axis=axis).reshape(shape)
+  dy -= dy_mean
+  dy -= x_hat * dy_x_hat_mean
+  dy *= inv_std.reshape(shape)
+  return dy, dgamma, dbeta
+
+
+def affine_bn_relu_dropout_forward(x, w, b, gamma, beta, bn_param,
+                                   dropout_param, out_dtype=None):
+  """
+  Convenience layer that performs an affine transform, batch normalization,
+  a ReLU and dropout, as in a hidden layer of FullyConnectedNet.
+
+  This is equivalent to calling affine_forward, batchnorm_forward,
+  relu_forward and dropout_forward in turn, but the normalization, ReLU and
+  dropout all work in place on the affine output, so the only arrays
+  allocated are the normalized activations (needed for the backward pass)
+  and the output. The output doubles as the mask for the backward pass: a
+  unit passes gradient exactly when the ReLU was active and dropout kept it,
+  that is when its output is positive.
+
+  Inputs:
+  - x: Input to the affine layer
+  - w, b: Weights for the affine layer
+  - gamma, beta: Scale and shift parameters for batch normalization; ignored
+    if bn_param is None.
+  - bn_param: Parameters for batch normalization as for batchnorm_forward,
+    or None to skip batch normalization.
+  - dropout_param: Parameters for dropout as for dropout_forward, or None to
+    skip dropout.
+  - out_dtype: If not None, the output (which is also kept in the cache) is
+    stored in this type, such as np.float16 for mixed precision training.
+
+  Returns a tuple of:
+  - out: Output from the dropout layer
+  - cache: Object to give to the backward pass
+  """
+  a = x.reshape(x.shape[0], -1).dot(w)
+  a += b
+
+  x_hat, inv_std = None, None
+  if bn_param is not None:
+    mean, inv_std = _batchnorm_statistics(a, bn_param, axis=0)
+    a -= mean
+    a *= inv_std
+    x_hat = a
+    out = x_hat * gamma
+    out += beta
+  else:
+    out = a
+  np.maximum(out, 0, out=out)
+
+  scale = 1.0
+  if dropout_param is not None and dropout_param['mode'] == 'train':
+    # Draw the same mask as dropout_forward
+    p = dropout_param['p']
+    if 'seed' in dropout_param:
+      np.random.seed(dropout_param['seed'])
+    out *= np.random.rand(*out.shape) < 1 - p
+    scale = 1.0 / (1 - p)
+    out *= scale
+
+  if out_dtype is not None:
+    out = out.astype(out_dtype, copy=False)
+  cache = (x, w, x_hat, gamma, inv_std, out, scale)
+  return out, cache
+
+
+def affine_bn_relu_dropout_backward(dout, cache, need_dx=True, need_dw=True):
+  """
+  Backward pass for the affine-batchnorm-relu-dropout convenience layer.
+
+  Returns a tuple of (dx, dw, db, dgamma, dbeta); dgamma and dbeta are None
+  if the forward pass did not use batch normalization.
+  """
+  if not (need_dx or need_dw):
+    return None, None, None, None, None
+  x, w, x_hat, gamma, inv_std, out, scale = cache
+  da = dout * (out > 0)
+  if scale != 1.0:
+    da *= scale
+
+  dgamma, dbeta = None, None
+  if x_hat is not None:
+    da, dgamma, dbeta = _batchnorm_backward_inplace(da, x_hat, gamma, inv_std,
+                                                    axis=0)
+
+  dx, dw, db = None, None, None
+  if need_dw:
+    dw = x.reshape(x.shape[0], -1).T.dot(da)
+    db = da.sum(axis=0)
+  else:
+    dgamma, dbeta = None, None
+  if need_dx:
+    dx = da.dot(w.T).reshape(x.shape)
+  return dx, dw, db, dgamma, dbeta
+
+
+def _batchnorm_inference_scale_shift(gamma, beta, bn_param, b):
+  """
+  Fold the bias b of the preceding layer and a batch normalization layer in
+  test mode into a single per-feature scale and shift.
+  """
+  eps = bn_param.get('eps', 1e-5)
+  D = gamma.shape[0]
+  running_mean = bn_param.get('running_mean', np.zeros(D, dtype=gamma.dtype))
+  running_var = bn_param.get('running_var', np.zeros(D, dtype=gamma.dtype))
+  scale = gamma / np.sqrt(running_var + eps)
+  shift = beta + (b - running_mean) * scale
+  return scale.astype(gamma.dtype), shift.astype(gamma.dtype)
+
+
+def affine_bn_relu_inference(x, w, b, gamma=None, beta=None, bn_param=None,
+                             relu=True, out=None):
+  """
+  Forward-only version of affine_bn_relu_dropout_forward for test time, when
+  dropout does nothing and batch normalization uses its running averages.
+  Nothing is kept for a backward pass, the bias and normalization are folded
+  into one scale and shift, and everything after the matrix multiply happens
+  in place.
+
+  Inputs:
+  - x: Input to the affine layer
+  - w, b: Weights for the affine layer
+  - gamma, beta, bn_param: Batch normalization parameters, or None to skip
+    batch normalization.
+  - relu: Whether to apply a ReLU.
+  - out: If not None, a C-contiguous array of shape (N, M) and the same type
+    as x.dot(w) into which to write the output.
+
+  Returns:
+  - out: Output of the layer
+  """
+  out = np.dot(x.reshape(x.shape[0], -1), w, out=out)
+  if bn_param is not None:
+    scale, shift = _batchnorm_inference_scale_shift(gamma, beta, bn_param, b)
+    out *= scale
+    out += shift
+  else:
+    out += b
+  if relu:
+    np.maximum(out, 0, out=out)
+  return out
+
+
+def conv_bn_relu_pool_inference(x, w, b, conv_param, pool_param, gamma=None,
+                                beta=None, bn_param=None):
+  """
+  Forward-only version of conv_relu_pool_forward and
+  conv_bn_relu_pool_forward for test time; batch normalization is skipped if
+  bn_param is None. Nothing is kept for a backward pass, the normalization
+  works in place on the convolution output and the ReLU in place on the
+  (smaller) pooled output.
+
+  Returns:
+  - out: Output from the pooling layer
+  """
+  a = conv_forward_inference(x, w, b, conv_param)
+  if bn_param is not None:
+    scale, shift = _batchnorm_inference_scale_shift(gamma, beta, bn_param, 0)
+    a *= scale.reshape(1, -1, 1, 1)
+    a += shift.reshape(1, -1, 1, 1)
+  out = max_pool_forward_inference(a, pool_param)
+  np.maximum(out, 0, out=out)
+  return out
 
 
 def conv_relu_forward(x, w, b, conv_param):
@@ -51,13 +288,16 @@ def conv_relu_forward(x, w, b, conv_param):
   return out, cache
 
 
-def conv_relu_backward(dout, cache):
+def conv_relu_backward(dout, cache, need_dx=True, need_dw=True):
   """
   Backward pass for the conv-relu convenience layer.
   """
+  if not (need_dx or need_dw):
+    return None, None, None
   conv_cache, relu_cache = cache
   da = relu_backward(dout, relu_cache)
-  dx, dw, db = conv_backward_fast(da, conv_cache)
+  dx, dw, db = conv_backward_fast(da, conv_cache, need_dx=need_dx,
+                                  need_dw=need_dw)
   return dx, dw, db
 
 
@@ -81,13 +321,161 @@ def conv_relu_pool_forward(x, w, b, conv_param, pool_param):
   return out, cache
 
 
-def conv_relu_pool_backward(dout, cache):
+def conv_relu_pool_backward(dout, cache, need_dx=True, need_dw=True):
   """
   Backward pass for the conv-relu-pool convenience layer
   """
+  if not (need_dx or need_dw):
+    return None, None, None
   conv_cache, relu_cache, pool_cache = cache
   ds = max_pool_backward_fast(dout, pool_cache)
   da = relu_backward(ds, relu_cache)
-  dx, dw, db = conv_backward_fast(da, conv_cache)
+  dx, dw, db = conv_backward_fast(da, conv_cache, need_dx=need_dx,
+                                  need_dw=need_dw)
   return dx, dw, db
 
+
+def conv_bn_relu_pool_forward(x, w, b, gamma, beta, conv_param, bn_param,
+                              pool_param, out_dtype=None):
+  """
+  Convenience layer that performs a convolution, spatial batch normalization,
+  a ReLU, and a pool.
+
+  The normalization works in place on the convolution output. Since the ReLU
+  is monotonic, taking the max over a pooling region before or after it gives
+  the same result, so the ReLU is applied to the (smaller) pooled output;
+  the pooled output is then also all the backward pass needs to know which
+  units were active.
+
+  Inputs:
+  - x: Input to the convolutional layer
+  - w, b, conv_param: Weights and parameters for the convolutional layer
+  - gamma, beta, bn_param: Parameters for spatial batch normalization
+  - pool_param: Parameters for the pooling layer
+  - out_dtype: If not None, the output (which is also kept in the cache) is
+    stored in this type.
+
+  Returns a tuple of:
+  - out: Output from the pooling layer
+  - cache: Object to give to the backward pass
+  """
+  a, conv_cache = conv_forward_fast(x, w, b, conv_param)
+  mean, inv_std = _batchnorm_statistics(a, bn_param, axis=(0, 2, 3))
+  a -= mean.reshape(1, -1, 1, 1)
+  a *= inv_std.reshape(1, -1, 1, 1)
+  x_hat = a
+  s = x_hat * gamma.reshape(1, -1, 1, 1)
+  s += beta.reshape(1, -1, 1, 1)
+  out, pool_cache = max_pool_forward_fast(s, pool_param)
+  np.maximum(out, 0, out=out)
+  if out_dtype is not None:
+    out = out.astype(out_dtype, copy=False)
+  cache = (conv_cache, x_hat, gamma, inv_std, pool_cache, out)
+  return out, cache
+
+
+def conv_bn_relu_pool_backward(dout, cache, need_dx=True, need_dw=True):
+  """
+  Backward pass for the conv-bn-relu-pool convenience layer.
+
+  Returns a tuple of (dx, dw, db, dgamma, dbeta).
+  """
+  if not (need_dx or need_dw):
+    return None, None, None, None, None
+  conv_cache, x_hat, gamma, inv_std, pool_cache, out = cache
+  ds = max_pool_backward_fast(dout * (out > 0), pool_cache)
+  da, dgamma, dbeta = _batchnorm_backward_inplace(ds, x_hat, gamma, inv_std,
+                                                  axis=(0, 2, 3))
+  dx, dw, db = conv_backward_fast(da, conv_cache, need_dx=need_dx,
+                                  need_dw=need_dw)
+  if not need_dw:
+    dgamma, dbeta = None, None
+  return dx, dw, db, dgamma, dbeta
+
+
+def checkpoint_forward(forward, *args, **kwargs):
+  """
+  Run a layer's forward function but keep only its inputs, rather than its
+  cache, for the backward pass; checkpoint_backward runs forward again to
+  rebuild the cache. Wrapping a whole segment such as conv_relu_pool_forward
+  frees every intermediate of the segment between the forward and backward
+  passes, at the cost of a second forward pass through it.
+
+  Recomputing must give the same result as the original forward pass, so the
+  numpy random state is recorded for layers that use it (such as dropout),
+  and parameter dictionaries among the arguments (such as a bn_param whose
+  running averages forward updates) are put back afterwards as forward left
+  them.
+
+  Inputs:
+  - forward: Forward function of a layer, returning (out, cache).
+  - args, kwargs: Arguments for forward.
+
+  Returns a tuple of:
+  - out: Output of forward
+  - cache: Object to give to checkpoint_backward
+  """
+  rng_state = np.random.get_state()
+  out, _ = forward(*args, **kwargs)
+  saved = [(arg, dict(arg)) for arg in args if isinstance(arg, dict)]
+  return out, (forward, args, kwargs, rng_state, saved)
+
+
+def checkpoint_backward(backward, dout, cache, **kwargs):
+  """
+  Backward pass for a layer run through checkpoint_forward, where backward is
+  the layer's backward function; keyword arguments such as need_dx are
+  passed on to it.
+  """
+  forward, args, forward_kwargs, rng_state, saved = cache
+  state = np.random.get_state()
+  np.random.set_state(rng_state)
+  _, real_cache = forward(*args, **forward_kwargs)
+  np.random.set_state(state)
+  for arg, values in saved:
+    arg.clear()
+    arg.update(values)
+  return backward(dout, real_cache, **kwargs)
+
+
+def checkpoint_report(x, w, b, conv_param, pool_param, num_repeats=2):
+  """
+  Compare the memory kept between the forward and backward passes and the
+  time taken by both passes of a conv-relu-pool layer for each way of
+  checkpointing it:
+
+  - None: No checkpointing.
+  - 'conv': Only the convolution's cache is recomputed (conv_param
+    ['checkpoint'] = True).
+  - 'segment': The whole conv-relu-pool segment is recomputed
+    (checkpoint_forward).
+
+  Inputs:
+  - x, w, b, conv_param, pool_param: As for conv_relu_pool_forward.
+  - num_repeats: The best time of this many runs is reported.
+
+  Returns:
+  - report: Dictionary mapping each mode to a dictionary with keys
+    'cache_bytes' (bytes held by the cache, not counting x, w and b) and
+    'seconds' (time of a forward and a backward pass).
+  """
+  report = {}
+  for mode in (None, 'conv', 'segment'):
+    param = dict(conv_param, checkpoint=(mode == 'conv'))
+    best = None
+    for i in xrange(num_repeats):
+      start = time.time()
+      if mode == 'segment':
+        out, cache = checkpoint_forward(conv_relu_pool_forward, x, w, b, param,
+                                        pool_param)
+      else:
+        out, cache = conv_relu_pool_forward(x, w, b, param, pool_param)
+      nbytes = cache_bytes([cache], [id(x), id(w), id(b)])
+      if mode == 'segment':
+        checkpoint_backward(conv_relu_pool_backward, out, cache)
+      else:
+        conv_relu_pool_backward(out, cache)
+      elapsed = time.time() - start
+      best = elapsed if best is None else min(best, elapsed)
+    report[mode] = {'cache_bytes': nbytes, 'seconds': best}
+  return report
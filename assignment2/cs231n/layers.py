@@ -27,8 +27,7 @@ def affine_forward(x, w, b):
   xshapes = () #Tuple to store the dimension sizes of input x matrix. 
   xshapes = x.shape #Unpacking the shapes for future convenience
   D, M = w.shape 
-  x = x.reshape((xshapes[0], -1)) #Reshaping design matrix into 2D matrix.
-  out = x.dot(w) + b
+  out = x.reshape((xshapes[0], -1)).dot(w) + b #Reshaping design matrix into 2D matrix.
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -36,7 +35,7 @@ def affine_forward(x, w, b):
   return out, cache
 
 
-def affine_backward(dout, cache):
+def affine_backward(dout, cache, need_dx=True, need_dw=True):
   """
   Computes the backward pass for an affine layer.
 
@@ -45,6 +44,8 @@ def affine_backward(dout, cache):
   - cache: Tuple of:
     - x: Input data, of shape (N, d_1, ... d_k)
     - w: Weights, of shape (D, M)
+  - need_dx: Whether to compute dx; if False it is returned as None.
+  - need_dw: Whether to compute dw and db; if False they are returned as None.
 
   Returns a tuple of:
   - dx: Gradient with respect to x, of shape (N, d1, ..., d_k)
@@ -56,10 +57,12 @@ def affine_backward(dout, cache):
   #############################################################################
   # TODO: Implement the affine backward pass.                                 #
   #############################################################################
-  dx = dout.dot(w.transpose())
-  dx = dx.reshape(x.shape)
-  dw = x.transpose().dot(dout)
-  db = dout.sum(axis = 0) 
+  if need_dx:
+    dx = dout.dot(w.transpose())
+    dx = dx.reshape(x.shape)
+  if need_dw:
+    dw = x.reshape((x.shape[0], -1)).transpose().dot(dout)
+    db = dout.sum(axis = 0) 
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -192,7 +195,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     cache['normalized'] = normalized
     
     running_mean = momentum * running_mean + (1 - momentum) * np.mean(x, axis = 0)
-    running_var = momentum * running_var + (1 - momentum) * np.std(x, axis = 0)
+    running_var = momentum * running_var + (1 - momentum) * x_var
     #############################################################################
     #                             END OF YOUR CODE                              #
     #############################################################################
@@ -204,7 +207,7 @@ def batchnorm_forward(x, gamma, beta, bn_param):
     # the out variable.                                                         #
     #############################################################################
     out = x - running_mean
-    out /= (running_var + eps)
+    out /= np.sqrt(running_var + eps)
     out = gamma * out + beta
     #############################################################################
     #                             END OF YOUR CODE                              #
@@ -288,7 +291,11 @@ def batchnorm_backward_alt(dout, cache):
   # should be able to compute gradients with respect to the inputs in a       #
   # single statement; our implementation fits on a single 80-character line.  #
   #############################################################################
-  pass
+  x_hat, std = cache['normalized'], cache['h2']
+  dgamma = (x_hat * dout).sum(axis=0)
+  dbeta = dout.sum(axis=0)
+  dx_hat = cache['gamma'] * dout
+  dx = (dx_hat - dx_hat.mean(axis=0) - x_hat * (dx_hat * x_hat).mean(axis=0)) / std
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -327,7 +334,8 @@ def dropout_forward(x, dropout_param):
     # TODO: Implement the training phase forward pass for inverted dropout.   #
     # Store the dropout mask in the mask variable.                            #
     ###########################################################################
-    pass
+    mask = (np.random.rand(*x.shape) < 1 - p) / (1 - p)
+    out = x * mask
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -335,7 +343,7 @@ def dropout_forward(x, dropout_param):
     ###########################################################################
     # TODO: Implement the test phase forward pass for inverted dropout.       #
     ###########################################################################
-    pass
+    out = x
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -362,7 +370,7 @@ def dropout_backward(dout, cache):
     ###########################################################################
     # TODO: Implement the training phase backward pass for inverted dropout.  #
     ###########################################################################
-    pass
+    dx = dout * mask
     ###########################################################################
     #                            END OF YOUR CODE                             #
     ###########################################################################
@@ -496,7 +504,8 @@ def max_pool_forward_naive(x, pool_param):
 
   Returns a tuple of:
   - out: Output data
-  - cache: (x, pool_param)
+  - cache: (x_shape, pool_param, argmax), where argmax has the shape of out
+    and gives the row-major position of the max within each pooling region.
   """
   
   out = None
@@ -509,8 +518,8 @@ def max_pool_forward_naive(x, pool_param):
   pool_h = pool_param['pool_height']
   H_ = 1 + (H - pool_param['pool_height']) / pool_param['stride']
   W_ = 1 + (W - pool_param['pool_width']) / pool_param['stride'] 
-  out = np.zeros((N, C, H_, W_))
-  grad_cont = np.zeros(x.shape)
+  out = np.zeros((N, C, H_, W_), dtype=x.dtype)
+  argmax = np.zeros((N, C, H_, W_), dtype=np.int32)
   for i in xrange(0, N): 
     for j in xrange(0, C):
         for k in xrange(0, H_): 
@@ -518,12 +527,12 @@ def max_pool_forward_naive(x, pool_param):
                 to_consider = x[i, j, k * stride: k * stride + pool_h, 
                                    l * stride: l * stride + pool_w]
                 temp = np.argmax(to_consider)
-                out[i, j, k, l] = to_consider[temp / to_consider.shape[1], temp % to_consider.shape[1]]
-                grad_cont[i, j, pool_h * k + (temp / to_consider.shape[1]), pool_w * l + (temp % to_consider.shape[1])] = 1
+                out[i, j, k, l] = to_consider[temp / pool_w, temp % pool_w]
+                argmax[i, j, k, l] = temp
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
-  cache = (grad_cont, pool_param)
+  cache = (x.shape, pool_param, argmax)
   return out, cache
 
 
@@ -533,34 +542,28 @@ def max_pool_backward_naive(dout, cache):
 
   Inputs:
   - dout: Upstream derivatives
-  - cache: A tuple of (grad_cont, pool_param) as in the forward pass.
+  - cache: A tuple of (x_shape, pool_param, argmax) as in the forward pass.
 
   Returns:
   - dx: Gradient with respect to x
   """
   
-  grad_cont = cache[0]
-  #print grad_cont
-  N, C, H, W = grad_cont.shape
-  pool_param = cache[1]
+  x_shape, pool_param, argmax = cache
+  N, C, H, W = x_shape
   stride = pool_param['stride']
-  pool_h = pool_param['pool_height']
   pool_w = pool_param['pool_width']
-  dx = np.zeros(grad_cont.shape)
-  H_ = 1 + (H - pool_param['pool_height']) / pool_param['stride']
-  W_ = 1 + (W - pool_param['pool_width']) / pool_param['stride'] 
+  dx = np.zeros(x_shape, dtype=dout.dtype)
+  _, _, H_, W_ = argmax.shape
   #############################################################################
   # TODO: Implement the max pooling backward pass                             #
   #############################################################################
-  for i in xrange(0, N): 
-      for j in xrange(0, C):
-          for k in xrange(0, H_): 
-              for l in xrange(0, W_):
-                  to_consider = grad_cont[i, j, k * stride: k * stride + pool_h, 
-                                   l * stride: l * stride + pool_w]
-                  #print 'came here'
-                  dx[i, j, k * stride: k * stride + pool_h, 
-                                   l * stride: l * stride + pool_w] = to_consider * dout[i, j, k, l]
+  # Row and column of each max in the input; np.add.at accumulates gradients
+  # for inputs that win several overlapping pooling regions
+  rows = np.arange(H_).reshape(1, 1, H_, 1) * stride + argmax / pool_w
+  cols = np.arange(W_).reshape(1, 1, 1, W_) * stride + argmax % pool_w
+  n_idx = np.arange(N).reshape(N, 1, 1, 1)
+  c_idx = np.arange(C).reshape(1, C, 1, 1)
+  np.add.at(dx, (n_idx, c_idx, rows, cols), dout)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -598,7 +601,10 @@ def spatial_batchnorm_forward(x, gamma, beta, bn_param):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  N, C, H, W = x.shape
+  x_flat = x.transpose(0, 2, 3, 1).reshape(-1, C)
+  out_flat, cache = batchnorm_forward(x_flat, gamma, beta, bn_param)
+  out = out_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -628,7 +634,10 @@ def spatial_batchnorm_backward(dout, cache):
   # version of batch normalization defined above. Your implementation should  #
   # be very short; ours is less than five lines.                              #
   #############################################################################
-  pass
+  N, C, H, W = dout.shape
+  dout_flat = dout.transpose(0, 2, 3, 1).reshape(-1, C)
+  dx_flat, dgamma, dbeta = batchnorm_backward_alt(dout_flat, cache)
+  dx = dx_flat.reshape(N, H, W, C).transpose(0, 3, 1, 2)
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
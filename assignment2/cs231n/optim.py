@@ -26,7 +26,10 @@ well; however the default values of the other hyperparameters should work well
 for a variety of different problems.
 
 For efficiency, update rules may perform in-place updates, mutating w and
-setting next_w equal to w.
+setting next_w equal to w. All of the rules below do so, and also update the
+arrays they keep in config in place, using at most one temporary array the
+size of w; dw is never modified. This lets the Solver apply a rule to a
+single flat buffer holding every parameter (see its flat_params option).
 """
 
 
@@ -58,19 +61,22 @@ def sgd_momentum(w, dw, config=None):
   if config is None: config = {}
   config.setdefault('learning_rate', 1e-2)
   config.setdefault('momentum', 0.9)
-  v = config.get('velocity', np.zeros_like(w))
+  if 'velocity' not in config:
+    config['velocity'] = np.zeros_like(w)
+  v = config['velocity']
   
   next_w = None
   #############################################################################
   # TODO: Implement the momentum update formula. Store the updated value in   #
   # the next_w variable. You should also use and update the velocity v.       #
   #############################################################################
-  v = config['momentum'] * v - (config['learning_rate'] * dw)
-  next_w = w + v
+  v *= config['momentum']
+  v -= config['learning_rate'] * dw
+  w += v
+  next_w = w
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
-  config['velocity'] = v
 
   return next_w, config
 
@@ -92,7 +98,8 @@ def rmsprop(x, dx, config=None):
   config.setdefault('learning_rate', 1e-2)
   config.setdefault('decay_rate', 0.99)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('cache', np.zeros_like(x))
+  if 'cache' not in config:
+    config['cache'] = np.zeros_like(x)
 
   next_x = None
   #############################################################################
@@ -100,9 +107,17 @@ def rmsprop(x, dx, config=None):
   # in the next_x variable. Don't forget to update cache value stored in      #  
   # config['cache'].                                                          #
   #############################################################################
-  config['cache'] = (config['decay_rate'] * config['cache']) +\
-                    ((1 - config['decay_rate']) * dx**2)
-  next_x = x - (config['learning_rate'] * (dx / np.sqrt(config['cache'] + 1e-7)))
+  cache = config['cache']
+  tmp = np.multiply(dx, dx)
+  tmp *= 1 - config['decay_rate']
+  cache *= config['decay_rate']
+  cache += tmp
+  np.add(cache, 1e-7, out=tmp)
+  np.sqrt(tmp, out=tmp)
+  np.divide(dx, tmp, out=tmp)
+  tmp *= config['learning_rate']
+  x -= tmp
+  next_x = x
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -129,8 +144,10 @@ def adam(x, dx, config=None):
   config.setdefault('beta1', 0.9)
   config.setdefault('beta2', 0.999)
   config.setdefault('epsilon', 1e-8)
-  config.setdefault('m', np.zeros_like(x))
-  config.setdefault('v', np.zeros_like(x))
+  if 'm' not in config:
+    config['m'] = np.zeros_like(x)
+  if 'v' not in config:
+    config['v'] = np.zeros_like(x)
   config.setdefault('t', 0)
   
   next_x = None
@@ -139,11 +156,21 @@ def adam(x, dx, config=None):
   # the next_x variable. Don't forget to update the m, v, and t variables     #
   # stored in config.                                                         #
   #############################################################################
-  config['m'] = config['beta1'] * config['m'] +\
-                (1 - config['beta1']) * dx 
-  config['v'] = config['beta2'] * config['v'] +\
-                (1 - config['beta2']) * dx**2
-  next_x = x - config['learning_rate'] * config ['m'] / (np.sqrt(config['v'] + 1e-7))
+  m, v = config['m'], config['v']
+  config['t'] += 1
+  tmp = np.multiply(dx, 1 - config['beta1'])
+  m *= config['beta1']
+  m += tmp
+  np.multiply(dx, dx, out=tmp)
+  tmp *= 1 - config['beta2']
+  v *= config['beta2']
+  v += tmp
+  np.add(v, 1e-7, out=tmp)
+  np.sqrt(tmp, out=tmp)
+  np.divide(m, tmp, out=tmp)
+  tmp *= config['learning_rate']
+  x -= tmp
+  next_x = x
   #############################################################################
   #                             END OF YOUR CODE                              #
   #############################################################################
@@ -0,0 +1,280 @@
+import multiprocessing
+import os
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+"""
+This file implements data-parallel training for the Solver on a single
+machine. A pool of worker processes each holds a copy of the model; the
+training data, the parameters and the gradients live in shared memory, so
+that no arrays need to be sent between processes apart from the indices of
+each minibatch.
+
+There are two modes:
+
+- 'sync': Every minibatch is split into one shard per worker. Each worker
+  computes the loss and gradients on its shard and writes the gradients into
+  its own slot of a shared buffer; the Solver then averages the slots
+  (weighted by shard size, which gives exactly the gradient of the whole
+  minibatch) and applies the update rule itself, as usual. Batch
+  normalization uses the statistics of each shard, and the running averages
+  are the averages of the workers' running averages.
+- 'async': Hogwild-style training. Each minibatch goes whole to one worker,
+  which computes its gradients and applies the update rule directly to the
+  shared parameters, without locking, while the other workers do the same
+  with other minibatches. Every worker keeps its own update rule state (such
+  as momentum). Up to one minibatch per worker is in flight at any time.
+
+parallel = DataParallel(model, X, y, num_workers=4)
+loss, grads = parallel.loss(model.params, batch_idx)
+parallel.close()
+"""
+
+
+def _shared_array(shape, dtype):
+  """
+  Allocate an array of the given shape and type in shared memory, so that
+  processes forked afterwards (or receiving it through the Pool initializer)
+  see each other's writes.
+  """
+  nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+  raw = RawArray('b', max(nbytes, 1))
+  a = np.ctypeslib.as_array(raw)[:nbytes].view(dtype).reshape(shape)
+  return raw, a
+
+
+def _shared_view(raw, shape, dtype):
+  nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+  return np.ctypeslib.as_array(raw)[:nbytes].view(dtype).reshape(shape)
+
+
+class _ParamLayout(object):
+  """
+  Position of each parameter in a flat vector holding all of them.
+  """
+
+  def __init__(self, params):
+    self.names = sorted(params)
+    self.shapes = {}
+    self.offsets = {}
+    offset = 0
+    for name in self.names:
+      self.shapes[name] = params[name].shape
+      self.offsets[name] = (offset, offset + params[name].size)
+      offset += params[name].size
+    self.size = offset
+
+  def views(self, flat):
+    return {name: flat[start:end].reshape(self.shapes[name])
+            for name, (start, end) in self.offsets.iteritems()}
+
+
+def _bn_state(model):
+  return [{k: bn_param[k] for k in ('running_mean', 'running_var')
+           if k in bn_param}
+          for bn_param in getattr(model, 'bn_params', [])]
+
+
+def _set_bn_state(model, state):
+  for bn_param, saved in zip(getattr(model, 'bn_params', []), state):
+    bn_param.update(saved)
+
+
+# State of a worker process, set up by _init_worker
+_worker = {}
+
+
+def _init_worker(model, layout, dtype, num_slots, shared, seed, update_rule,
+                 optim_config):
+  raw_X, X_shape, X_dtype, raw_y, y_shape, y_dtype, raw_w, raw_g = shared
+  _worker['model'] = model
+  _worker['layout'] = layout
+  _worker['X'] = _shared_view(raw_X, X_shape, X_dtype)
+  _worker['y'] = _shared_view(raw_y, y_shape, y_dtype)
+  _worker['grads'] = _shared_view(raw_g, (num_slots, layout.size), dtype)
+  # The model reads its parameters straight from shared memory
+  model.params = layout.views(_shared_view(raw_w, (layout.size,), dtype))
+  _worker['update_rule'] = update_rule
+  _worker['configs'] = {p: dict(optim_config) for p in layout.names}
+  # Give every worker its own random stream (for example for dropout)
+  np.random.seed((seed + os.getpid()) % (2**31 - 1))
+  # The workers already use all the cores; keep the conv kernels serial
+  try:
+    from cs231n.im2col_cython import set_num_threads
+    set_num_threads(1)
+  except ImportError:
+    pass
+
+
+def _worker_loss(idx, loss_scale, bn_state):
+  model = _worker['model']
+  _set_bn_state(model, bn_state)
+  if hasattr(model, 'loss_scale'):
+    model.loss_scale = loss_scale
+  return model.loss(_worker['X'][idx], _worker['y'][idx])
+
+
+def _sync_task(args):
+  """
+  Compute the gradients on one shard of a minibatch and store them, as a
+  flat vector, in the given slot of the shared gradient buffer. Parameters
+  without a gradient (such as frozen ones) get zeros.
+  """
+  slot, idx, loss_scale, bn_state = args
+  loss, grads = _worker_loss(idx, loss_scale, bn_state)
+  layout = _worker['layout']
+  out = _worker['grads'][slot]
+  for name, (start, end) in layout.offsets.iteritems():
+    if name in grads:
+      out[start:end] = grads[name].ravel()
+    else:
+      out[start:end] = 0
+  return loss, _bn_state(_worker['model']), sorted(grads)
+
+
+def _async_task(args):
+  """
+  Compute the gradients on a whole minibatch and apply the update rule to
+  the shared parameters in place.
+  """
+  idx, lr_scale, bn_state = args
+  loss, grads = _worker_loss(idx, 1.0, bn_state)
+  model = _worker['model']
+  for p, w in model.params.iteritems():
+    if p not in grads:
+      continue
+    config = _worker['configs'][p]
+    if 'learning_rate' in config:
+      config.setdefault('base_learning_rate', config['learning_rate'])
+      config['learning_rate'] = config['base_learning_rate'] * lr_scale
+    next_w, _worker['configs'][p] = _worker['update_rule'](w, grads[p], config)
+    if next_w is not w:
+      w[...] = next_w
+  return loss, _bn_state(model)
+
+
+class DataParallel(object):
+  """
+  Runs the loss and gradient computation of a model on a pool of worker
+  processes; see the top of this file.
+  """
+
+  def __init__(self, model, X, y, num_workers, mode='sync', update_rule=None,
+               optim_config=None, seed=None):
+    """
+    Inputs:
+    - model: Model to train; each worker gets a copy of it.
+    - X, y: Training data and labels, copied once into shared memory.
+    - num_workers: Number of worker processes.
+    - mode: 'sync' or 'async'.
+    - update_rule, optim_config: Update rule function and its configuration,
+      used by the workers in async mode.
+    - seed: Seed from which the workers' random seeds are derived; if None,
+      it is drawn from the global numpy random state.
+    """
+    if mode not in ('sync', 'async'):
+      raise ValueError('Invalid parallel mode "%s"' % mode)
+    self.mode = mode
+    self.num_workers = num_workers
+    self.model = model
+    self.layout = _ParamLayout(model.params)
+    self.dtype = np.result_type(*model.params.values())
+
+    raw_X, self.X = _shared_array(X.shape, X.dtype)
+    self.X[...] = X
+    raw_y, self.y = _shared_array(y.shape, y.dtype)
+    self.y[...] = y
+    raw_w, self.w = _shared_array((self.layout.size,), self.dtype)
+    num_slots = num_workers if mode == 'sync' else 1
+    raw_g, self.grads = _shared_array((num_slots, self.layout.size),
+                                      self.dtype)
+    self.params = self.layout.views(self.w)
+    self.load_params(model.params)
+
+    if seed is None:
+      seed = np.random.randint(2**31 - 1)
+    shared = (raw_X, X.shape, X.dtype, raw_y, y.shape, y.dtype, raw_w, raw_g)
+    self.pool = multiprocessing.Pool(
+        num_workers, initializer=_init_worker,
+        initargs=(model, self.layout, self.dtype, num_slots, shared, seed,
+                  update_rule, optim_config or {}))
+    self._pending = []
+
+  def load_params(self, params):
+    """
+    Copy params into the shared parameters that the workers read.
+    """
+    for name, view in self.params.iteritems():
+      view[...] = params[name]
+
+  def loss(self, params, batch_idx, loss_scale=1.0):
+    """
+    Compute the loss and gradients of one minibatch in sync mode.
+
+    Inputs:
+    - params: Current parameters, copied to the workers first.
+    - batch_idx: Indices (or a slice) of the training examples in the
+      minibatch.
+    - loss_scale: Value to which the workers set model.loss_scale.
+
+    Returns a tuple of:
+    - loss: Loss of the whole minibatch.
+    - grads: Dictionary mapping parameter names to gradients, for the
+      parameters that the model returned gradients for.
+    """
+    self.load_params(params)
+    idx = np.arange(self.X.shape[0])[batch_idx]
+    shards = [s for s in np.array_split(idx, self.num_workers) if s.size]
+    bn_state = _bn_state(self.model)
+    tasks = [(k, shard, loss_scale, bn_state) for k, shard in enumerate(shards)]
+    results = self.pool.map(_sync_task, tasks, chunksize=1)
+
+    # All-reduce: the minibatch loss and gradient are the averages of those
+    # of the shards, weighted by the shard sizes
+    weights = np.array([s.size for s in shards], dtype=self.dtype) / idx.size
+    grads = weights.dot(self.grads[:len(shards)])
+    loss = sum(wt * result[0] for wt, result in zip(weights, results))
+    states = [result[1] for result in results]
+    for i, bn_param in enumerate(getattr(self.model, 'bn_params', [])):
+      for k in states[0][i]:
+        bn_param[k] = sum(wt * state[i][k] for wt, state in zip(weights, states))
+    views = self.layout.views(grads)
+    return loss, {name: views[name] for name in results[0][2]}
+
+  def async_step(self, batch_idx, lr_scale=1.0):
+    """
+    Hand a minibatch to the next free worker in async mode. Once every
+    worker is busy, wait for the oldest minibatch to finish first.
+
+    Inputs:
+    - batch_idx: Indices (or a slice) of the training examples.
+    - lr_scale: Factor by which the workers multiply the learning rate of
+      optim_config, for learning rate decay.
+
+    Returns:
+    - losses: List with the losses of the minibatches that finished.
+    """
+    idx = np.arange(self.X.shape[0])[batch_idx]
+    losses = []
+    if len(self._pending) >= self.num_workers:
+      losses.append(self._collect())
+    args = (idx, lr_scale, _bn_state(self.model))
+    self._pending.append(self.pool.apply_async(_async_task, (args,)))
+    return losses
+
+  def _collect(self):
+    loss, bn_state = self._pending.pop(0).get()
+    _set_bn_state(self.model, bn_state)
+    return loss
+
+  def drain(self):
+    """
+    Wait for all minibatches in flight and return their losses.
+    """
+    return [self._collect() for _ in xrange(len(self._pending))]
+
+  def close(self):
+    self.pool.terminate()
+    self.pool.join()
+    self._pending = []
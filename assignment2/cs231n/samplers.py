@@ -0,0 +1,315 @@
+import sys
+import threading
+import Queue
+
+import numpy as np
+
+"""
+This file implements the minibatch samplers used by the Solver. A sampler
+decides which training examples make up each minibatch; the Prefetcher at the
+bottom of the file can wrap any sampler and assemble the next minibatch on a
+background thread while the model is busy computing the current one.
+
+Every sampler has the same interface:
+
+sampler = SomeSampler(num_train, batch_size, y=None, seed=None)
+batch_idx = sampler.next_indices()
+
+Inputs:
+  - num_train: Number of training examples to draw from.
+  - batch_size: Number of examples in each minibatch.
+  - y: Array of shape (num_train,) giving training labels; only samplers that
+    look at the labels (such as StratifiedSampler) require it.
+  - seed: Seed for the sampler's private random number generator. If None, a
+    seed is drawn from the global numpy random state so that np.random.seed
+    still makes training reproducible.
+
+Samplers own a private np.random.RandomState so that drawing minibatches on a
+background thread does not interfere with the global random state used by the
+model (for example by dropout), and so that their position can be saved and
+restored through get_state() / set_state().
+
+Some samplers also have a take(X, y, batch_idx) method which is used instead
+of fancy indexing to gather a minibatch; ChunkSampler uses this to read runs
+of consecutive rows as slices.
+"""
+
+
+def _make_rng(seed):
+  if seed is None:
+    seed = np.random.randint(2**31 - 1)
+  return np.random.RandomState(seed)
+
+
+class RandomSampler(object):
+  """
+  Draws every minibatch independently and uniformly at random with
+  replacement. This is the original Solver behavior.
+  """
+
+  def __init__(self, num_train, batch_size, y=None, seed=None):
+    self.num_train = num_train
+    self.batch_size = batch_size
+    self.rng = _make_rng(seed)
+
+  def next_indices(self):
+    return self.rng.randint(self.num_train, size=self.batch_size)
+
+  def get_state(self):
+    return {'rng': self.rng.get_state()}
+
+  def set_state(self, state):
+    self.rng.set_state(state['rng'])
+
+
+class EpochSampler(object):
+  """
+  Draws a fresh random permutation of the training set at the start of every
+  epoch and walks through it, so each example is seen exactly once per epoch
+  (sampling without replacement). The final minibatch of an epoch is topped up
+  from the next permutation so that all minibatches have batch_size elements.
+  """
+
+  def __init__(self, num_train, batch_size, y=None, seed=None):
+    self.num_train = num_train
+    self.batch_size = batch_size
+    self.rng = _make_rng(seed)
+    self._new_epoch()
+
+  def _new_epoch(self):
+    self.perm = self.rng.permutation(self.num_train)
+    self.cursor = 0
+
+  def next_indices(self):
+    idx = self.perm[self.cursor:self.cursor + self.batch_size]
+    self.cursor += self.batch_size
+    while idx.shape[0] < self.batch_size:
+      self._new_epoch()
+      need = self.batch_size - idx.shape[0]
+      idx = np.concatenate([idx, self.perm[:need]])
+      self.cursor = need
+    return idx
+
+  def get_state(self):
+    # Permutations are replaced rather than modified, so perm needs no copy
+    return {'rng': self.rng.get_state(), 'perm': self.perm,
+            'cursor': self.cursor}
+
+  def set_state(self, state):
+    self.rng.set_state(state['rng'])
+    self.perm = np.asarray(state['perm'])
+    self.cursor = state['cursor']
+
+
+class ChunkSampler(EpochSampler):
+  """
+  Builds minibatches out of chunks of consecutive training examples.
+
+  Gathering a random minibatch touches batch_size rows scattered across the
+  whole training array; a chunk of consecutive rows is read as one slice,
+  which is much cheaper when X_train is a memory-mapped file or a lazily
+  converted view such as data_utils.MeanSubtractedImages. Every epoch the
+  chunks are visited in a new random order and each minibatch is made of
+  several of them (four by default), so minibatches mix different parts of
+  the training set from epoch to epoch without the data ever being copied or
+  rearranged.
+
+  The trade-off is that examples in the same chunk always share a minibatch,
+  so the training set should not be sorted (for example by class). If
+  chunk_size does not divide num_train the last chunk is smaller.
+  """
+
+  def __init__(self, num_train, batch_size, y=None, seed=None,
+               chunk_size=None):
+    if chunk_size is None:
+      chunk_size = max(1, batch_size // 4)
+    self.chunk_size = chunk_size
+    self.num_chunks = (num_train + chunk_size - 1) / chunk_size
+    super(ChunkSampler, self).__init__(num_train, batch_size, y=y, seed=seed)
+
+  def _new_epoch(self):
+    # Visit the chunks in a random order, and the rows of each chunk in order
+    order = self.rng.permutation(self.num_chunks)
+    rows = order[:, None] * self.chunk_size + np.arange(self.chunk_size)
+    self.perm = rows[rows < self.num_train]
+    self.cursor = 0
+
+  def take(self, X, y, batch_idx):
+    breaks = np.flatnonzero(np.diff(batch_idx) != 1) + 1
+    runs = np.split(batch_idx, breaks)
+    X_batch = np.concatenate([X[run[0]:run[-1] + 1] for run in runs])
+    return X_batch, y[batch_idx]
+
+
+class StratifiedSampler(object):
+  """
+  Draws minibatches whose class proportions match those of the full training
+  set. Each class keeps its own permutation of its examples (sampling without
+  replacement within a class) and contributes a number of examples to each
+  minibatch proportional to its frequency; the remaining slots are filled by
+  picking classes at random in proportion to their frequency.
+  """
+
+  def __init__(self, num_train, batch_size, y=None, seed=None):
+    if y is None:
+      raise ValueError('StratifiedSampler requires training labels')
+    self.num_train = num_train
+    self.batch_size = batch_size
+    self.rng = _make_rng(seed)
+
+    self.classes, y_idx = np.unique(y, return_inverse=True)
+    order = np.argsort(y_idx, kind='mergesort')
+    counts = np.bincount(y_idx)
+    self.members = np.split(order, np.cumsum(counts)[:-1])
+    self.freq = counts / float(num_train)
+    self.base = np.floor(self.freq * batch_size).astype(np.int64)
+    self.perms = [self.rng.permutation(m) for m in self.members]
+    self.cursors = np.zeros(len(self.members), dtype=np.int64)
+
+  def _draw(self, c, count):
+    """
+    Take the next count examples of class c, reshuffling the class when its
+    permutation runs out.
+    """
+    perm = self.perms[c]
+    out = []
+    while count > 0:
+      if self.cursors[c] >= perm.shape[0]:
+        perm = self.perms[c] = self.rng.permutation(self.members[c])
+        self.cursors[c] = 0
+      take = min(count, perm.shape[0] - self.cursors[c])
+      out.append(perm[self.cursors[c]:self.cursors[c] + take])
+      self.cursors[c] += take
+      count -= take
+    return out
+
+  def next_indices(self):
+    counts = self.base.copy()
+    extra = self.batch_size - counts.sum()
+    if extra > 0:
+      counts += np.bincount(self.rng.choice(len(counts), extra, p=self.freq),
+                            minlength=len(counts))
+    idx = []
+    for c, count in enumerate(counts):
+      idx.extend(self._draw(c, count))
+    idx = np.concatenate(idx)
+    self.rng.shuffle(idx)
+    return idx
+
+  def get_state(self):
+    # Permutations are replaced rather than modified, so a shallow copy of
+    # the list is enough
+    return {'rng': self.rng.get_state(),
+            'perms': list(self.perms),
+            'cursors': self.cursors.copy()}
+
+  def set_state(self, state):
+    self.rng.set_state(state['rng'])
+    self.perms = [np.asarray(p) for p in state['perms']]
+    self.cursors = np.asarray(state['cursors']).copy()
+
+
+samplers = {
+  'random': RandomSampler,
+  'epoch': EpochSampler,
+  'chunk': ChunkSampler,
+  'stratified': StratifiedSampler,
+}
+
+
+def take_batch(sampler, X, y, batch_idx):
+  """
+  Gather the minibatch selected by batch_idx, letting the sampler override
+  how the rows are read.
+  """
+  if hasattr(sampler, 'take'):
+    return sampler.take(X, y, batch_idx)
+  return X[batch_idx], y[batch_idx]
+
+
+class Prefetcher(object):
+  """
+  Assembles minibatches on a background thread.
+
+  While the main thread runs model.loss on the current minibatch, a worker
+  thread draws indices from the sampler and copies the next minibatches out
+  of the training set into a small queue. NumPy releases the GIL while it
+  copies, so on large datasets the gather cost is hidden behind compute.
+
+  Each queued item also carries the sampler state from just after that batch
+  was drawn, so that the Solver can record the state corresponding to the
+  batches it has actually consumed rather than the ones still in the queue.
+
+  Example usage:
+
+  prefetcher = Prefetcher(sampler, X_train, y_train, depth=2)
+  X_batch, y_batch = prefetcher.next()
+  ...
+  prefetcher.close()
+  """
+
+  def __init__(self, sampler, X, y, depth=2):
+    """
+    Inputs:
+    - sampler: A sampler object as described at the top of this file.
+    - X, y: Training data and labels to gather minibatches from.
+    - depth: Number of minibatches to assemble ahead of time.
+    """
+    self.sampler = sampler
+    self.X = X
+    self.y = y
+    self.state = sampler.get_state()
+    self._error = None
+    self._queue = Queue.Queue(maxsize=depth)
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _put(self, item):
+    # Use a timeout so that close() is never blocked by a full queue
+    while not self._stop.is_set():
+      try:
+        self._queue.put(item, timeout=0.1)
+        break
+      except Queue.Full:
+        pass
+
+  def _run(self):
+    try:
+      while not self._stop.is_set():
+        batch_idx = self.sampler.next_indices()
+        X_batch, y_batch = take_batch(self.sampler, self.X, self.y, batch_idx)
+        self._put((X_batch, y_batch, self.sampler.get_state()))
+    except Exception:
+      # Keep the traceback of the worker thread; None in the queue tells
+      # next() that the batches before it are all there is
+      self._error = sys.exc_info()
+      self._put(None)
+
+  def next(self):
+    """
+    Return the next (X_batch, y_batch) pair. If assembling a minibatch
+    failed, this raises the worker's exception, with its traceback, once the
+    batches assembled before the failure have been returned, and again on
+    every later call.
+    """
+    item = self._queue.get()
+    if item is None:
+      # The worker has stopped, so there is room to put the marker back
+      self._queue.put(None)
+      raise self._error[0], self._error[1], self._error[2]
+    X_batch, y_batch, self.state = item
+    return X_batch, y_batch
+
+  def close(self):
+    """
+    Stop the background thread. Batches left in the queue are discarded.
+    """
+    self._stop.set()
+    while True:
+      try:
+        self._queue.get_nowait()
+      except Queue.Empty:
+        break
+    self._thread.join()
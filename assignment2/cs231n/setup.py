@@ -1,11 +1,54 @@
+import os
+import shutil
+import sys
+import tempfile
+
+from distutils.ccompiler import new_compiler
 from distutils.core import setup
+from distutils.errors import CompileError, LinkError
 from distutils.extension import Extension
+from distutils.sysconfig import customize_compiler
 from Cython.Build import cythonize
 import numpy
 
+
+def openmp_flags():
+  """
+  Return the compiler flags needed to build with OpenMP, or an empty list if
+  the compiler does not support it (for example Apple clang) or if the
+  CS231N_NO_OPENMP environment variable is set. Without OpenMP the parallel
+  loops in im2col_cython.pyx simply run on a single thread.
+  """
+  if os.environ.get('CS231N_NO_OPENMP'):
+    return []
+  flag = '/openmp' if sys.platform == 'win32' else '-fopenmp'
+  tmp_dir = tempfile.mkdtemp()
+  try:
+    source = os.path.join(tmp_dir, 'check_openmp.c')
+    with open(source, 'w') as f:
+      f.write('#include <omp.h>\n'
+              'int main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n')
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    objects = compiler.compile([source], output_dir=tmp_dir,
+                               extra_postargs=[flag])
+    compiler.link_executable(objects, os.path.join(tmp_dir, 'check_openmp'),
+                             extra_postargs=[flag])
+  except (CompileError, LinkError):
+    print 'OpenMP is not available; building single-threaded kernels'
+    return []
+  finally:
+    shutil.rmtree(tmp_dir)
+  return [flag]
+
+
+flags = openmp_flags()
+
 extensions = [
   Extension('im2col_cython', ['im2col_cython.pyx'],
-            include_dirs = [numpy.get_include()]
+            include_dirs = [numpy.get_include()],
+            extra_compile_args = flags,
+            extra_link_args = flags,
   ),
 ]
 
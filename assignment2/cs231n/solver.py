@@ -1,6 +1,47 @@
+import copy
+import threading
+
 import numpy as np
 
 from cs231n import optim
+from cs231n import parallel
+from cs231n import samplers
+from cs231n.checkpoint import save_checkpoint, load_checkpoint
+
+
+class _FlatParams(object):
+  """
+  Packs a dictionary of arrays into one contiguous buffer, with views of the
+  buffer standing in for the original arrays, plus a matching buffer for
+  their gradients.
+  """
+
+  def __init__(self, params, dtype):
+    self.names = sorted(params)
+    total = sum(params[name].size for name in self.names)
+    self.w = np.empty(total, dtype=dtype)
+    self.dw = np.empty(total, dtype=dtype)
+    self.views = {}
+    self.grad_views = {}
+    offset = 0
+    for name in self.names:
+      shape, size = params[name].shape, params[name].size
+      self.views[name] = self.w[offset:offset + size].reshape(shape)
+      self.grad_views[name] = self.dw[offset:offset + size].reshape(shape)
+      offset += size
+    self.load(params)
+
+  def load(self, params):
+    for name in self.names:
+      if name in params:
+        self.views[name][...] = params[name]
+
+  def load_grads(self, grads):
+    for name in self.names:
+      if name in grads:
+        self.grad_views[name][...] = grads[name]
+      else:
+        self.grad_views[name][...] = 0
 
 
 class Solver(object):
@@ -44,6 +85,15 @@ class Solver(object):
                   print_every=100)
   solver.train()
 
+  If a checkpoint_dir is given, the Solver periodically saves everything it
+  needs to continue training there. To resume a run that was interrupted,
+  construct a Solver with the same model, data and arguments and restore it
+  from the checkpoint before training:
+
+  solver = Solver(model, data, checkpoint_dir='/path/to/checkpoint', ...)
+  solver.restore('/path/to/checkpoint')
+  solver.train()
+
 
   A Solver works on a model object that must conform to the following API:
 
@@ -69,6 +119,8 @@ class Solver(object):
     - loss: Scalar giving the loss
     - grads: Dictionary with the same keys as self.params mapping parameter
       names to gradients of the loss with respect to those parameters.
+      Parameters that are missing from grads (such as frozen parameters) are
+      left unchanged.
   """
 
   def __init__(self, model, data, **kwargs):
@@ -99,6 +151,70 @@ class Solver(object):
       iterations.
     - verbose: Boolean; if set to false then no output will be printed during
       training.
+    - sampler: A string giving the name of a minibatch sampler in samplers.py:
+      'random' (default; independent draws with replacement), 'epoch'
+      (a new permutation every epoch), 'chunk' (runs of consecutive examples
+      in a new random order every epoch) or 'stratified' (class-balanced).
+    - sampler_seed: If not None, seed for the sampler's random generator.
+    - prefetch: Integer; if greater than zero, assemble this many minibatches
+      ahead of time on a background thread. Default is 0.
+    - mixed_precision: Boolean; if True, keep float64 master copies of the
+      parameters and apply the update rule to them, while the model computes
+      its forward and backward passes in its own dtype (such as float32)
+      with parameters rounded from the master copies after every update.
+      Default is False.
+    - loss_scale: Used with mixed_precision. Either a number by which the loss
+      is multiplied before the backward pass (the gradients are divided by it
+      again in float64), or 'dynamic' (the default) to start at 2**10, halve
+      it and skip the update whenever a gradient overflows, and double it
+      after loss_scale_window updates without overflow. Loss scaling needs a
+      model with a loss_scale attribute; for other models it is disabled.
+    - loss_scale_window: Number of overflow-free updates after which a
+      dynamic loss scale is doubled. Default is 1000.
+    - flat_params: Boolean; if True, pack all parameters (or their master
+      copies, with mixed_precision), their gradients and the optimizer state
+      into single contiguous buffers and apply the update rule once per step
+      to the whole buffer instead of once per parameter. model.params then
+      holds views into the buffer, and the update rule state lives in
+      optim_configs['_flat']. Default is False.
+    - checkpoint_dir: If not None, directory in which to save checkpoints
+      during training; see checkpoint.py for the format. Default is None.
+    - checkpoint_every: Integer; save a checkpoint every checkpoint_every
+      iterations. If None (the default), save one at the end of every epoch.
+      A checkpoint is also saved after the last iteration.
+    - eval_every: Integer; check train and validation accuracy every
+      eval_every iterations. If None (the default), check at the end of every
+      epoch. Accuracy is also checked after the first and last iterations.
+    - num_train_samples: Number of training examples sampled to check
+      training accuracy. Default is 1000.
+    - num_val_samples: Number of validation examples sampled to check
+      validation accuracy, or None (the default) to use them all.
+    - eval_sample_growth: Factor by which num_train_samples and
+      num_val_samples grow after every check, so that early checks are cheap
+      and later ones (when accuracies are close) more precise. Default is 1.
+    - patience: If not None, stop training early once the validation accuracy
+      has not improved for this many checks in a row. Default is None.
+    - eval_batch_size: Number of examples per forward pass when checking
+      accuracy. If None (the default), it is chosen so that the activations
+      fit in eval_memory_budget, using model.activation_bytes(N) if the model
+      has it and the size of the input otherwise.
+    - eval_memory_budget: Bytes available for one evaluation batch; default
+      is 64 MB.
+    - eval_async: Boolean; if True, check accuracy on a background thread
+      using a snapshot of the model, while training continues. The results,
+      and the decisions about the best parameters and early stopping that
+      depend on them, arrive a few iterations late. Default is False.
+    - num_workers: Integer; if greater than zero, compute the loss and
+      gradients on a pool of this many worker processes; see parallel.py.
+      The training data is copied once into shared memory, and prefetch is
+      ignored. Default is 0.
+    - parallel_mode: Either 'sync' (the default), to split every minibatch
+      across the workers and average their gradients before each update, or
+      'async', to let each worker train on whole minibatches and update the
+      shared parameters Hogwild-style, with its own update rule state. The
+      async mode does not support mixed_precision or flat_params, and since
+      the update rule state lives in the workers, resuming an async run
+      from a checkpoint restarts that state.
     """
     self.model = model 
     self.X_train = data['X_train']
@@ -115,6 +231,25 @@ class Solver(object):
 
     self.print_every = kwargs.pop('print_every', 10)
     self.verbose = kwargs.pop('verbose', True)
+    self.sampler = kwargs.pop('sampler', 'random')
+    self.sampler_seed = kwargs.pop('sampler_seed', None)
+    self.prefetch = kwargs.pop('prefetch', 0)
+    self.mixed_precision = kwargs.pop('mixed_precision', False)
+    self.loss_scale = kwargs.pop('loss_scale', 'dynamic')
+    self.loss_scale_window = kwargs.pop('loss_scale_window', 1000)
+    self.flat_params = kwargs.pop('flat_params', False)
+    self.checkpoint_dir = kwargs.pop('checkpoint_dir', None)
+    self.checkpoint_every = kwargs.pop('checkpoint_every', None)
+    self.eval_every = kwargs.pop('eval_every', None)
+    self.num_train_samples = kwargs.pop('num_train_samples', 1000)
+    self.num_val_samples = kwargs.pop('num_val_samples', None)
+    self.eval_sample_growth = kwargs.pop('eval_sample_growth', 1.0)
+    self.patience = kwargs.pop('patience', None)
+    self.eval_batch_size = kwargs.pop('eval_batch_size', None)
+    self.eval_memory_budget = kwargs.pop('eval_memory_budget', 2**26)
+    self.eval_async = kwargs.pop('eval_async', False)
+    self.num_workers = kwargs.pop('num_workers', 0)
+    self.parallel_mode = kwargs.pop('parallel_mode', 'sync')
 
     # Throw an error if there are extra keyword arguments
     if len(kwargs) > 0:
@@ -127,6 +262,23 @@ class Solver(object):
       raise ValueError('Invalid update_rule "%s"' % self.update_rule)
     self.update_rule = getattr(optim, self.update_rule)
 
+    if self.sampler not in samplers.samplers:
+      raise ValueError('Invalid sampler "%s"' % self.sampler)
+
+    if self.parallel_mode not in ('sync', 'async'):
+      raise ValueError('Invalid parallel_mode "%s"' % self.parallel_mode)
+    if self.parallel_mode == 'async' and (self.mixed_precision or
+                                          self.flat_params):
+      raise ValueError('parallel_mode "async" does not support '
+                       'mixed_precision or flat_params')
+
+    self.dynamic_loss_scale = self.loss_scale == 'dynamic'
+    if self.dynamic_loss_scale:
+      self.loss_scale = 2.0 ** 10
+    if not hasattr(self.model, 'loss_scale'):
+      self.loss_scale = 1.0
+      self.dynamic_loss_scale = False
+
     self._reset()
 
 
@@ -143,30 +295,101 @@ class Solver(object):
     self.train_acc_history = []
     self.val_acc_history = []
 
+    # Iteration at which the next call to train() starts; restore() sets it
+    # to continue an interrupted run
+    self._start_iteration = 0
+
+    # Evaluation state: the current sample sizes, the number of checks since
+    # the validation accuracy last improved, and any check running on a
+    # background thread
+    self._eval_num_samples = [self.num_train_samples, self.num_val_samples]
+    self._evals_since_best = 0
+    self.stopped_early = False
+    self._pending_eval = None
+
+    # With mixed precision the update rule works on float64 master copies of
+    # the parameters, so its state (such as Adam's moments) is float64 too
+    self.master_params = None
+    if self.mixed_precision:
+      self.master_params = {}
+      for p, w in self.model.params.iteritems():
+        self.master_params[p] = w.astype(np.float64)
+    self.num_skipped_steps = 0
+    self._good_steps = 0
+
     # Make a deep copy of the optim_config for each parameter
     self.optim_configs = {}
     for p in self.model.params:
       d = {k: v for k, v in self.optim_config.iteritems()}
       self.optim_configs[p] = d
 
+    # In flat mode a single config holds the state for all parameters
+    self._flat = None
+    if self.flat_params:
+      if self.mixed_precision:
+        self._flat = _FlatParams(self.model.params, np.float64)
+        self.master_params = self._flat.views
+      else:
+        dtype = np.result_type(*self.model.params.values())
+        self._flat = _FlatParams(self.model.params, dtype)
+        self.model.params.update(self._flat.views)
+      self.optim_configs = {'_flat': dict(self.optim_config)}
+
+    # Set up the minibatch sampler
+    num_train = self.X_train.shape[0]
+    sampler_class = samplers.samplers[self.sampler]
+    self._sampler = sampler_class(num_train, self.batch_size, y=self.y_train,
+                                  seed=self.sampler_seed)
+    self._prefetcher = None
+    self._parallel = None
+
+
+  def _next_batch(self):
+    """
+    Return the next minibatch of training data, either from the prefetcher
+    or by gathering it directly.
+    """
+    if self._prefetcher is not None:
+      return self._prefetcher.next()
+    batch_idx = self._sampler.next_indices()
+    return samplers.take_batch(self._sampler, self.X_train, self.y_train,
+                               batch_idx)
+
 
   def _step(self):
     """
     Make a single gradient update. This is called by train() and should not
     be called manually.
     """
-    # Make a minibatch of training data
-    num_train = self.X_train.shape[0]
-    batch_mask = np.random.choice(num_train, self.batch_size)
-    X_batch = self.X_train[batch_mask]
-    y_batch = self.y_train[batch_mask]
-
-    # Compute loss and gradient
-    loss, grads = self.model.loss(X_batch, y_batch)
+    # Compute loss and gradient on a minibatch of training data
+    if self.mixed_precision and hasattr(self.model, 'loss_scale'):
+      self.model.loss_scale = self.loss_scale
+    if self._parallel is None:
+      X_batch, y_batch = self._next_batch()
+      loss, grads = self.model.loss(X_batch, y_batch)
+    elif self.parallel_mode == 'sync':
+      loss, grads = self._parallel.loss(self.model.params,
+                                        self._sampler.next_indices(),
+                                        getattr(self.model, 'loss_scale', 1.0))
+    else:
+      # The workers update the parameters themselves
+      lr_scale = self.lr_decay ** self.epoch
+      self.loss_history.extend(
+          self._parallel.async_step(self._sampler.next_indices(), lr_scale))
+      return
     self.loss_history.append(loss)
 
+    if self._flat is not None:
+      self._flat_update(grads)
+      return
+    if self.mixed_precision:
+      self._mixed_precision_update(grads)
+      return
+
     # Perform a parameter update
     for p, w in self.model.params.iteritems():
+      if p not in grads:
+        continue
       dw = grads[p]
       config = self.optim_configs[p]
       next_w, next_config = self.update_rule(w, dw, config)
@@ -174,7 +397,87 @@ class Solver(object):
       self.optim_configs[p] = next_config
 
 
-  def check_accuracy(self, X, y, num_samples=None, batch_size=100):
+  def _mixed_precision_update(self, grads):
+    """
+    Unscale the gradients in float64, apply the update rule to the master
+    copies of the parameters and copy the results back into the model. If
+    any gradient overflowed the update is skipped, and with dynamic loss
+    scaling the loss scale is halved.
+    """
+    master_grads = {}
+    finite = True
+    for p, dw in grads.iteritems():
+      dw = dw.astype(np.float64)
+      if self.loss_scale != 1:
+        dw /= self.loss_scale
+      if not np.all(np.isfinite(dw)):
+        finite = False
+        break
+      master_grads[p] = dw
+    if not self._update_loss_scale(finite):
+      return
+
+    for p, w in self.master_params.iteritems():
+      if p not in master_grads:
+        continue
+      config = self.optim_configs[p]
+      next_w, next_config = self.update_rule(w, master_grads[p], config)
+      self.master_params[p] = next_w
+      self.optim_configs[p] = next_config
+      self.model.params[p] = next_w.astype(self.model.params[p].dtype)
+
+
+  def _update_loss_scale(self, finite):
+    """
+    Record whether the gradients of a mixed precision step were finite,
+    adjusting a dynamic loss scale. Returns finite; if it is False the step
+    must be skipped.
+    """
+    if not finite:
+      self.num_skipped_steps += 1
+      if self.dynamic_loss_scale:
+        self.loss_scale /= 2
+        self._good_steps = 0
+    elif self.dynamic_loss_scale:
+      self._good_steps += 1
+      if self._good_steps >= self.loss_scale_window:
+        self.loss_scale *= 2
+        self._good_steps = 0
+    return finite
+
+
+  def _flat_update(self, grads):
+    """
+    Copy the gradients into the flat gradient buffer and apply the update
+    rule to the whole flat parameter buffer at once. Parameters missing from
+    grads get a zero gradient and are restored after the update, since
+    rules with state (such as momentum) could otherwise still move them.
+    """
+    flat = self._flat
+    frozen = {}
+    for p in flat.names:
+      if p not in grads:
+        frozen[p] = flat.views[p].copy()
+    flat.load_grads(grads)
+    if self.mixed_precision:
+      if self.loss_scale != 1:
+        flat.dw /= self.loss_scale
+      if not self._update_loss_scale(np.all(np.isfinite(flat.dw))):
+        return
+
+    config = self.optim_configs['_flat']
+    next_w, self.optim_configs['_flat'] = self.update_rule(flat.w, flat.dw,
+                                                           config)
+    if next_w is not flat.w:
+      flat.w[...] = next_w
+    flat.load(frozen)
+
+    if self.mixed_precision:
+      for p in flat.names:
+        self.model.params[p] = flat.views[p].astype(self.model.params[p].dtype)
+
+
+  def check_accuracy(self, X, y, num_samples=None, batch_size=None):
     """
     Check accuracy of the model on the provided data.
     
@@ -184,35 +487,143 @@ class Solver(object):
     - num_samples: If not None, subsample the data and only test the model
       on num_samples datapoints.
     - batch_size: Split X and y into batches of this size to avoid using too
-      much memory.
+      much memory. If None, the batch size is chosen from
+      eval_memory_budget.
       
     Returns:
     - acc: Scalar giving the fraction of instances that were correctly
       classified by the model.
     """
-    
-    # Maybe subsample the data
+    return self._accuracy(self.model, X, y, num_samples, batch_size,
+                          np.random)
+
+
+  def _eval_batch_size(self, model, X):
+    if self.eval_batch_size is not None:
+      return self.eval_batch_size
+    per_example = X[0].nbytes
+    if hasattr(model, 'activation_bytes'):
+      per_example += model.activation_bytes(1)
+    return int(max(1, min(X.shape[0], self.eval_memory_budget / per_example)))
+
+
+  def _accuracy(self, model, X, y, num_samples, batch_size, rng):
+    """
+    Compute the accuracy of model on X and y as described in check_accuracy,
+    drawing the subsample from the random generator rng. Models with a
+    predict method are evaluated through it and others through model.loss.
+    Only one batch of the (subsampled) data is gathered at a time, and only
+    the count of correct predictions is kept.
+    """
     N = X.shape[0]
+    mask = None
     if num_samples is not None and N > num_samples:
-      mask = np.random.choice(N, num_samples)
+      mask = rng.choice(N, num_samples)
       N = num_samples
-      X = X[mask]
-      y = y[mask]
+    if batch_size is None:
+      batch_size = self._eval_batch_size(model, X)
+
+    num_correct = 0
+    for start in xrange(0, N, batch_size):
+      end = start + batch_size
+      if mask is None:
+        X_batch, y_batch = X[start:end], y[start:end]
+      else:
+        X_batch, y_batch = X[mask[start:end]], y[mask[start:end]]
+      if hasattr(model, 'predict'):
+        y_pred = model.predict(X_batch, batch_size=batch_size)
+      else:
+        y_pred = np.argmax(model.loss(X_batch), axis=1)
+      num_correct += np.sum(y_pred == y_batch)
+    return float(num_correct) / N
+
+
+  def _run_eval(self, model, rng, num_samples, result):
+    """
+    Check train and validation accuracy of model, storing them (or the
+    exception that stopped the check) in the dictionary result.
+    """
+    try:
+      result['train_acc'] = self._accuracy(model, self.X_train, self.y_train,
+                                           num_samples[0], None, rng)
+      result['val_acc'] = self._accuracy(model, self.X_val, self.y_val,
+                                         num_samples[1], None, rng)
+    except Exception as e:
+      result['error'] = e
 
-    # Compute predictions in batches
-    num_batches = N / batch_size
-    if N % batch_size != 0:
-      num_batches += 1
-    y_pred = []
-    for i in xrange(num_batches):
-      start = i * batch_size
-      end = (i + 1) * batch_size
-      scores = self.model.loss(X[start:end])
-      y_pred.append(np.argmax(scores, axis=1))
-    y_pred = np.hstack(y_pred)
-    acc = np.mean(y_pred == y)
 
-    return acc
+  def _start_eval(self):
+    """
+    Check train and validation accuracy, either right away or, with
+    eval_async, on a background thread using a copy of the model.
+    """
+    self._finish_eval()
+    num_samples = list(self._eval_num_samples)
+    sizes = [self.X_train.shape[0], self.X_val.shape[0]]
+    for i, n in enumerate(self._eval_num_samples):
+      if n is not None:
+        self._eval_num_samples[i] = min(int(n * self.eval_sample_growth),
+                                        sizes[i])
+
+    result = {'epoch': self.epoch}
+    if not self.eval_async:
+      self._run_eval(self.model, np.random, num_samples, result)
+      self._record_eval(self.model, result)
+      return
+
+    # The copy has its own parameters and batchnorm / dropout settings, so
+    # training can go on changing the originals; it also gets its own random
+    # generator for drawing the subsamples.
+    model = copy.deepcopy(self.model)
+    rng = np.random.RandomState(np.random.randint(2**31 - 1))
+    thread = threading.Thread(target=self._run_eval,
+                              args=(model, rng, num_samples, result))
+    thread.daemon = True
+    thread.start()
+    self._pending_eval = (thread, model, result)
+
+
+  def _finish_eval(self, wait=True):
+    """
+    Record the result of a check running on a background thread, if there is
+    one; if wait is False, only do so if it has already finished.
+    """
+    if self._pending_eval is None:
+      return
+    thread, model, result = self._pending_eval
+    if not wait and thread.is_alive():
+      return
+    thread.join()
+    self._pending_eval = None
+    self._record_eval(model, result)
+
+
+  def _record_eval(self, model, result):
+    """
+    Append the accuracies in result to the histories and keep track of the
+    best parameters, taken from model, and of early stopping.
+    """
+    if 'error' in result:
+      raise result['error']
+    train_acc, val_acc = result['train_acc'], result['val_acc']
+    self.train_acc_history.append(train_acc)
+    self.val_acc_history.append(val_acc)
+
+    if self.verbose:
+      print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+             result['epoch'], self.num_epochs, train_acc, val_acc)
+
+    # Keep track of the best model
+    if val_acc > self.best_val_acc:
+      self.best_val_acc = val_acc
+      self.best_params = {}
+      for k, v in model.params.iteritems():
+        self.best_params[k] = v.copy()
+      self._evals_since_best = 0
+    else:
+      self._evals_since_best += 1
+      if self.patience is not None and self._evals_since_best >= self.patience:
+        self.stopped_early = True
 
 
   def train(self):
@@ -223,11 +634,55 @@ class Solver(object):
     iterations_per_epoch = max(num_train / self.batch_size, 1)
     num_iterations = self.num_epochs * iterations_per_epoch
 
-    for t in xrange(num_iterations):
+    if self.num_workers > 0:
+      self._parallel = parallel.DataParallel(
+          self.model, self.X_train, self.y_train, self.num_workers,
+          mode=self.parallel_mode, update_rule=self.update_rule,
+          optim_config=self.optim_config)
+      if self.parallel_mode == 'async':
+        # The workers write to the shared parameters, so the model reads them
+        # from there too
+        self.model.params.update(self._parallel.params)
+    elif self.prefetch > 0:
+      self._prefetcher = samplers.Prefetcher(self._sampler, self.X_train,
+                                             self.y_train,
+                                             depth=self.prefetch)
+    try:
+      self._train_loop(num_iterations, iterations_per_epoch)
+    finally:
+      if self._parallel is not None:
+        self._parallel.close()
+        self._parallel = None
+      if self._prefetcher is not None:
+        # Rewind the sampler past any batches that were assembled but never
+        # used, so that a later call to train() picks up where we stopped.
+        self._prefetcher.close()
+        self._sampler.set_state(self._prefetcher.state)
+        self._prefetcher = None
+
+    # At the end of training swap the best params into the model. In flat
+    # mode model.params (or, with mixed precision, the master copies) are
+    # views into the flat buffer, so the best params are copied into it.
+    if self._flat is not None:
+      self._flat.load(self.best_params)
+    if self._flat is None or self.mixed_precision:
+      self.model.params = self.best_params
+    if self._flat is None and self.mixed_precision:
+      for p, w in self.model.params.iteritems():
+        self.master_params[p] = w.astype(np.float64)
+
+
+  def _train_loop(self, num_iterations, iterations_per_epoch):
+    """
+    Run the main optimization loop. This is called by train() and should not
+    be called manually.
+    """
+    self.stopped_early = False
+    for t in xrange(self._start_iteration, num_iterations):
       self._step()
 
       # Maybe print training loss
-      if self.verbose and t % self.print_every == 0:
+      if self.verbose and t % self.print_every == 0 and self.loss_history:
         print '(Iteration %d / %d) loss: %f' % (
                t + 1, num_iterations, self.loss_history[-1])
 
@@ -237,30 +692,134 @@ class Solver(object):
       if epoch_end:
         self.epoch += 1
         for k in self.optim_configs:
-          self.optim_configs[k]['learning_rate'] *= self.lr_decay
+          # The update rule fills in a default learning rate on its first
+          # call, which may not have happened yet if every step was skipped
+          if 'learning_rate' in self.optim_configs[k]:
+            self.optim_configs[k]['learning_rate'] *= self.lr_decay
 
       # Check train and val accuracy on the first iteration, the last
-      # iteration, and at the end of each epoch.
+      # iteration, and at the end of each epoch or every eval_every
+      # iterations.
       first_it = (t == 0)
-      last_it = (t == num_iterations + 1)
-      if first_it or last_it or epoch_end:
-        train_acc = self.check_accuracy(self.X_train, self.y_train,
-                                        num_samples=1000)
-        val_acc = self.check_accuracy(self.X_val, self.y_val)
-        self.train_acc_history.append(train_acc)
-        self.val_acc_history.append(val_acc)
-
+      last_it = (t == num_iterations - 1)
+      if self.eval_every is None:
+        eval_now = epoch_end
+      else:
+        eval_now = (t + 1) % self.eval_every == 0
+      if first_it or last_it or eval_now:
+        self._drain_parallel()
+        self._start_eval()
+      else:
+        self._finish_eval(wait=False)
+
+      # Maybe save a checkpoint
+      if self.checkpoint_dir is not None:
+        if self.checkpoint_every is None:
+          checkpoint_now = epoch_end
+        else:
+          checkpoint_now = (t + 1) % self.checkpoint_every == 0
+        if checkpoint_now or last_it or self.stopped_early:
+          self._drain_parallel()
+          self._finish_eval()
+          self._save_checkpoint(t + 1)
+
+      if self.stopped_early:
         if self.verbose:
-          print '(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                 self.epoch, self.num_epochs, train_acc, val_acc)
-
-        # Keep track of the best model
-        if val_acc > self.best_val_acc:
-          self.best_val_acc = val_acc
-          self.best_params = {}
-          for k, v in self.model.params.iteritems():
-            self.best_params[k] = v.copy()
-
-    # At the end of training swap the best params into the model
-    self.model.params = self.best_params
+          print '(Iteration %d / %d) stopping early' % (t + 1, num_iterations)
+        break
+
+    self._drain_parallel()
+    self._finish_eval()
+    self._start_iteration = 0
+
+
+  def _drain_parallel(self):
+    # In async mode, wait for the minibatches still in flight so that the
+    # parameters and losses are up to date
+    if self._parallel is not None and self.parallel_mode == 'async':
+      self.loss_history.extend(self._parallel.drain())
+
+
+  def _sampler_state(self):
+    # The prefetcher may have drawn batches that were not used yet; its state
+    # is the one matching the batches actually consumed
+    if self._prefetcher is not None:
+      return self._prefetcher.state
+    return self._sampler.get_state()
+
+
+  def _save_checkpoint(self, iteration):
+    """
+    Save the training state after iteration iterations to checkpoint_dir.
+    """
+    state = {
+      'iteration': iteration,
+      'epoch': self.epoch,
+      'update_rule': self.update_rule.__name__,
+      'params': self.model.params,
+      'master_params': self.master_params,
+      'optim_configs': self.optim_configs,
+      'bn_params': getattr(self.model, 'bn_params', []),
+      'best_val_acc': self.best_val_acc,
+      'best_params': self.best_params,
+      'loss_history': np.array(self.loss_history),
+      'train_acc_history': self.train_acc_history,
+      'val_acc_history': self.val_acc_history,
+      'loss_scale': self.loss_scale,
+      'good_steps': self._good_steps,
+      'num_skipped_steps': self.num_skipped_steps,
+      'eval_num_samples': self._eval_num_samples,
+      'evals_since_best': self._evals_since_best,
+      'rng_state': np.random.get_state(),
+      'sampler_state': self._sampler_state(),
+    }
+    save_checkpoint(self.checkpoint_dir, state)
+
+
+  def restore(self, path):
+    """
+    Restore the training state saved in the checkpoint directory path, so
+    that the next call to train() continues from the iteration at which the
+    checkpoint was saved, exactly as if training had never stopped.
+
+    The Solver must have been constructed with the same model architecture,
+    update rule and options (including sampler_seed) as the one that saved
+    the checkpoint.
+    """
+    state = load_checkpoint(path)
+    if state['update_rule'] != self.update_rule.__name__:
+      raise ValueError('Checkpoint was saved with update_rule "%s"'
+                       % state['update_rule'])
+    params = state['params']
+    for p, w in self.model.params.iteritems():
+      if p not in params or params[p].shape != w.shape:
+        raise ValueError('Checkpoint parameters do not match the model')
+
+    # Copy into the existing arrays, which in flat mode are views into the
+    # flat buffers
+    for p, w in self.model.params.iteritems():
+      w[...] = params[p]
+    if self.master_params is not None:
+      for p, w in self.master_params.iteritems():
+        w[...] = state['master_params'][p]
+    self.optim_configs = state['optim_configs']
+    # The model shares its bn_params with its layers, so update them in place
+    for bn_param, saved in zip(getattr(self.model, 'bn_params', []),
+                               state['bn_params']):
+      bn_param.update(saved)
+
+    self.epoch = state['epoch']
+    self.best_val_acc = state['best_val_acc']
+    self.best_params = state['best_params']
+    self.loss_history = state['loss_history'].tolist()
+    self.train_acc_history = state['train_acc_history']
+    self.val_acc_history = state['val_acc_history']
+    self.loss_scale = state['loss_scale']
+    self._good_steps = state['good_steps']
+    self.num_skipped_steps = state['num_skipped_steps']
+    self._eval_num_samples = state['eval_num_samples']
+    self._evals_since_best = state['evals_since_best']
+    np.random.set_state(state['rng_state'])
+    self._sampler.set_state(state['sampler_state'])
+    self._start_iteration = state['iteration']
 